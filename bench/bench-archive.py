@@ -0,0 +1,95 @@
+#!/usr/bin/python -tt
+
+"""
+Compare the in-process recursive archiver with git-archive-recursive.sh on
+synthetic repos with deeply nested submodules.
+"""
+
+import logging
+import optparse
+import os.path
+import shutil
+import subprocess
+import sys
+import tarfile
+import tempfile
+
+import benchlib
+import tarlib
+
+
+def archive_with_script(repo, tarball):
+    args = [os.path.join(benchlib.TOPDIR, 'git-archive-recursive.sh'),
+            'HEAD', '--prefix', 'bench/', '-o', tarball]
+    subprocess.check_call(args, cwd=repo)
+
+
+def archive_in_process(repo, tarball):
+    def find_submodule(repo, commit, path, subcommit):
+        return os.path.join(repo, path)
+    archiver = tarlib.GitArchiver(find_submodule)
+    tarball_file = tarlib.CompressedFile(tarball)
+    try:
+        archiver.archive(repo, 'HEAD', 'bench', tarball_file)
+    finally:
+        archiver.close()
+        tarball_file.close()
+
+
+def tarball_members(tarball):
+    tar = tarfile.open(tarball)
+    members = sorted(member.name for member in tar if not member.isdir())
+    tar.close()
+    return members
+
+
+def parse_cli_args():
+    parser = optparse.OptionParser(usage='%prog [options]')
+    parser.add_option('--depth', type='int', default=4,
+                      help='levels of nested submodules (default: 4)')
+    parser.add_option('--fanout', type='int', default=2,
+                      help='submodules per repo (default: 2)')
+    parser.add_option('--files', type='int', default=100,
+                      help='files per repo (default: 100)')
+    parser.add_option('--size', type='int', default=2048,
+                      help='bytes per file (default: 2048)')
+    parser.add_option('--repeat', type='int', default=3,
+                      help='runs of each archiver (default: 3)')
+    (options, args) = parser.parse_args()
+    if args:
+        parser.error('no positional arguments are allowed')
+    return options
+
+
+def main():
+    options = parse_cli_args()
+    logging.basicConfig(stream=sys.stdout, level=logging.INFO,
+                        format='%(asctime)-15s [%(levelname)s] %(message)s')
+    workdir = tempfile.mkdtemp(prefix='rpmfab-bench-')
+    try:
+        repo = os.path.join(workdir, 'repo')
+        logging.info('Generating repo with %i levels of %i submodules',
+                     options.depth, options.fanout)
+        benchlib.make_git_repo(repo, nfiles=options.files, size=options.size,
+                               depth=options.depth, fanout=options.fanout)
+        results = {}
+        for (name, func) in [('git-archive-recursive.sh', archive_with_script),
+                             ('tarlib.GitArchiver', archive_in_process)]:
+            tarball = os.path.join(workdir, 'bench.tar')
+            times = []
+            for __ in xrange(options.repeat):
+                if os.path.exists(tarball):
+                    os.remove(tarball)
+                times.append(benchlib.time_call(func, repo, tarball))
+            results[name] = tarball_members(tarball)
+            logging.info('%-26s best %.3fs  mean %.3fs', name, min(times),
+                         sum(times) / len(times))
+        if len(set(map(tuple, results.values()))) != 1:
+            logging.error('Archivers produced different file lists')
+            sys.exit(1)
+    finally:
+        shutil.rmtree(workdir)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,124 @@
+#!/usr/bin/python -tt
+
+"""
+Compare choosing which -m macros to add to a spec file and adding them the
+way build-srpm-from-scm.py used to (looking for four forms of each macro in
+the whole spec text, then writing it all back through a temporary file)
+with scanning it once with speclib.macro_references and streaming it into
+its replacement with speclib.prepend_globals, on a large generated spec
+file with %includes.
+"""
+
+import logging
+import optparse
+import os
+import os.path
+import shutil
+import sys
+import tempfile
+
+import benchlib
+import speclib
+
+
+def write_spec(workdir, size, nmacros, nincludes):
+    """
+    Write a spec file of about size bytes that refers to half of nmacros
+    macros, and to a few more only from the files it %includes.
+    """
+    specfile = os.path.join(workdir, 'bench.spec')
+    with open(specfile, 'w') as spec:
+        spec.write('Name: bench\nVersion: 1.0\nRelease: 1%{?dist}\n'
+                   'Summary: Benchmark package\nLicense: MIT\n')
+        for i in xrange(nincludes):
+            include = 'macros{0}.inc'.format(i)
+            spec.write('Source{0}: {1}\n'.format(i + 1, include))
+            with open(os.path.join(workdir, include), 'w') as inc:
+                inc.write('%global from_inc{0} %{{?m{1}}}\n'
+                          .format(i, (i * 2 + 1) % nmacros))
+            spec.write('%include %{{SOURCE{0}}}\n'.format(i + 1))
+        spec.write('\n%description\nBenchmark\n\n%build\n')
+        i = 0
+        while spec.tell() < size:
+            spec.write('echo "%{{name}} step {0}: %{{?m{1}}} %{{!?m{1}:none}}'
+                       ' %%done"\n'.format(i, (i * 2) % nmacros))
+            i += 1
+        spec.write('\n%install\n\n%files\n')
+    return specfile
+
+
+def add_macros_old(specfile, macros):
+    with open(specfile) as original_file:
+        original = original_file.read()
+    applicable_macros = {}
+    for (key, val) in macros.iteritems():
+        for fmt in ['%{{{0}}}', '%{{?{0}}}', '%{{!?{0}}}', '%{0}']:
+            if fmt.format(key) in original:
+                applicable_macros[key] = val
+                break
+    modified = tempfile.NamedTemporaryFile(delete=False)
+    try:
+        for (key, val) in applicable_macros.iteritems():
+            modified.write('%global {0} {1}\n'.format(key, val))
+        modified.write('\n')
+        modified.write(original)
+    finally:
+        modified.close()
+    shutil.move(modified.name, specfile)
+    return applicable_macros
+
+
+def add_macros_new(specfile, macros):
+    referenced = speclib.macro_references(specfile)
+    applicable_macros = dict((key, val) for (key, val) in macros.iteritems()
+                             if key in referenced)
+    speclib.prepend_globals(specfile, applicable_macros)
+    return applicable_macros
+
+
+def parse_cli_args():
+    parser = optparse.OptionParser(usage='%prog [options]')
+    parser.add_option('--size', type='int', default=8 * 1024 * 1024,
+                      help='bytes in the spec (default: 8388608)')
+    parser.add_option('--macros', type='int', default=400,
+                      help='-m macros to add (default: 400)')
+    parser.add_option('--includes', type='int', default=20,
+                      help='%include files in the spec (default: 20)')
+    parser.add_option('--repeat', type='int', default=3,
+                      help='runs of each method (default: 3)')
+    (options, args) = parser.parse_args()
+    if args:
+        parser.error('no positional arguments are allowed')
+    return options
+
+
+def main():
+    options = parse_cli_args()
+    logging.basicConfig(stream=sys.stdout, level=logging.INFO,
+                        format='%(asctime)-15s [%(levelname)s] %(message)s')
+    workdir = tempfile.mkdtemp(prefix='rpmfab-bench-')
+    try:
+        logging.info('Generating a %i byte spec with %i includes',
+                     options.size, options.includes)
+        original = write_spec(workdir, options.size, options.macros,
+                              options.includes)
+        specfile = os.path.join(workdir, 'copy.spec')
+        macros = dict(('m{0}'.format(i), 'value{0}'.format(i))
+                      for i in xrange(options.macros))
+        for (name, func) in [('four searches each', add_macros_old),
+                             ('single pass', add_macros_new)]:
+            times = []
+            for __ in xrange(options.repeat):
+                shutil.copy(original, specfile)
+                times.append(benchlib.time_call(func, specfile, macros))
+            shutil.copy(original, specfile)
+            added = func(specfile, macros)
+            logging.info('%-20s best %.3fs  mean %.3fs  (%i macros added)',
+                         name, min(times), sum(times) / len(times),
+                         len(added))
+    finally:
+        shutil.rmtree(workdir)
+
+
+if __name__ == '__main__':
+    main()
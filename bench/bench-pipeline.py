@@ -0,0 +1,247 @@
+#!/usr/bin/python -tt
+
+"""
+Time each stage of building a package end to end (checking out sources,
+building tarballs, downloading spec sources, and building the SRPM and the
+RPMs) using synthetic repos served by git daemon (or bzr serve), so that
+they are cloned and fetched as real ones are, a local HTTP server for the
+spec file's remote sources, and fake-mock.py in place of mock.  What is
+left is rpmfab's own overhead.
+
+Timings are saved as JSON so later runs can be compared with --compare.
+"""
+
+import glob
+import imp
+import logging
+import optparse
+import os
+import os.path
+import shutil
+import sys
+import tempfile
+import time
+
+import benchlib
+
+# mocklib reads this when it is imported
+os.environ.setdefault('RPMFAB_MOCK',
+                      os.path.join(benchlib.TOPDIR, 'bench', 'fake-mock.py'))
+
+import cachelib
+import fetchlib
+import poollib
+
+buildsrpm = imp.load_source('build_srpm_from_scm',
+                            os.path.join(benchlib.TOPDIR,
+                                         'build-srpm-from-scm.py'))
+buildarch = imp.load_source('build_arch',
+                            os.path.join(benchlib.TOPDIR, 'build-arch.py'))
+
+STAGES = ('checkout_sources', 'build_tarballs', 'fetch_spec_sources',
+          'build_srpm', 'build_arch', 'total')
+CHROOT = 'bench-x86_64'
+
+
+def write_spec(specfile, base_url, nremote):
+    with open(specfile, 'w') as spec:
+        spec.write('Name: bench\nVersion: 1.0\nRelease: 1%{?dist}\n'
+                   'Summary: Benchmark package\nLicense: MIT\n'
+                   'Source0: bench-%{version}.tar.gz\n')
+        for i in xrange(nremote):
+            spec.write('Source{0}: {1}/extra{2}.tar.gz\n'
+                       .format(i + 1, base_url, i))
+        spec.write('\n%description\nBenchmark package\n\n%prep\n\n%build\n\n'
+                   '%install\n\n%files\n')
+
+
+def make_inputs(workdir, options, repo_servers):
+    """
+    Create the source repo, the packaging repo, and the files the spec
+    file downloads, and start serving those.  The processes serving the
+    repos are added to repo_servers.  Return the HTTP server and the two
+    repos' URLs.
+    """
+    repos = os.path.join(workdir, 'repos')
+    os.makedirs(repos)
+    src_repo = os.path.join(repos, 'src')
+    if options.vcs == 'bzr':
+        logging.info('Generating bzr repo with %i files', options.files)
+        benchlib.make_bzr_repo(src_repo, nfiles=options.files,
+                               size=options.size)
+    else:
+        logging.info('Generating git repo with %i levels of %i submodules',
+                     options.depth, options.fanout)
+        benchlib.make_git_repo(src_repo, nfiles=options.files,
+                               size=options.size, depth=options.depth,
+                               fanout=options.fanout)
+    downloads = os.path.join(workdir, 'downloads')
+    os.makedirs(downloads)
+    for i in xrange(options.remote_sources):
+        benchlib.write_random_file(
+            os.path.join(downloads, 'extra{0}.tar.gz'.format(i)),
+            options.remote_size, seed=i)
+    (server, base_url) = benchlib.serve_directory(downloads)
+    pkg_repo = os.path.join(repos, 'pkg')
+    os.makedirs(pkg_repo)
+    benchlib.git(pkg_repo, 'init', '-q')
+    write_spec(os.path.join(pkg_repo, 'bench.spec'), base_url,
+               options.remote_sources)
+    benchlib.git(pkg_repo, 'add', '-A')
+    benchlib.git(pkg_repo, 'commit', '-q', '-m', 'synthetic packaging')
+    (git_server, git_url) = benchlib.serve_repos(repos)
+    repo_servers.append(git_server)
+    src_url = git_url + '/src'
+    if options.vcs == 'bzr':
+        (bzr_server, bzr_url) = benchlib.serve_repos(repos, vcs='bzr')
+        repo_servers.append(bzr_server)
+        src_url = bzr_url + '/src'
+    return (server, git_url + '/pkg', src_url)
+
+
+def make_caches(cache_dir):
+    caches = dict((name, None) for name in ('mirror', 'tarball', 'download'))
+    if cache_dir:
+        for name in caches:
+            caches[name] = cachelib.CacheDir(os.path.join(cache_dir, name))
+    return caches
+
+
+def run_once(rundir, pkg_repo, src_repo, caches, jobs):
+    """
+    Build the package from scratch in rundir and return how long each stage
+    took.
+    """
+    mirrors = None
+    if caches['mirror']:
+        mirrors = buildsrpm.Mirrors(caches['mirror'])
+    downloader = fetchlib.Downloader(cache=caches['download'])
+    builder = buildsrpm.SRPMBuilder(CHROOT, pkg_repo,
+                                    sources=[(0, src_repo)], mock_opts=[],
+                                    mirrors=mirrors,
+                                    tarball_cache=caches['tarball'],
+                                    downloader=downloader)
+    builddir = os.path.join(rundir, 'builddir')
+    srpm_dir = os.path.join(rundir, 'srpm')
+    rpm_dir = os.path.join(rundir, 'rpms')
+    os.makedirs(builddir)
+    timings = {}
+    try:
+        start = time.time()
+        builder.checkout_packaging_repo(builddir)
+        builder.checkout_sources(rundir, jobs=jobs)
+        timings['checkout_sources'] = time.time() - start
+        timings['build_tarballs'] = benchlib.time_call(
+            poollib.run_tasks, builder.tarball_tasks(), jobs=jobs)
+        timings['fetch_spec_sources'] = benchlib.time_call(
+            builder.fetch_spec_sources, jobs=jobs)
+        timings['build_srpm'] = benchlib.time_call(builder.build_srpm,
+                                                   srpm_dir)
+        srpm = glob.glob(os.path.join(srpm_dir, '*.src.rpm'))[0]
+        timings['build_arch'] = benchlib.time_call(buildarch.build_arch,
+                                                   srpm, CHROOT, rpm_dir)
+    finally:
+        downloader.close()
+        if mirrors:
+            mirrors.release()
+    timings['total'] = sum(timings.values())
+    return timings
+
+
+def report(timings, old_results=None):
+    old_timings = old_results and old_results['timings'] or {}
+    for stage in STAGES:
+        times = timings[stage]
+        line = '{0:<20} best {1:8.3f}s  mean {2:8.3f}s'.format(
+            stage, min(times), sum(times) / len(times))
+        if old_timings.get(stage):
+            old_best = min(old_timings[stage])
+            line += '  was {0:8.3f}s ({1:+.1f}%)'.format(
+                old_best, (min(times) - old_best) / old_best * 100
+                if old_best else 0)
+        logging.info('%s', line)
+
+
+def parse_cli_args():
+    parser = optparse.OptionParser(usage='%prog [options]')
+    parser.add_option('--vcs', choices=('git', 'bzr'), default='git',
+                      help='kind of source repo to generate (default: git)')
+    parser.add_option('--depth', type='int', default=2,
+                      help='levels of nested git submodules (default: 2)')
+    parser.add_option('--fanout', type='int', default=2,
+                      help='git submodules per repo (default: 2)')
+    parser.add_option('--files', type='int', default=200,
+                      help='files per repo (default: 200)')
+    parser.add_option('--size', type='int', default=4096,
+                      help='bytes per file (default: 4096)')
+    parser.add_option('--remote-sources', type='int', default=4,
+                      help=('spec file sources served over HTTP '
+                            '(default: 4)'))
+    parser.add_option('--remote-size', type='int', default=1024 * 1024,
+                      help='bytes per served source (default: 1048576)')
+    parser.add_option('--mock-delay', type='float', default=0,
+                      help='seconds each fake mock run takes (default: 0)')
+    parser.add_option('-j', '--jobs', type='int', default=1,
+                      help='jobs to give each stage (default: 1)')
+    parser.add_option('--cache-dir', metavar='DIR', default=None,
+                      help=('keep mirror, tarball, and download caches in '
+                            'DIR, so runs after the first measure warm '
+                            'builds'))
+    parser.add_option('--repeat', type='int', default=3,
+                      help='builds to time (default: 3)')
+    parser.add_option('-o', '--output', metavar='FILE', default=None,
+                      help=('save results to FILE (default: '
+                            'bench-results/pipeline-TIMESTAMP.json)'))
+    parser.add_option('--compare', metavar='FILE', default=None,
+                      help='compare the results with an earlier run')
+    (options, args) = parser.parse_args()
+    if args:
+        parser.error('no positional arguments are allowed')
+    if options.vcs == 'bzr' and options.depth:
+        # Only git has submodules
+        options.depth = 0
+    return options
+
+
+def main():
+    options = parse_cli_args()
+    logging.basicConfig(stream=sys.stdout, level=logging.INFO,
+                        format='%(asctime)-15s [%(levelname)s] %(message)s')
+    # rpmfab's own logging would drown out the results
+    logging.getLogger().setLevel(logging.WARNING)
+    os.environ['RPMFAB_FAKE_MOCK_DELAY'] = str(options.mock_delay)
+    old_results = None
+    if options.compare:
+        old_results = benchlib.load_results(options.compare)
+    output = options.output or os.path.join(
+        'bench-results',
+        time.strftime('pipeline-%Y%m%d-%H%M%S.json', time.localtime()))
+    workdir = tempfile.mkdtemp(prefix='rpmfab-bench-')
+    server = None
+    repo_servers = []
+    try:
+        (server, pkg_repo, src_repo) = make_inputs(workdir, options,
+                                                   repo_servers)
+        caches = make_caches(options.cache_dir)
+        timings = dict((stage, []) for stage in STAGES)
+        for i in xrange(options.repeat):
+            rundir = os.path.join(workdir, 'run{0}'.format(i))
+            for (stage, secs) in run_once(rundir, pkg_repo, src_repo,
+                                          caches, options.jobs).iteritems():
+                timings[stage].append(secs)
+            shutil.rmtree(rundir)
+    finally:
+        if server:
+            server.shutdown()
+        for repo_server in repo_servers:
+            repo_server.terminate()
+            repo_server.wait()
+        shutil.rmtree(workdir)
+    logging.getLogger().setLevel(logging.INFO)
+    report(timings, old_results)
+    benchlib.save_results(output, 'pipeline', vars(options), timings)
+    logging.info('Results saved to %s', output)
+
+
+if __name__ == '__main__':
+    main()
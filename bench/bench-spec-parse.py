@@ -0,0 +1,103 @@
+#!/usr/bin/python -tt
+
+"""
+Compare parsing a spec file once for each build stage that needs it, as
+build-srpm-from-scm.py used to, with sharing one speclib.ParsedSpec between
+them, on a large generated spec file with many subpackages and %includes.
+"""
+
+import logging
+import optparse
+import os.path
+import shutil
+import sys
+import tempfile
+
+import benchlib
+import rpm
+import speclib
+
+# tarball_tasks, spec_fetch_tasks, and _get_nvr each parsed the spec
+STAGES = 3
+
+
+def write_spec(workdir, nsubpackages, nsources, nincludes):
+    specfile = os.path.join(workdir, 'bench.spec')
+    with open(specfile, 'w') as spec:
+        for i in xrange(nincludes):
+            include = os.path.join(workdir, 'macros{0}.inc'.format(i))
+            with open(include, 'w') as inc:
+                for j in xrange(50):
+                    inc.write('%global inc{0}_{1} %{{?dist}}.{0}.{1}\n'
+                              .format(i, j))
+            spec.write('%include {0}\n'.format(include))
+        spec.write('Name: bench\nVersion: 1.0\nRelease: 1%{?dist}\n'
+                   'Summary: Benchmark package\nLicense: MIT\n')
+        for i in xrange(nsources):
+            spec.write('Source{0}: http://example.com/bench-src{0}.tar.gz\n'
+                       .format(i))
+            spec.write('Patch{0}: bench-{0}.patch\n'.format(i))
+        spec.write('BuildRequires: gcc\n\n%description\nBenchmark\n\n')
+        for i in xrange(nsubpackages):
+            spec.write('%package sub{0}\nSummary: Subpackage {0}\n'
+                       'Requires: %{{name}} = %{{version}}-%{{release}}\n'
+                       'Provides: bench-cap{0} = %{{inc0_{1}}}\n\n'
+                       '%description sub{0}\nSubpackage {0}\n\n'
+                       .format(i, i % 50 if nincludes else 0))
+        spec.write('%prep\n%build\n%install\n%files\n')
+        for i in xrange(nsubpackages):
+            spec.write('%files sub{0}\n'.format(i))
+    return specfile
+
+
+def parse_per_stage(specfile):
+    for __ in xrange(STAGES):
+        rpm.ts().parseSpec(specfile)
+
+
+def parse_once(specfile):
+    spec = speclib.ParsedSpec(specfile)
+    for __ in xrange(STAGES):
+        spec.sources
+        spec.nvr
+
+
+def parse_cli_args():
+    parser = optparse.OptionParser(usage='%prog [options]')
+    parser.add_option('--subpackages', type='int', default=500,
+                      help='subpackages in the spec (default: 500)')
+    parser.add_option('--sources', type='int', default=200,
+                      help='sources and patches in the spec (default: 200)')
+    parser.add_option('--includes', type='int', default=20,
+                      help='%include files in the spec (default: 20)')
+    parser.add_option('--repeat', type='int', default=3,
+                      help='runs of each method (default: 3)')
+    (options, args) = parser.parse_args()
+    if args:
+        parser.error('no positional arguments are allowed')
+    return options
+
+
+def main():
+    options = parse_cli_args()
+    logging.basicConfig(stream=sys.stdout, level=logging.INFO,
+                        format='%(asctime)-15s [%(levelname)s] %(message)s')
+    workdir = tempfile.mkdtemp(prefix='rpmfab-bench-')
+    try:
+        logging.info('Generating spec with %i subpackages, %i sources, and '
+                     '%i includes', options.subpackages, options.sources,
+                     options.includes)
+        specfile = write_spec(workdir, options.subpackages, options.sources,
+                              options.includes)
+        for (name, func) in [('parse per stage', parse_per_stage),
+                             ('speclib.ParsedSpec', parse_once)]:
+            times = [benchlib.time_call(func, specfile)
+                     for __ in xrange(options.repeat)]
+            logging.info('%-20s best %.3fs  mean %.3fs', name, min(times),
+                         sum(times) / len(times))
+    finally:
+        shutil.rmtree(workdir)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,216 @@
+"""
+Helpers for generating synthetic inputs for rpmfab's benchmarks.
+"""
+
+import BaseHTTPServer
+import json
+import os
+import os.path
+import platform
+import random
+import SimpleHTTPServer
+import socket
+import SocketServer
+import subprocess
+import sys
+import threading
+import time
+
+# Make rpmfab's own modules importable from the benchmarks
+TOPDIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, TOPDIR)
+
+_GIT_ENV = dict(os.environ, GIT_AUTHOR_NAME='rpmfab bench',
+                GIT_AUTHOR_EMAIL='bench@localhost',
+                GIT_COMMITTER_NAME='rpmfab bench',
+                GIT_COMMITTER_EMAIL='bench@localhost',
+                GIT_AUTHOR_DATE='2015-01-01T00:00:00Z',
+                GIT_COMMITTER_DATE='2015-01-01T00:00:00Z')
+
+
+def git(repo, *args):
+    subprocess.check_call(('git',) + args, cwd=repo, env=_GIT_ENV)
+
+
+def write_files(topdir, nfiles, size, seed=0):
+    """
+    Fill a directory with nfiles pseudo-random files of about size bytes,
+    spread across a few levels of subdirectories.
+    """
+    rand = random.Random(seed)
+    for i in xrange(nfiles):
+        subdir = os.path.join(topdir, 'dir{0}'.format(i % 7),
+                              'sub{0}'.format(i % 3))
+        if not os.path.isdir(subdir):
+            os.makedirs(subdir)
+        with open(os.path.join(subdir, 'file{0}.txt'.format(i)), 'w') as f:
+            f.write(''.join(chr(rand.randint(32, 126)) for __ in xrange(size)))
+
+
+def make_git_repo(path, nfiles=50, size=1024, depth=0, fanout=1, seed=0):
+    """
+    Create a git repo with depth levels of submodules beneath it, each
+    level having fanout submodules, and return the paths of all of the
+    submodules.
+
+    Submodules are embedded repos with their own .git directories, as old
+    versions of git made them, and every repo's .gitmodules also maps the
+    submodules nested inside its own so git-archive-recursive.sh can
+    handle them too.
+    """
+    os.makedirs(path)
+    git(path, 'init', '-q')
+    write_files(path, nfiles, size, seed=seed)
+    submodules = []
+    for i in xrange(depth and fanout):
+        name = 'module{0}'.format(i)
+        nested = make_git_repo(os.path.join(path, name), nfiles=nfiles,
+                               size=size, depth=depth - 1, fanout=fanout,
+                               seed=seed * fanout + i + 1)
+        submodules.append(name)
+        submodules.extend(name + '/' + subpath for subpath in nested)
+    if submodules:
+        with open(os.path.join(path, '.gitmodules'), 'w') as f:
+            for subpath in submodules:
+                f.write('[submodule "{0}"]\n\tpath = {0}\n\turl = ./{0}\n'
+                        .format(subpath))
+    git(path, '-c', 'advice.addEmbeddedRepo=false', 'add', '-A')
+    git(path, 'commit', '-q', '-m', 'synthetic repo')
+    if submodules:
+        git(path, 'submodule', '-q', 'init')
+    return submodules
+
+
+def make_bzr_repo(path, nfiles=50, size=1024, seed=0):
+    """
+    Create a bzr branch with a working tree holding synthetic files.
+    """
+    os.makedirs(path)
+    subprocess.check_call(['bzr', 'init', '-q', path])
+    write_files(path, nfiles, size, seed=seed)
+    subprocess.check_call(['bzr', 'add', '-q'], cwd=path)
+    subprocess.check_call(['bzr', 'commit', '-q', '-m', 'synthetic repo'],
+                          cwd=path, env=dict(os.environ,
+                                             BZR_EMAIL='bench@localhost'))
+
+
+def write_random_file(path, size, seed=0):
+    rand = random.Random(seed)
+    with open(path, 'wb') as f:
+        f.write(''.join(chr(rand.randint(0, 255)) for __ in xrange(size)))
+
+
+class _QuietHandler(SimpleHTTPServer.SimpleHTTPRequestHandler):
+    # Keep connections alive as real servers do
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+
+class _ThreadingHTTPServer(SocketServer.ThreadingMixIn,
+                           BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+
+def serve_directory(path):
+    """
+    Serve the files in a directory over HTTP on localhost from a background
+    thread.  Return the server, whose shutdown method stops it, and the
+    base URL of the directory.
+    """
+    class Handler(_QuietHandler):
+        def translate_path(self, url_path):
+            url_path = url_path.split('?', 1)[0].split('#', 1)[0]
+            return os.path.join(path, *[part for part in url_path.split('/')
+                                        if part not in ('', '.', '..')])
+    server = _ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return (server, 'http://127.0.0.1:{0}'.format(server.server_address[1]))
+
+
+def serve_repos(path, vcs='git'):
+    """
+    Serve the repos under a directory on localhost with git daemon (or bzr
+    serve), so builds have to clone and fetch them as they would from a
+    real server.  Return the server process, which must be terminated,
+    and the base URL of the directory.
+    """
+    port = _free_port()
+    if vcs == 'bzr':
+        args = ['bzr', 'serve', '--directory', path,
+                '--port', '127.0.0.1:{0}'.format(port)]
+    else:
+        args = ['git', 'daemon', '--export-all', '--reuseaddr',
+                '--listen=127.0.0.1', '--port={0}'.format(port),
+                '--base-path=' + path, path]
+    server = subprocess.Popen(args)
+    deadline = time.time() + 30
+    while True:
+        try:
+            socket.create_connection(('127.0.0.1', port)).close()
+            break
+        except socket.error:
+            if server.poll() is not None or time.time() > deadline:
+                if server.poll() is None:
+                    server.kill()
+                raise RuntimeError('{0} did not start'.format(args[0]))
+            time.sleep(0.1)
+    return (server, '{0}://127.0.0.1:{1}'.format(vcs, port))
+
+
+def _free_port():
+    sock = socket.socket()
+    try:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+    finally:
+        sock.close()
+
+
+def rpmfab_revision():
+    """
+    Return the git revision of the rpmfab tree being benchmarked, marked
+    dirty if it has uncommitted changes, or None outside of git.
+    """
+    try:
+        rev = subprocess.check_output(['git', 'rev-parse', 'HEAD'],
+                                      cwd=TOPDIR).strip()
+        dirty = subprocess.call(['git', 'diff', '--quiet', 'HEAD'],
+                                cwd=TOPDIR)
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    return rev + ('-dirty' if dirty else '')
+
+
+def save_results(path, name, options, timings):
+    """
+    Write a benchmark's timings, a dict of lists of seconds, to a JSON file
+    along with what was benchmarked where, so runs can be compared later.
+    """
+    results = {'benchmark': name, 'time': time.time(),
+               'rpmfab_revision': rpmfab_revision(),
+               'host': platform.node(), 'platform': platform.platform(),
+               'cpus': os.sysconf('SC_NPROCESSORS_ONLN'),
+               'options': options, 'timings': timings}
+    directory = os.path.dirname(os.path.abspath(path))
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    with open(path, 'w') as f:
+        json.dump(results, f, indent=2, sort_keys=True)
+
+
+def load_results(path):
+    with open(path) as f:
+        return json.load(f)
+
+
+def time_call(func, *args, **kwargs):
+    """
+    Call a function and return how long it took in seconds.
+    """
+    start = time.time()
+    func(*args, **kwargs)
+    return time.time() - start
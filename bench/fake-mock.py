@@ -0,0 +1,163 @@
+#!/usr/bin/python -tt
+
+"""
+A stand-in for mock that benchmarks point rpmfab at with RPMFAB_MOCK, so
+they measure rpmfab's own overhead rather than real builds.
+
+It understands the options rpmfab passes to mock.  --buildsrpm writes
+NAME-VERSION-RELEASE.src.rpm from the spec file's Name, Version, and
+Release, and --rebuild writes NAME-VERSION-RELEASE.ARCH.rpm, taking ARCH
+from the end of the chroot name.  Both write logs and print the phase
+markers that mock -v does.  Their contents are not real RPMs but are the
+same every time for the same inputs.
+
+Environment variables:
+    RPMFAB_FAKE_MOCK_DELAY     seconds each build takes, half of it in
+                               chroot init (default: 0)
+    RPMFAB_FAKE_MOCK_SIZE      bytes of padding in each RPM (default: 65536)
+    RPMFAB_FAKE_MOCK_LOG_SIZE  bytes each build writes to build.log
+                               (default: 4096)
+"""
+
+import glob
+import hashlib
+import optparse
+import os
+import os.path
+import random
+import re
+import sys
+import time
+
+ARCHES = ('i386', 'i686', 'x86_64', 'armv7hl', 'aarch64', 'ppc64le',
+          's390x', 'noarch')
+
+
+def spec_nvr(specfile):
+    with open(specfile) as spec:
+        data = spec.read()
+    tags = {}
+    for tag in ('Name', 'Version', 'Release'):
+        match = re.search(r'^{0}:\s*(\S+)'.format(tag), data,
+                          re.MULTILINE | re.IGNORECASE)
+        if not match:
+            sys.exit('fake-mock: no {0} in {1}'.format(tag, specfile))
+        tags[tag] = match.group(1)
+    nvr = '{Name}-{Version}-{Release}'.format(**tags)
+    # Enough macro expansion for the specs the benchmarks generate
+    nvr = nvr.replace('%{?dist}', '')
+    for tag in ('name', 'version'):
+        nvr = nvr.replace('%{{{0}}}'.format(tag), tags[tag.capitalize()])
+    return nvr
+
+
+def write_rpm(path, digest):
+    size = int(os.environ.get('RPMFAB_FAKE_MOCK_SIZE', 65536))
+    rand = random.Random(digest)
+    with open(path, 'wb') as rpm:
+        rpm.write('fake-mock {0}\n'.format(digest))
+        rpm.write(''.join(chr(rand.randint(0, 255)) for __ in xrange(size)))
+
+
+def write_logs(resultdir, message):
+    for log in ('build.log', 'root.log', 'state.log'):
+        with open(os.path.join(resultdir, log), 'a') as log_file:
+            log_file.write('fake-mock: {0}\n'.format(message))
+
+
+def phase(name, secs, resultdir=None):
+    print 'INFO: Start: {0}'.format(name)
+    sys.stdout.flush()
+    if resultdir:
+        # Write the build log bit by bit, as rpmbuild would
+        log_size = int(os.environ.get('RPMFAB_FAKE_MOCK_LOG_SIZE', 4096))
+        line = 'fake-mock: compiling something or other\n'
+        steps = 10
+        with open(os.path.join(resultdir, 'build.log'), 'a') as log_file:
+            for __ in xrange(steps):
+                log_file.write(line * (log_size // len(line) // steps))
+                log_file.flush()
+                time.sleep(secs / steps)
+    else:
+        time.sleep(secs)
+    print 'INFO: Finish: {0}'.format(name)
+    sys.stdout.flush()
+
+
+def build_srpm(options):
+    digest = hashlib.sha1()
+    with open(options.spec, 'rb') as spec:
+        digest.update(spec.read())
+    for source in sorted(glob.glob(os.path.join(options.sources, '*'))):
+        if os.path.isfile(source):
+            digest.update(os.path.basename(source) + '\0')
+            with open(source, 'rb') as source_file:
+                for chunk in iter(lambda: source_file.read(1024 * 1024), ''):
+                    digest.update(chunk)
+    srpm = spec_nvr(options.spec) + '.src.rpm'
+    write_rpm(os.path.join(options.resultdir, srpm), digest.hexdigest())
+    write_logs(options.resultdir, 'wrote ' + srpm)
+
+
+def rebuild(options, srpm):
+    name = os.path.basename(srpm)
+    if not name.endswith('.src.rpm'):
+        sys.exit('fake-mock: {0} is not a source RPM'.format(srpm))
+    arch = options.chroot.rsplit('-', 1)[-1]
+    if arch not in ARCHES:
+        arch = 'x86_64'
+    digest = hashlib.sha1(options.chroot + '\0')
+    with open(srpm, 'rb') as srpm_file:
+        digest.update(srpm_file.read())
+    rpm = '{0}.{1}.rpm'.format(name[:-len('.src.rpm')], arch)
+    write_rpm(os.path.join(options.resultdir, rpm), digest.hexdigest())
+    with open(srpm, 'rb') as srpm_file:
+        data = srpm_file.read()
+    with open(os.path.join(options.resultdir, name), 'wb') as srpm_copy:
+        srpm_copy.write(data)
+    write_logs(options.resultdir, 'wrote ' + rpm)
+
+
+def parse_cli_args():
+    parser = optparse.OptionParser(usage='%prog [mock options]')
+    parser.add_option('-v', '--verbose', action='store_true')
+    parser.add_option('-q', '--quiet', action='store_true')
+    parser.add_option('-r', '--root', dest='chroot', default='default')
+    parser.add_option('--resultdir', default='.')
+    parser.add_option('--configdir')
+    parser.add_option('--uniqueext')
+    parser.add_option('--buildsrpm', action='store_true')
+    parser.add_option('--spec')
+    parser.add_option('--sources')
+    parser.add_option('--rebuild', action='store_true')
+    parser.add_option('--init', action='store_true')
+    parser.add_option('--no-clean', action='store_true')
+    parser.add_option('--addrepo', action='append')
+    parser.add_option('--define', action='append')
+    return parser.parse_args()
+
+
+def main():
+    (options, args) = parse_cli_args()
+    delay = float(os.environ.get('RPMFAB_FAKE_MOCK_DELAY', 0))
+    if options.init or not options.no_clean:
+        phase('chroot init', delay / 2)
+    if options.init:
+        return
+    if not os.path.isdir(options.resultdir):
+        os.makedirs(options.resultdir)
+    phase('rpmbuild', delay / 2, options.resultdir)
+    if options.buildsrpm:
+        if not options.spec or not options.sources:
+            sys.exit('fake-mock: --buildsrpm needs --spec and --sources')
+        build_srpm(options)
+    elif options.rebuild:
+        if len(args) != 1:
+            sys.exit('fake-mock: --rebuild needs exactly one source RPM')
+        rebuild(options, args[0])
+    else:
+        sys.exit('fake-mock: nothing to do')
+
+
+if __name__ == '__main__':
+    main()
@@ -6,71 +6,547 @@
 # copy logs and outputs to 'pending' dir?
 
 import glob
+import hashlib
+import json
 import logging
+import multiprocessing
 import optparse
 import os.path
+import shutil
 import subprocess
 import sys
+import tempfile
+import threading
+import time
+import urlparse
 
+import cachelib
+import fetchlib
 import mocklib
+import poollib
+import repolib
+import tracelib
 
 __version__ = '0.2'
 
-def build_arch(srpm, chroot, resultdir, mock_opts=None):
+MOCK_BASEDIR = '/var/lib/mock'
+PROVENANCE_FILE = 'noarch-provenance.json'
+
+def build_arch(srpm, chroot, resultdir, mock_opts=None, build_cache=None,
+               cache_key=None, force_rebuild=False, chroot_init=None,
+               timeouts=None, compress_logs=False):
+    """
+    Rebuild an SRPM in a chroot, or fetch the results of the same build
+    from build_cache, and return the paths of the RPMs in resultdir that
+    came from it.
+    """
+    # Mock appends to logs, so only the RPMs may share the cache's copy
+    link = lambda name: name.endswith('.rpm')
+    if build_cache and not force_rebuild:
+        cached = build_cache.fetch_files(cache_key, resultdir, link=link)
+        if cached:
+            logging.info('Using cached build of %s for chroot %s in %s',
+                         os.path.basename(srpm), chroot, resultdir)
+            if chroot_init:
+                chroot_init.cancel()
+            return [os.path.join(resultdir, name) for name in cached
+                    if name.endswith('.rpm')]
+    # Mock copies RPMs over whatever is in resultdir, so never let it write
+    # into files that are linked to cache entries
+    for rpm in glob.glob(os.path.join(resultdir, '*.rpm')):
+        if os.stat(rpm).st_nlink > 1:
+            os.remove(rpm)
+    before = _listing(resultdir)
     logging.info('Building RPMs in %s using chroot %s', resultdir, chroot)
-    args = ['/usr/bin/mock', '-v', '-r', chroot, '--resultdir', resultdir]
+    args = [mocklib.MOCK, '-v', '-r', chroot, '--resultdir', resultdir]
     args.extend(mock_opts or [])
+    if chroot_init:
+        # Build in the root mock set up in the background
+        with tracelib.span('wait-chroot-init'):
+            chroot_init.wait()
+        args.append('--no-clean')
     args.extend(['--rebuild', srpm])
-    logging.debug("Executing ``%s''", ' '.join(args))
-    subprocess.check_call(args)
-    rpms = glob.glob(os.path.join(resultdir, '*.rpm'))
+    mocklib.run_mock(args, timeouts=timeouts, logdir=resultdir,
+                     compress_logs=compress_logs)
+    # resultdir may still hold RPMs from older builds, which must not be
+    # taken for this one's
+    after = _listing(resultdir)
+    produced = sorted(path for (path, stat) in after.iteritems()
+                      if before.get(path) != stat)
+    rpms = [path for path in produced if path.endswith('.rpm')]
     assert len(rpms) > 0
+    if build_cache:
+        results = [path for path in produced
+                   if path.endswith(('.rpm', '.log', '.log.gz'))]
+        build_cache.store_files(cache_key, results, link=link)
+    return rpms
+
+def _listing(resultdir):
+    # Enough of each file's stat to tell whether mock wrote it
+    listing = {}
+    if not os.path.isdir(resultdir):
+        return listing
+    for name in os.listdir(resultdir):
+        path = os.path.join(resultdir, name)
+        if os.path.isfile(path):
+            stat = os.stat(path)
+            listing[path] = (stat.st_ino, stat.st_size, stat.st_mtime)
+    return listing
+
+def build_cache_key(build_cache, digest, config_digest, mock_opts,
+                    extra=()):
+    """
+    Return the build cache key for an SRPM with the given srpm_digest built
+    with a mock config and options.  extra is anything else that affects
+    the result.
+    """
+    return build_cache.key_for('rpms', digest, config_digest,
+                               *(mocklib.output_opts(mock_opts) +
+                                 list(extra)))
+
+def srpm_digest(srpm):
+    """
+    Return a string that identifies an SRPM's contents:  the digests rpm
+    keeps of its header and payload, which don't change when it is
+    re-signed, or failing that a hash of the whole file.
+    """
+    args = ['rpm', '-qp', '--nosignature', '--qf', '%{SHA1HEADER} %{SIGMD5}',
+            srpm]
+    try:
+        rpm_query = subprocess.Popen(args, stdout=subprocess.PIPE,
+                                     stderr=subprocess.PIPE)
+        digest = rpm_query.communicate()[0].strip()
+        if rpm_query.returncode == 0 and digest and '(none)' not in digest:
+            return 'rpm ' + digest
+    except OSError:
+        # No rpm command
+        pass
+    sha256 = hashlib.sha256()
+    with open(srpm, 'rb') as srpm_file:
+        for chunk in iter(lambda: srpm_file.read(1024 * 1024), ''):
+            sha256.update(chunk)
+    return 'sha256 ' + sha256.hexdigest()
+
+def srpm_build_arches(srpm):
+    """
+    Return the architectures an SRPM's spec file limits its packages to
+    with BuildArch, which is just noarch when everything it builds is
+    noarch, or an empty list if it sets none or rpm cannot tell.
+    """
+    args = ['rpm', '-qp', '--nosignature', '--qf', '[%{BUILDARCHS}\n]',
+            srpm]
+    try:
+        rpm_query = subprocess.Popen(args, stdout=subprocess.PIPE,
+                                     stderr=subprocess.PIPE)
+        output = rpm_query.communicate()[0]
+    except OSError:
+        # No rpm command
+        return []
+    if rpm_query.returncode != 0:
+        return []
+    return [arch for arch in output.split() if arch != '(none)']
+
+def share_results(srpm, source, source_resultdir, resultdir):
+    """
+    Make resultdir hold the results of building an SRPMSource that are in
+    source_resultdir, as built by the target named source.  RPMs are linked
+    where the filesystem allows, logs are copied because mock appends to
+    them, and PROVENANCE_FILE records where they all came from.  Return
+    the paths of the files shared.
+    """
+    if not os.path.isdir(resultdir):
+        os.makedirs(resultdir)
+    names = []
+    for name in sorted(os.listdir(source_resultdir)):
+        src = os.path.join(source_resultdir, name)
+        if name == PROVENANCE_FILE or not os.path.isfile(src):
+            continue
+        dest = os.path.join(resultdir, name)
+        if name.endswith('.rpm'):
+            cachelib.link_or_copy(src, dest)
+        else:
+            if os.path.lexists(dest):
+                os.remove(dest)
+            shutil.copy2(src, dest)
+        names.append(name)
+    provenance = {'srpm': os.path.basename(srpm.path),
+                  'srpm_digest': srpm.digest(), 'built_in': source,
+                  'source_resultdir': source_resultdir, 'files': names,
+                  'shared_at': time.time()}
+    path = os.path.join(resultdir, PROVENANCE_FILE)
+    tmp_path = '{0}.tmp-{1}'.format(path, os.getpid())
+    with open(tmp_path, 'w') as provenance_file:
+        json.dump(provenance, provenance_file, indent=1, sort_keys=True)
+    os.rename(tmp_path, path)
+    logging.info('Shared %i noarch result(s) from %s in %s', len(names),
+                 source, resultdir)
+    return [os.path.join(resultdir, name) for name in names]
+
+class SRPMSource(object):
+    """
+    The SRPM to build:  either a local file or a URL, which is downloaded
+    to destdir in the background so that chroots can be set up meanwhile.
+    """
+    def __init__(self, location, destdir):
+        self._error = None
+        self._digest = None
+        self._lock = threading.Lock()
+        self._thread = None
+        url_path = urlparse.urlparse(location)[2]
+        if urlparse.urlparse(location)[0]:
+            self.path = os.path.join(destdir, os.path.basename(url_path))
+            self._thread = threading.Thread(
+                target=tracelib.carry(self._fetch), args=(location,),
+                name='fetch-srpm')
+            self._thread.daemon = True
+            self._thread.start()
+        else:
+            self.path = os.path.abspath(location)
+
+    def _fetch(self, url):
+        logging.info('Downloading %s', url)
+        downloader = fetchlib.Downloader()
+        try:
+            with tracelib.span('fetch-srpm', output=self.path):
+                downloader.fetch(url, self.path)
+        except Exception as err:
+            logging.error('Downloading %s failed', url,
+                          exc_info=sys.exc_info())
+            self._error = err
+        finally:
+            downloader.close()
+
+    def wait(self):
+        """
+        Return the path of the SRPM once it is there.
+        """
+        if self._thread:
+            self._thread.join()
+        if self._error:
+            raise self._error
+        return self.path
+
+    def digest(self):
+        with self._lock:
+            if self._digest is None:
+                with tracelib.span('srpm-digest'):
+                    self._digest = srpm_digest(self.wait())
+            return self._digest
+
+def build_arches(srpm, targets, resultdir, mock_opts=None, jobs=1,
+                 gate=None, build_cache=None, force_rebuild=False,
+                 publish_repo=None, overlap_init=False, timeouts=None,
+                 compress_logs=False, noarch_target=None):
+    """
+    Rebuild an SRPM, given as a path or a URL, in several chroots at once.
+    targets is a list of (name, chroot, config) tuples that each have
+    either a chroot or a mock config file or url.  With more than one
+    target each one's results go in a subdirectory of resultdir named
+    after it.
+
+    With a build cache, chroots that have already built the same SRPM with
+    the same config and mock options reuse those results.
+
+    With a publish repo, each target's RPMs are added to a local repository
+    that every build for that target installs packages from, so later
+    builds can use them.  Like results, each target gets its own repository
+    in a subdirectory when there is more than one.
+
+    With overlap_init, mock initializes each chroot in the background while
+    the SRPM is downloaded and the build cache checked.  timeouts and
+    compress_logs are as for mocklib.run_mock.
+
+    With noarch_target set to one of the targets' names, an SRPM that only
+    builds noarch packages is built by that target alone, and its results
+    are shared with the others' resultdirs (and repos) by share_results.
 
-def parse_cli_args():
-    usage = ('%prog [-d] [--mock-opts OPTS] [-r CHROOT | -c CONFIG] '
-             '-o RESULTDIR SRPM')
+    Return a dict that maps each target's name to whether it succeeded and
+    how many seconds it took.
+    """
+    results = {}
+    download_dir = tempfile.mkdtemp(prefix='rpmfab-srpm-')
+    srpm = SRPMSource(srpm, download_dir)
+    tasks = []
+    shares = []
+    for (name, chroot, config) in targets:
+        if len(targets) > 1:
+            target_resultdir = os.path.join(resultdir, name)
+        else:
+            target_resultdir = resultdir
+        repo = None
+        if publish_repo and len(targets) > 1:
+            repo = repolib.LocalRepo(os.path.join(publish_repo, name))
+        elif publish_repo:
+            repo = repolib.LocalRepo(publish_repo)
+        tasks.append((name, _build_target,
+                      (srpm, name, chroot, config, target_resultdir,
+                       mock_opts or [], results, build_cache,
+                       force_rebuild, repo, overlap_init, timeouts,
+                       compress_logs)))
+        if noarch_target and name != noarch_target:
+            shares.append((name, _share_target,
+                           (srpm, noarch_target,
+                            os.path.join(resultdir, noarch_target), name,
+                            target_resultdir, repo, results)))
+    try:
+        if shares and _builds_only_noarch(srpm):
+            logging.info('%s only builds noarch packages; building it in '
+                         '%s alone', os.path.basename(srpm.path),
+                         noarch_target)
+            poollib.run_tasks([task for task in tasks
+                               if task[0] == noarch_target],
+                              jobs=jobs, gate=gate)
+            poollib.run_tasks(shares, jobs=jobs)
+        else:
+            poollib.run_tasks(tasks, jobs=jobs, gate=gate)
+    finally:
+        shutil.rmtree(download_dir)
+    return results
+
+def _builds_only_noarch(srpm):
+    try:
+        srpm_path = srpm.wait()
+    except Exception:
+        # Every target's build will report it
+        return False
+    with tracelib.span('srpm-build-arches'):
+        arches = srpm_build_arches(srpm_path)
+    return bool(arches) and all(arch == 'noarch' for arch in arches)
+
+def _build_target(srpm, name, chroot, config, resultdir, mock_opts, results,
+                  build_cache, force_rebuild, repo, overlap_init, timeouts,
+                  compress_logs):
+    # Failures are recorded rather than raised so every target gets built
+    start = time.time()
+    mock = None
+    chroot_init = None
+    try:
+        extra_config = None
+        if repo:
+            # The repo always exists so the config, and therefore the
+            # chroot's caches, stay the same from the first build on
+            with tracelib.span('repo-ensure'):
+                repo.ensure()
+            extra_config = repo.config_snippet()
+        if config:
+            mock = mocklib.MockTemp(logging, mock_opts=list(mock_opts))
+            with tracelib.span('mock-config'):
+                mock.apply_config(config, extra_config=extra_config)
+        elif extra_config:
+            mock = mocklib.MockTemp(logging, mock_opts=list(mock_opts))
+            with tracelib.span('mock-config'):
+                mock.apply_chroot(chroot, extra_config=extra_config)
+        if mock:
+            config_digest = mocklib.config_digest(mock.chroot,
+                                                  mock.config_tempdir)
+            (chroot, target_opts) = (mock.chroot, mock.mock_opts)
+        else:
+            config_digest = mocklib.config_digest(chroot)
+            target_opts = mock_opts
+        if overlap_init:
+            chroot_init = mocklib.BackgroundInit(chroot, target_opts,
+                                                 timeouts=timeouts)
+        srpm_path = srpm.wait()
+        cache_key = None
+        if build_cache:
+            # What the build installs from the repo matters too
+            extra = [repo.digest() or ''] if repo else []
+            cache_key = build_cache_key(build_cache, srpm.digest(),
+                                        config_digest, mock_opts,
+                                        extra=extra)
+        with tracelib.span('build', output=resultdir, chroot=chroot):
+            rpms = build_arch(srpm_path, chroot, resultdir,
+                              mock_opts=target_opts, build_cache=build_cache,
+                              cache_key=cache_key,
+                              force_rebuild=force_rebuild,
+                              chroot_init=chroot_init, timeouts=timeouts,
+                              compress_logs=compress_logs)
+        if repo:
+            _publish(repo, rpms)
+        results[name] = (True, time.time() - start)
+    except Exception:
+        logging.error('Build in %s failed', name, exc_info=sys.exc_info())
+        results[name] = (False, time.time() - start)
+    finally:
+        if chroot_init:
+            # Does nothing unless the build failed before waiting for it
+            chroot_init.cancel()
+        if mock:
+            mock.cleanup()
+
+def _share_target(srpm, source, source_resultdir, name, resultdir, repo,
+                  results):
+    start = time.time()
+    try:
+        if not results[source][0]:
+            raise RuntimeError('noarch build in {0} failed'.format(source))
+        with tracelib.span('share-noarch', output=resultdir, source=source):
+            shared = share_results(srpm, source, source_resultdir,
+                                   resultdir)
+        if repo:
+            _publish(repo, [path for path in shared
+                            if path.endswith('.rpm')])
+        results[name] = (True, time.time() - start)
+    except Exception:
+        logging.error('Sharing noarch build with %s failed', name,
+                      exc_info=sys.exc_info())
+        results[name] = (False, time.time() - start)
+
+def _publish(repo, rpms):
+    with tracelib.span('publish'):
+        repo.publish([rpm for rpm in rpms if not rpm.endswith('.src.rpm')])
+
+def config_name(config):
+    return os.path.basename(urlparse.urlparse(config)[2]).rsplit('.cfg', 1)[0]
+
+def parse_cli_args(argv=None):
+    usage = ('%prog [-d] [-j N] [--mock-opts OPTS] [-r CHROOT ...] '
+             '[-c CONFIG ...] -o RESULTDIR SRPM|URL')
     parser = optparse.OptionParser(usage=usage,
                                    version='%prog %s'.format(__version__))
     parser.add_option('-d', '--debug', dest='loglevel', action='store_const',
                       const=logging.DEBUG, default=logging.INFO)
-    parser.add_option('-r', '--chroot', default=None,
-                      help='mock chroot to use')
-    parser.add_option('-c', '--config', default=None,
-                      help='mock config file or url')
+    parser.add_option('-r', '--chroot', dest='chroots', action='append',
+                      default=[], help=('mock chroot to use (may be given '
+                                        'more than once)'))
+    parser.add_option('-c', '--config', dest='configs', action='append',
+                      default=[], help=('mock config file or url (may be '
+                                        'given more than once)'))
     parser.add_option('-o', '--resultdir', default=None,
                       help='directory to place results into')
     parser.add_option('--mock-options', metavar='OPTS', default='',
                       help='options to pass to mock')
-    (options, args) = parser.parse_args()
+    parser.add_option('-j', '--jobs', metavar='N', type='int',
+                      default=multiprocessing.cpu_count(),
+                      help=('build in up to N chroots at once (default: one '
+                            'per CPU)'))
+    parser.add_option('--mem-per-build', metavar='MB', type='int',
+                      default=2048, help=('only start another build while '
+                                          'this much memory is available '
+                                          '(default: 2048)'))
+    parser.add_option('--disk-per-build', metavar='MB', type='int',
+                      default=4096, help=('only start another build while '
+                                          'this much disk space is free for '
+                                          'mock (default: 4096)'))
+    parser.add_option('--build-cache', metavar='DIR', default=None,
+                      help=('reuse the results of building the same SRPM '
+                            'with the same mock config, keeping them in DIR'))
+    parser.add_option('--build-cache-size', metavar='MB', type='int',
+                      default=None, help=('evict least recently used '
+                                          'builds beyond this size'))
+    parser.add_option('--publish-repo', metavar='DIR', default=None,
+                      help=('add the RPMs to a repository in DIR that '
+                            'builds using it install packages from'))
+    parser.add_option('--force-rebuild', action='store_true', default=False,
+                      help=('build even if the build cache has results, '
+                            'replacing them'))
+    parser.add_option('--overlap-init', action='store_true', default=False,
+                      help=('initialize each mock chroot in the background '
+                            'while the SRPM is fetched and the build cache '
+                            'checked'))
+    parser.add_option('--timeout', metavar='PHASE=SECS', dest='timeouts',
+                      action='append', default=[],
+                      help=('kill mock if a phase whose name starts with '
+                            'PHASE, as in its "Start: PHASE" lines, takes '
+                            'longer than SECS; "total" limits the whole '
+                            'run (may be given more than once)'))
+    parser.add_option('--compress-logs', action='store_true', default=False,
+                      help=('gzip mock\'s logs while it writes them, '
+                            'leaving NAME.log.gz'))
+    parser.add_option('--noarch-chroot', metavar='NAME', default=None,
+                      help=('if the SRPM only builds noarch packages, build '
+                            'it in chroot or config NAME alone and share '
+                            'its results with the others'))
+    parser.add_option('--trace', metavar='FILE', default=None,
+                      help=('write how long each phase of the builds and '
+                            'each command took, and the resources they '
+                            'used, to FILE as a Chrome trace'))
+    (options, args) = parser.parse_args(argv)
     if len(args) != 1:
         parser.error('exactly 1 positional argument is required')
-    if not options.chroot and not options.config:
-        parser.error('must specify either the chroot or config option')
-    if options.chroot and options.config:
-        parser.error('cannot specify both chroot and config options')
+    if not options.chroots and not options.configs:
+        parser.error('must specify at least one chroot or config option')
+    names = options.chroots + map(config_name, options.configs)
+    if len(set(names)) != len(names):
+        parser.error('each chroot and config must have a different name')
+    if options.noarch_chroot and options.noarch_chroot not in names:
+        parser.error('--noarch-chroot must name one of the chroots or '
+                     'configs')
     if not options.resultdir:
         parser.error('result directory must be specified with -o')
+    try:
+        options.timeouts = mocklib.parse_timeouts(options.timeouts)
+    except ValueError as err:
+        parser.error(str(err))
     return (options, args)
 
 def main():
     (options, args) = parse_cli_args()
-    srpm      = os.path.abspath(args[0])
-    resultdir = os.path.abspath(options.resultdir)
-    mock_opts = options.mock_options.split()
+    if len(options.chroots) + len(options.configs) > 1 and options.jobs > 1:
+        # Concurrent builds' threads are named after their chroots
+        log_format = ('%(asctime)-15s [%(levelname)s] %(threadName)s: '
+                      '%(message)s')
+    else:
+        log_format = '%(asctime)-15s [%(levelname)s] %(message)s'
     logging.basicConfig(stream=sys.stdout, level=options.loglevel,
-                        format='%(asctime)-15s [%(levelname)s] %(message)s')
+                        format=log_format)
+    sys.exit(run(options, args))
 
-    if options.config:
-        try:
-            mock = mocklib.MockTemp(logging, mock_opts=mock_opts)
-            mock.apply_config(options.config)
-            build_arch(srpm, mock.chroot, resultdir, mock_opts=mock.mock_opts)
-        finally:
-            mock.cleanup()
-    else:
-        build_arch(srpm, options.chroot, resultdir, mock_opts=mock_opts)
+def run(options, args, gate=None):
+    """
+    Do the builds that parsed command line options ask for and return the
+    exit status.  Callers running other builds at the same time should
+    pass in the ResourceGate they all share.
+    """
+    with tracelib.tracing(options.trace, {'script': 'build-arch',
+                                          'srpm': args[0]}):
+        return _run(options, args, gate)
+
+def _run(options, args, gate):
+    srpm      = args[0]
+    resultdir = os.path.abspath(options.resultdir)
+    mock_opts = options.mock_options.split()
+    targets = ([(chroot, chroot, None) for chroot in options.chroots] +
+               [(config_name(config), None, config)
+                for config in options.configs])
+    if not gate:
+        if os.path.isdir(MOCK_BASEDIR):
+            disk_path = MOCK_BASEDIR
+        else:
+            disk_path = '/'
+        gate = poollib.ResourceGate(
+            mem_per_task=options.mem_per_build * 1024 * 1024,
+            disk_per_task=options.disk_per_build * 1024 * 1024,
+            disk_path=disk_path)
+    build_cache = None
+    if options.build_cache:
+        max_size = None
+        if options.build_cache_size:
+            max_size = options.build_cache_size * 1024 * 1024
+        build_cache = cachelib.CacheDir(options.build_cache,
+                                        max_size=max_size)
+    results = build_arches(srpm, targets, resultdir, mock_opts=mock_opts,
+                           jobs=options.jobs, gate=gate,
+                           build_cache=build_cache,
+                           force_rebuild=options.force_rebuild,
+                           publish_repo=options.publish_repo,
+                           overlap_init=options.overlap_init,
+                           timeouts=options.timeouts,
+                           compress_logs=options.compress_logs,
+                           noarch_target=options.noarch_chroot)
 
+    logging.info('Build summary:')
+    for (name, __, __) in targets:
+        (succeeded, duration) = results[name]
+        logging.info('  %-40s %-9s %5.0fs', name,
+                     'succeeded' if succeeded else 'FAILED', duration)
+    failed = [name for (name, (succeeded, __)) in results.iteritems()
+              if not succeeded]
+    if failed:
+        logging.error('%i of %i build(s) failed', len(failed), len(targets))
+        return 1
     logging.info('Build complete; results in %s', resultdir)
+    return 0
 
 if __name__ == '__main__':
     main()
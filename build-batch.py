@@ -0,0 +1,409 @@
+#!/usr/bin/python -tt
+
+"""
+Build a batch of packages described by a JSON manifest such as
+
+    {"chroots": ["fedora-23-x86_64"],
+     "packages": [
+        {"name": "foo",
+         "repo": "git://example.com/foo-packaging.git#master",
+         "sources": {"0": "git://example.com/foo.git"},
+         "macros": {"commit": "@REV0@"}},
+        {"name": "bar",
+         "repo": "git://example.com/bar-packaging.git",
+         "fetch": ["http://example.com/bar-extras.tar.gz"],
+         "configs": ["http://example.com/bar-f23.cfg"]}]}
+
+where each package's chroots and configs, if any, replace the top-level
+ones and "mock_options" may be given at either level.
+
+Packages whose spec files BuildRequire something another package's spec
+file Provides are built after it in each chroot they share, with the
+repository of everything built so far in that chroot added to mock.
+Everything else happens as soon as it can, up to -j things at once:
+source RPMs build while other packages' binary builds run, and each binary
+build starts as soon as the builds it depends on are published.
+"""
+
+import glob
+import imp
+import json
+import logging
+import optparse
+import os
+import os.path
+import shutil
+import sys
+
+import cachelib
+import fetchlib
+import mocklib
+import poollib
+import repolib
+
+__version__ = '0.2'
+
+_TOPDIR = os.path.dirname(os.path.abspath(__file__))
+buildsrpm = imp.load_source('build_srpm_from_scm',
+                            os.path.join(_TOPDIR, 'build-srpm-from-scm.py'))
+buildarch = imp.load_source('build_arch',
+                            os.path.join(_TOPDIR, 'build-arch.py'))
+
+
+class Package(object):
+    def __init__(self, name, repo, sources=None, macros=None, fetch=None,
+                 targets=None, mock_opts=None):
+        self.name = name
+        self.repo = repo
+        self.sources = sources or []
+        self.macros = macros or {}
+        self.fetch = fetch or []
+        # (name, chroot, config) tuples, as for build-arch.py
+        self.targets = targets or []
+        self.mock_opts = mock_opts or []
+        self.builder = None
+        self.srpm = None
+        self.srpm_digest = None
+        self.deps = set()
+
+    def target_names(self):
+        return [name for (name, __, __) in self.targets]
+
+
+class BatchBuilder(object):
+    def __init__(self, packages, workspace, resultdir, jobs=1, gate=None,
+                 mirrors=None, tarball_only=False, tarball_cache=None,
+                 downloader=None, srpm_cache=None, build_cache=None):
+        self.packages = packages
+        self.workspace = workspace
+        self.resultdir = resultdir
+        self.jobs = jobs
+        self.gate = gate
+        self.mirrors = mirrors
+        self.tarball_only = tarball_only
+        self.tarball_cache = tarball_cache
+        self.downloader = downloader or fetchlib.Downloader()
+        self.srpm_cache = srpm_cache
+        self.build_cache = build_cache
+        self.slots = mocklib.ChrootSlots()
+        self.failures = []
+
+    def run(self):
+        """
+        Build every package, returning the (name, exception) pairs of
+        everything that failed.
+        """
+        tasks = [('Prepare ' + package.name, self.prepare, (package,))
+                 for package in self.packages]
+        try:
+            poollib.run_tasks(tasks, jobs=self.jobs)
+        except poollib.TaskFailures as err:
+            self.failures.extend(err.failures)
+        prepared = [package for package in self.packages if package.builder]
+        self.resolve_deps(prepared)
+        try:
+            (tasks, deps) = self.build_graph(prepared)
+        except ValueError as err:
+            # Nothing can be built before what it depends on
+            self.failures.append(('Ordering builds', err))
+            return self.failures
+        try:
+            poollib.run_dag(tasks, deps, jobs=self.jobs, gate=self.gate)
+        except poollib.TaskFailures as err:
+            self.failures.extend(err.failures)
+        return self.failures
+
+    def prepare(self, package):
+        """
+        Check out a package's repos and add its macros to its spec file,
+        which reveals what it requires and provides.
+        """
+        pkgdir = os.path.join(self.workspace, package.name)
+        builddir = os.path.join(pkgdir, 'builddir')
+        if not os.path.exists(builddir):
+            os.makedirs(builddir)
+        builder = buildsrpm.SRPMBuilder(
+            None, package.repo, fetch=package.fetch, sources=package.sources,
+            mirrors=self.mirrors, tarball_only=self.tarball_only,
+            tarball_cache=self.tarball_cache, downloader=self.downloader,
+            srpm_cache=self.srpm_cache)
+        builder.checkout_packaging_repo(builddir)
+        builder.checkout_sources(pkgdir)
+        builder.add_macros_to_specfile(package.macros)
+        package.builder = builder
+
+    def resolve_deps(self, packages):
+        providers = {}
+        for package in packages:
+            for capability in package.builder.spec.provides:
+                providers.setdefault(capability, set()).add(package)
+        for package in packages:
+            for requirement in package.builder.spec.build_requires:
+                for provider in providers.get(requirement, ()):
+                    if provider is not package:
+                        package.deps.add(provider)
+            if package.deps:
+                logging.info('%s builds after %s', package.name,
+                             ', '.join(sorted(dep.name
+                                              for dep in package.deps)))
+
+    def build_graph(self, packages):
+        """
+        Return run_dag tasks and dependencies that build the source RPM of
+        each package and then build that in each of its chroots, with
+        packages listed so their dependencies come first.  Raise ValueError
+        if packages depend on each other.
+        """
+        ordered = []
+
+        def visit(package, visiting):
+            if package in ordered:
+                return
+            if package in visiting:
+                cycle = visiting[visiting.index(package):] + [package]
+                raise ValueError('packages depend on each other: ' +
+                                 ' -> '.join(pkg.name for pkg in cycle))
+            for dep in sorted(package.deps, key=lambda pkg: pkg.name):
+                visit(dep, visiting + [package])
+            ordered.append(package)
+        for package in packages:
+            visit(package, [])
+
+        tasks = []
+        deps = {}
+        for package in ordered:
+            srpm_task = 'SRPM ' + package.name
+            tasks.append((srpm_task, self.build_srpm, (package,)))
+            for target in package.targets:
+                task = 'Build {0} {1}'.format(package.name, target[0])
+                tasks.append((task, self.build_arch, (package, target)))
+                deps[task] = [srpm_task]
+                deps[task].extend('Build {0} {1}'.format(dep.name, target[0])
+                                  for dep in package.deps
+                                  if target[0] in dep.target_names())
+        return (tasks, deps)
+
+    def build_srpm(self, package):
+        builder = package.builder
+        poollib.run_tasks(builder.tarball_tasks() + builder.fetch_tasks() +
+                          builder.spec_fetch_tasks())
+        resultdir = os.path.join(self.resultdir, package.name, 'srpm')
+        _empty_dir(resultdir)
+
+        def build(chroot, mock_opts, configdir):
+            builder.chroot = chroot
+            builder.mock_opts = mock_opts
+            builder.mock_configdir = configdir
+            builder.build_srpm(resultdir)
+        self._in_chroot(package.targets[0], package.mock_opts, build)
+        package.srpm = glob.glob(os.path.join(resultdir, '*.src.rpm'))[0]
+        if self.build_cache:
+            package.srpm_digest = buildarch.srpm_digest(package.srpm)
+
+    def build_arch(self, package, target):
+        resultdir = os.path.join(self.resultdir, package.name, target[0])
+        _empty_dir(resultdir)
+        repo = self.repo_path(target[0])
+
+        def build(chroot, mock_opts, configdir):
+            if os.path.isdir(os.path.join(repo, 'repodata')):
+                mock_opts = mock_opts + ['--addrepo', 'file://' + repo]
+            cache_key = None
+            if self.build_cache:
+                # What the build installs from the repo matters too
+                extra = sorted(dep.srpm_digest
+                               for dep in _all_deps(package, target[0]))
+                cache_key = buildarch.build_cache_key(
+                    self.build_cache, package.srpm_digest,
+                    mocklib.config_digest(chroot, configdir),
+                    package.mock_opts, extra=extra)
+            buildarch.build_arch(package.srpm, chroot, resultdir,
+                                 mock_opts=mock_opts,
+                                 build_cache=self.build_cache,
+                                 cache_key=cache_key)
+        self._in_chroot(target, package.mock_opts, build)
+        rpms = [rpm for rpm in glob.glob(os.path.join(resultdir, '*.rpm'))
+                if not rpm.endswith('.src.rpm')]
+        self.publish(target[0], rpms)
+
+    def repo_path(self, target_name):
+        return os.path.join(self.resultdir, 'repos', target_name)
+
+    def publish(self, target_name, rpms):
+        """
+        Add RPMs to the repository of everything built for a target so
+        far, which later builds for that target use.
+        """
+        repolib.LocalRepo(self.repo_path(target_name)).publish(rpms)
+
+    def _in_chroot(self, target, mock_opts, func):
+        """
+        Call func with the chroot name, mock options, and mock config dir
+        to use for a (name, chroot, config) target, making sure no other
+        build in this batch uses the same build root at the same time.
+        """
+        (__, chroot, config) = target
+        if config:
+            # MockTemp picks unique build roots itself
+            mock = mocklib.MockTemp(logging, mock_opts=list(mock_opts))
+            try:
+                mock.apply_config(config)
+                func(mock.chroot, mock.mock_opts, mock.config_tempdir)
+            finally:
+                mock.cleanup()
+            return
+        slot = self.slots.acquire([chroot])
+        try:
+            func(chroot, mock_opts + self.slots.mock_opts(slot, 'batch'),
+                 None)
+        finally:
+            self.slots.release([chroot], slot)
+
+
+def _all_deps(package, target_name, seen=None):
+    # Every package a package's build in a target may install from the
+    # target's repo
+    seen = seen if seen is not None else set()
+    for dep in package.deps:
+        if dep not in seen and target_name in dep.target_names():
+            seen.add(dep)
+            _all_deps(dep, target_name, seen)
+    return seen
+
+
+def _empty_dir(path):
+    # Results of an earlier batch would be taken for this one's, and
+    # published
+    if os.path.isdir(path):
+        shutil.rmtree(path)
+    os.makedirs(path)
+
+
+def read_manifest(manifest_file):
+    with open(manifest_file) as manifest_fileobj:
+        manifest = json.load(manifest_fileobj)
+    packages = []
+    for pkg in manifest['packages']:
+        chroots = pkg.get('chroots', manifest.get('chroots', []))
+        configs = pkg.get('configs', manifest.get('configs', []))
+        targets = ([(str(chroot), str(chroot), None) for chroot in chroots] +
+                   [(buildarch.config_name(config), None, str(config))
+                    for config in configs])
+        if not targets:
+            raise ValueError('package {0} has no chroots or configs'
+                             .format(pkg['name']))
+        mock_opts = pkg.get('mock_options', manifest.get('mock_options', ''))
+        sources = [(int(i), str(url))
+                   for (i, url) in sorted(pkg.get('sources', {}).items())]
+        macros = dict((str(key), str(val))
+                      for (key, val) in pkg.get('macros', {}).items())
+        packages.append(Package(str(pkg['name']), str(pkg['repo']),
+                                sources=sources, macros=macros,
+                                fetch=map(str, pkg.get('fetch', [])),
+                                targets=targets,
+                                mock_opts=str(mock_opts).split()))
+    names = [package.name for package in packages]
+    if len(set(names)) != len(names):
+        raise ValueError('package names must be unique')
+    return packages
+
+
+def parse_cli_args():
+    usage = '%prog [-d] [-j N] -w WORKSPACE -o RESULTDIR MANIFEST'
+    parser = optparse.OptionParser(usage=usage,
+                                   version='%prog {0}'.format(__version__))
+    parser.add_option('-d', '--debug', dest='loglevel', action='store_const',
+                      const=logging.DEBUG, default=logging.INFO)
+    parser.add_option('-w', '--workspace', default=None,
+                      help='directory to use as a workspace')
+    parser.add_option('-o', '--resultdir', default=None,
+                      help='directory to place results into')
+    parser.add_option('-j', '--jobs', metavar='N', type='int', default=1,
+                      help=('check out and build up to N things at once '
+                            '(default: 1)'))
+    parser.add_option('--mem-per-build', metavar='MB', type='int',
+                      default=2048, help=('only start another build while '
+                                          'this much memory is available '
+                                          '(default: 2048)'))
+    parser.add_option('--disk-per-build', metavar='MB', type='int',
+                      default=4096, help=('only start another build while '
+                                          'this much disk space is free for '
+                                          'mock (default: 4096)'))
+    parser.add_option('--tarball-only', action='store_true', default=False,
+                      help=('build source tarballs straight from bare '
+                            'repos without checking out working trees'))
+    parser.add_option('--mirror-cache', metavar='DIR', default=None,
+                      help=('check out git and bzr repos from persistent '
+                            'mirrors kept in DIR'))
+    parser.add_option('--tarball-cache', metavar='DIR', default=None,
+                      help=('reuse tarballs built from the same source '
+                            'revisions, keeping them in DIR'))
+    parser.add_option('--download-cache', metavar='DIR', default=None,
+                      help=('keep downloaded sources in DIR and only '
+                            'download them again when they change'))
+    parser.add_option('--srpm-cache', metavar='DIR', default=None,
+                      help=('reuse source RPMs built from the same spec '
+                            'file and sources, keeping them in DIR'))
+    parser.add_option('--build-cache', metavar='DIR', default=None,
+                      help=('reuse the results of building the same SRPM '
+                            'with the same mock config, keeping them in DIR'))
+    (options, args) = parser.parse_args()
+    if len(args) != 1:
+        parser.error('exactly 1 positional argument is required')
+    if not options.workspace:
+        parser.error('working directory must be specified with -w')
+    if not options.resultdir:
+        parser.error('result directory must be specified with -o')
+    return (options, args)
+
+
+def main():
+    (options, args) = parse_cli_args()
+    workspace = os.path.abspath(options.workspace)
+    resultdir = os.path.abspath(options.resultdir)
+    logging.basicConfig(stream=sys.stdout, level=options.loglevel,
+                        format=('%(asctime)-15s [%(levelname)s] '
+                                '%(threadName)s: %(message)s'))
+    packages = read_manifest(args[0])
+
+    mirrors = None
+    if options.mirror_cache:
+        mirrors = buildsrpm.Mirrors(
+            cachelib.CacheDir(options.mirror_cache))
+    caches = {}
+    for name in ('tarball', 'download', 'srpm', 'build'):
+        cache_dir = getattr(options, name + '_cache')
+        caches[name] = cache_dir and cachelib.CacheDir(cache_dir)
+    downloader = fetchlib.Downloader(cache=caches['download'])
+    if os.path.isdir(buildarch.MOCK_BASEDIR):
+        disk_path = buildarch.MOCK_BASEDIR
+    else:
+        disk_path = '/'
+    gate = poollib.ResourceGate(
+        mem_per_task=options.mem_per_build * 1024 * 1024,
+        disk_per_task=options.disk_per_build * 1024 * 1024,
+        disk_path=disk_path)
+    try:
+        batch = BatchBuilder(packages, workspace, resultdir,
+                             jobs=options.jobs, gate=gate, mirrors=mirrors,
+                             tarball_only=options.tarball_only,
+                             tarball_cache=caches['tarball'],
+                             downloader=downloader,
+                             srpm_cache=caches['srpm'],
+                             build_cache=caches['build'])
+        failures = batch.run()
+    finally:
+        downloader.close()
+        if mirrors:
+            mirrors.release()
+
+    if failures:
+        for (name, err) in failures:
+            logging.error('%s failed: %s', name, err)
+        logging.error('%i task(s) failed', len(failures))
+        sys.exit(1)
+    logging.info('Batch complete; results in %s', resultdir)
+
+
+if __name__ == '__main__':
+    main()
@@ -2,33 +2,32 @@
 
 import datetime
 import glob
+import hashlib
+import json
 import logging
 import optparse
 import os
 import os.path
 import re
-import rpm
 import shutil
 import subprocess
 import sys
-import tempfile
+import threading
 import urlparse
-import urllib
 
+import cachelib
+import fetchlib
 import mocklib
+import poollib
+import ramlib
+import speclib
+import tarlib
+import tracelib
 
 __version__ = '0.2'
-_DIR_STACK = []
-_ORIG_EXECUTABLE = os.path.abspath(sys.argv[0])
 
-
-def pushd(destdir):
-    _DIR_STACK.append(os.getcwd())
-    os.chdir(destdir)
-
-
-def popd():
-    os.chdir(_DIR_STACK.pop())
+# Exit status when --state-file shows nothing changed since the last build
+EXIT_UNCHANGED = 3
 
 
 def _split_repo_url(url):
@@ -40,10 +39,119 @@ def _split_repo_url(url):
     return (basic_url, commit or None)
 
 
+class Mirrors(object):
+    """
+    A store of local mirrors of repositories, keyed by URL, that builds
+    check out from instead of the network:  bare mirrors of git repos and
+    shared repositories holding bzr branches.  Each use fetches only new
+    revisions into the mirror.
+    """
+    def __init__(self, cache):
+        self.cache = cache
+        self._in_use = {}
+        self._in_use_lock = threading.Lock()
+
+    def _use(self, key):
+        # Keep the entry locked against eviction until release is called
+        with self._in_use_lock:
+            if key not in self._in_use:
+                in_use = self.cache.lock(key, shared=True)
+                in_use.acquire()
+                self._in_use[key] = in_use
+
+    def update(self, url):
+        """
+        Bring the mirror of git repo url up to date, creating it if
+        necessary, and return its path.  The mirror stays locked against
+        eviction until release is called.
+        """
+        key = self.cache.key_for(url)
+        mirror = self.cache.entry_path(key)
+        self._use(key)
+        with self.cache.lock(key, suffix='.fetch'):
+            if os.path.isdir(mirror):
+                logging.info('Updating git mirror of %s', url)
+                args = ['git', '--git-dir', mirror, 'fetch', '-q', '--prune']
+                logging.debug("Executing ``%s''", ' '.join(args))
+                subprocess.check_call(args)
+            else:
+                logging.info('Creating git mirror of %s', url)
+                tmp_mirror = '{0}.tmp-{1}'.format(mirror, os.getpid())
+                if os.path.exists(tmp_mirror):
+                    shutil.rmtree(tmp_mirror)
+                args = ['git', 'clone', '-q', '--mirror', url, tmp_mirror]
+                logging.debug("Executing ``%s''", ' '.join(args))
+                subprocess.check_call(args)
+                # Clones borrow objects from mirrors through alternates, so
+                # never let git throw any of them away.
+                args = ['git', '--git-dir', tmp_mirror, 'config', 'gc.auto',
+                        '0']
+                subprocess.check_call(args)
+                os.rename(tmp_mirror, mirror)
+        self.cache.touch(key)
+        return mirror
+
+    def update_bzr(self, url):
+        """
+        Bring the mirror of bzr branch url up to date, creating it if
+        necessary, and return the path of the branch.  The mirror is a
+        shared repository without working trees that holds just that
+        branch, and stays locked against eviction until release is called.
+        """
+        key = self.cache.key_for('bzr', url)
+        mirror = self.cache.entry_path(key)
+        self._use(key)
+        with self.cache.lock(key, suffix='.fetch'):
+            if os.path.isdir(mirror):
+                logging.info('Updating bzr mirror of %s', url)
+                args = ['bzr', 'pull', '-q', '--overwrite', '-d',
+                        os.path.join(mirror, 'branch'), url]
+                logging.debug("Executing ``%s''", ' '.join(args))
+                subprocess.check_call(args)
+            else:
+                logging.info('Creating bzr mirror of %s', url)
+                tmp_mirror = '{0}.tmp-{1}'.format(mirror, os.getpid())
+                if os.path.exists(tmp_mirror):
+                    shutil.rmtree(tmp_mirror)
+                args = ['bzr', 'init-repo', '-q', '--no-trees', tmp_mirror]
+                logging.debug("Executing ``%s''", ' '.join(args))
+                subprocess.check_call(args)
+                args = ['bzr', 'branch', '-q', '--no-tree', url,
+                        os.path.join(tmp_mirror, 'branch')]
+                logging.debug("Executing ``%s''", ' '.join(args))
+                subprocess.check_call(args)
+                os.rename(tmp_mirror, mirror)
+        self.cache.touch(key)
+        return os.path.join(mirror, 'branch')
+
+    def size(self, url, vcs='git'):
+        """
+        Return how many bytes the mirror of a git (or bzr) repo takes up,
+        or None if there is no mirror of it yet.
+        """
+        if vcs == 'bzr':
+            key = self.cache.key_for('bzr', url)
+        else:
+            key = self.cache.key_for(url)
+        mirror = self.cache.entry_path(key)
+        if not os.path.isdir(mirror):
+            return None
+        return ramlib.disk_usage(mirror)
+
+    def release(self):
+        for in_use in self._in_use.itervalues():
+            in_use.release()
+        self._in_use = {}
+        self.cache.evict()
+
+
 class Repo(object):
-    def __init__(self, url, ref):
+    def __init__(self, url, ref, mirrors=None, tarball_only=False):
         self.url = url
         self._ref = ref
+        self.mirrors = mirrors
+        # Only build tarballs from this repo; never write a working tree
+        self.tarball_only = tarball_only
         self.rev = None
         if os.path.exists(url):
             self.tree = url  # local filesystem
@@ -56,17 +164,59 @@ class Repo(object):
     def record_rev(self):
         raise NotImplementedError()
 
-    def create_tarball(self, tarball_name, destdir):
+    def resolve_rev(self):
+        """
+        Return the revision that a build would use without checking
+        anything out.
+        """
         raise NotImplementedError()
 
+    def create_tarball(self, tarball_name, destdir, workers=None, level=None):
+        raise NotImplementedError()
+
+    def size_hint(self):
+        """
+        Return roughly how many bytes a checkout will take up, or None if
+        there is no telling.
+        """
+        return None
+
     def friendly_rev(self):
         return self.rev
 
+    def cache_key(self):
+        """
+        Return a list of strings that together identify the contents of
+        this repo at the recorded revision.
+        """
+        if not self.rev:
+            raise RuntimeError('record_rev must precede cache_key')
+        return [self.url, self.rev]
+
 
 class GitRepo(Repo):
+    def __init__(self, url, ref, mirrors=None, tarball_only=False):
+        Repo.__init__(self, url, ref, mirrors=mirrors,
+                      tarball_only=tarball_only)
+        self.bare = False
+
+    def size_hint(self):
+        # The mirror's packed history is about the size of a checkout
+        if self.mirrors:
+            return self.mirrors.size(self.url)
+        return None
+
     def checkout(self, destdir):
         if self.tree:
             return
+        if self.tarball_only:
+            name = os.path.basename(self.url)
+            if not name.endswith('.git'):
+                name += '.git'
+            self.tree = self._get_bare_repo(self.url,
+                                            os.path.join(destdir, name))
+            self.bare = True
+            return
         # destdir is a pre-existing directory in which a source checkout goes
         # e.g. mydir -> repo goes in mydir/myrepo
         self.tree = os.path.join(destdir, os.path.basename(self.url))
@@ -75,6 +225,9 @@ class GitRepo(Repo):
         if os.path.exists(self.tree):
             logging.info('Cleaning dir %s', self.tree)
             shutil.rmtree(self.tree)
+        if self.mirrors:
+            self._checkout_from_mirror()
+            return
         logging.info('Cloning git repo %s to %s', self.url, self.tree)
         args = ['git', 'clone', '-q', '--recursive', self.url, self.tree]
         logging.debug("Executing ``%s''", ' '.join(args))
@@ -82,47 +235,287 @@ class GitRepo(Repo):
 
         if self._ref:
             logging.info('Checking out ref %s', self._ref)
-            pushd(self.tree)
             args = ['git', 'checkout', '-q', self._ref]
             logging.debug("Executing ``%s''", ' '.join(args))
-            subprocess.check_call(args)
-            popd()
+            subprocess.check_call(args, cwd=self.tree)
+
+    def _get_bare_repo(self, url, path):
+        """
+        Return a bare repo containing url's objects:  its mirror if we have
+        mirrors, or else a partial clone at path that fetches blobs only
+        when they are actually archived.
+        """
+        if self.mirrors:
+            return self.mirrors.update(url)
+        if os.path.exists(path):
+            logging.info('Cleaning dir %s', path)
+            shutil.rmtree(path)
+        logging.info('Cloning bare git repo %s to %s', url, path)
+        args = ['git', 'clone', '-q', '--bare', '--filter=blob:none', url,
+                path]
+        logging.debug("Executing ``%s''", ' '.join(args))
+        subprocess.check_call(args)
+        return path
+
+    def _checkout_from_mirror(self):
+        mirror = self.mirrors.update(self.url)
+        logging.info('Cloning git repo %s to %s from mirror %s', self.url,
+                     self.tree, mirror)
+        args = ['git', 'clone', '-q', '--shared', mirror, self.tree]
+        logging.debug("Executing ``%s''", ' '.join(args))
+        subprocess.check_call(args)
+        # Point origin back at the real repo so relative submodule URLs
+        # resolve against it.
+        subprocess.check_call(['git', 'remote', 'set-url', 'origin',
+                               self.url], cwd=self.tree)
+        if self._ref:
+            logging.info('Checking out ref %s', self._ref)
+            args = ['git', 'checkout', '-q', self._ref]
+            logging.debug("Executing ``%s''", ' '.join(args))
+            subprocess.check_call(args, cwd=self.tree)
+        self._update_submodules_from_mirrors(self.tree)
+
+    def _update_submodules_from_mirrors(self, tree):
+        if not os.path.exists(os.path.join(tree, '.gitmodules')):
+            return
+        subprocess.check_call(['git', 'submodule', '-q', 'init'], cwd=tree)
+        args = ['git', 'config', '--get-regexp', r'^submodule\..*\.url$']
+        git_config = subprocess.Popen(args, cwd=tree, stdout=subprocess.PIPE)
+        submodules = git_config.communicate()[0].splitlines()
+        assert git_config.returncode == 0
+        subtrees = []
+        for line in submodules:
+            (key, url) = line.split(None, 1)
+            name = key[len('submodule.'):-len('.url')]
+            args = ['git', 'config', '-f', '.gitmodules',
+                    'submodule.{0}.path'.format(name)]
+            git_config = subprocess.Popen(args, cwd=tree,
+                                          stdout=subprocess.PIPE)
+            path = git_config.communicate()[0].strip()
+            assert git_config.returncode == 0
+            mirror = self.mirrors.update(url)
+            logging.info('Checking out submodule %s from mirror %s', path,
+                         mirror)
+            # Clone the submodule from its mirror, then make it look like
+            # it came from the real repo.  Newer gits refuse to clone
+            # submodules from local paths unless told otherwise.
+            subprocess.check_call(['git', 'config', key, mirror], cwd=tree)
+            args = ['git', '-c', 'protocol.file.allow=always', 'submodule',
+                    'update', '-q', '--reference', mirror, '--', path]
+            logging.debug("Executing ``%s''", ' '.join(args))
+            subprocess.check_call(args, cwd=tree)
+            subprocess.check_call(['git', 'config', key, url], cwd=tree)
+            subprocess.check_call(['git', 'remote', 'set-url', 'origin', url],
+                                  cwd=os.path.join(tree, path))
+            subtrees.append(os.path.join(tree, path))
+        for subtree in subtrees:
+            self._update_submodules_from_mirrors(subtree)
 
     def record_rev(self):
         if not self.tree:
             raise RuntimeError('checkout must precede record_rev')
-        pushd(self.tree)
-        args = ['git', 'rev-parse', 'HEAD']
+        if self.bare:
+            # Nothing is checked out, so resolve the ref directly
+            args = ['git', 'rev-parse', '--verify',
+                    '{0}^{{commit}}'.format(self._ref or 'HEAD')]
+        else:
+            args = ['git', 'rev-parse', 'HEAD']
         logging.debug("Executing ``%s''", ' '.join(args))
-        git_revparse = subprocess.Popen(args, stdout=subprocess.PIPE)
+        git_revparse = subprocess.Popen(args, cwd=self.tree,
+                                        stdout=subprocess.PIPE)
         assert git_revparse.wait() == 0
-        popd()
         self.rev = git_revparse.stdout.read().strip()
         logging.debug('git ref %s is %s', self._ref or 'HEAD', self.rev)
 
-    def create_tarball(self, tarball_name, destdir):
+    def resolve_rev(self):
+        if self.tree:
+            # Local repos are used as they are
+            args = ['git', 'rev-parse', '--verify', 'HEAD^{commit}']
+            logging.debug("Executing ``%s''", ' '.join(args))
+            git_revparse = subprocess.Popen(args, cwd=self.tree,
+                                            stdout=subprocess.PIPE)
+            rev = git_revparse.communicate()[0].strip()
+            assert git_revparse.returncode == 0
+            return rev
+        ref = self._ref or 'HEAD'
+        if re.match('^[0-9a-f]{40}$', ref):
+            return ref
+        # Annotated tags need their peeled ^{} entries to name commits
+        args = ['git', 'ls-remote', self.url, ref, ref + '^{}']
+        logging.debug("Executing ``%s''", ' '.join(args))
+        git_lsremote = subprocess.Popen(args, stdout=subprocess.PIPE)
+        refs = {}
+        for line in git_lsremote.communicate()[0].splitlines():
+            (sha, name) = line.split(None, 1)
+            refs[name] = sha
+        if git_lsremote.returncode != 0:
+            raise subprocess.CalledProcessError(git_lsremote.returncode, args)
+        for name in (ref, 'refs/heads/' + ref, 'refs/tags/' + ref + '^{}',
+                     'refs/tags/' + ref):
+            if name in refs:
+                return refs[name]
+        if re.match('^[0-9a-f]+$', ref):
+            # An abbreviated commit, which can never change
+            return ref
+        raise ValueError('ref {0} not found in {1}'.format(ref, self.url))
+
+    def create_tarball(self, tarball_name, destdir, workers=None, level=None):
         if not self.tree:
             raise RuntimeError('checkout call must precede create_tarball')
-        # git archive requires a trailing / to make it a dir
-        topdir  = tarball_name.rsplit('.tar', 1)[0] + '/'
+        topdir  = tarball_name.rsplit('.tar', 1)[0]
         tarball = os.path.abspath(os.path.join(destdir, tarball_name))
         logging.debug('Creating tarball %s', tarball)
 
-        pushd(self.tree)
-        args = [os.path.join(os.path.dirname(_ORIG_EXECUTABLE),
-                             'git-archive-recursive.sh'),
-                'HEAD', '--prefix', topdir, '-o', tarball]
-        logging.debug("Executing ``%s''", ' '.join(args))
-        subprocess.check_call(args)
-        popd()
+        if not self.rev:
+            self.record_rev()
+        if self.bare:
+            self._bare_urls = {self.tree: self.url}
+            self._prefetch_blobs(self.tree, self.rev)
+            archiver = tarlib.GitArchiver(self._find_bare_submodule)
+        else:
+            archiver = tarlib.GitArchiver(_find_submodule_tree)
+        tarball_file = tarlib.CompressedFile(tarball, workers=workers,
+                                             level=level)
+        try:
+            archiver.archive(self.tree, self.rev, topdir, tarball_file)
+        finally:
+            archiver.close()
+            tarball_file.close()
+
+    def _find_bare_submodule(self, repo, commit, path, subcommit):
+        submodule_urls = _read_gitmodules(repo, commit)
+        if path not in submodule_urls:
+            logging.warn('No URL for submodule %s in %s; leaving it empty',
+                         path, self._bare_urls[repo])
+            return None
+        suburl = _resolve_submodule_url(self._bare_urls[repo],
+                                        submodule_urls[path])
+        logging.info('Resolved submodule %s to %s commit %s', path, suburl,
+                     subcommit)
+        subrepo = self._get_bare_repo(suburl,
+                                      os.path.join(repo, 'modules', path))
+        self._bare_urls[subrepo] = suburl
+        self._prefetch_blobs(subrepo, subcommit)
+        return subrepo
+
+    def _prefetch_blobs(self, repo, commit):
+        """
+        Fetch all of the blobs a partial clone lacks for a commit at once,
+        rather than letting git fetch them one at a time as they are read.
+        """
+        if self.mirrors:
+            return
+        args = ['git', 'rev-list', '--objects', '--no-walk',
+                '--missing=print', commit]
+        git_revlist = subprocess.Popen(args, cwd=repo, stdout=subprocess.PIPE)
+        missing = [line[1:] for line in
+                   git_revlist.communicate()[0].splitlines()
+                   if line.startswith('?')]
+        assert git_revlist.returncode == 0
+        if missing:
+            logging.debug('Fetching %i blob(s) into %s', len(missing), repo)
+            args = ['git', '-c', 'fetch.negotiationAlgorithm=noop', 'fetch',
+                    '-q', 'origin', '--no-tags', '--no-write-fetch-head',
+                    '--recurse-submodules=no', '--filter=blob:none',
+                    '--stdin']
+            git_fetch = subprocess.Popen(args, cwd=repo,
+                                         stdin=subprocess.PIPE)
+            git_fetch.communicate('\n'.join(missing) + '\n')
+            if git_fetch.returncode != 0:
+                raise subprocess.CalledProcessError(git_fetch.returncode,
+                                                    args)
 
     def friendly_rev(self):
         return self.rev[:8]
 
+    def cache_key(self):
+        # Submodule commits pin their own submodules in turn, so listing
+        # the top level's is enough.
+        key = Repo.cache_key(self)
+        args = ['git', 'ls-tree', '-r', self.rev]
+        git_lstree = subprocess.Popen(args, cwd=self.tree,
+                                      stdout=subprocess.PIPE)
+        entries = git_lstree.communicate()[0].splitlines()
+        assert git_lstree.returncode == 0
+        key.extend(entry for entry in entries if entry.startswith('160000 '))
+        return key
+
+
+def _find_submodule_tree(repo, commit, path, subcommit):
+    subtree = os.path.join(repo, path)
+    if os.path.exists(os.path.join(subtree, '.git')):
+        return subtree
+    logging.warn('Submodule %s is not checked out; leaving it empty', subtree)
+    return None
+
+
+def _read_gitmodules(gitdir, commit):
+    """
+    Return a dict that maps submodule paths to their URLs according to the
+    .gitmodules file in a commit.
+    """
+    args = ['git', '--git-dir', gitdir, 'config', '--blob',
+            commit + ':.gitmodules', '--get-regexp',
+            r'^submodule\..*\.(path|url)$']
+    git_config = subprocess.Popen(args, stdout=subprocess.PIPE)
+    lines = git_config.communicate()[0].splitlines()
+    paths = {}
+    urls = {}
+    for line in lines:
+        (key, value) = line.split(None, 1)
+        (name, __, attr) = key[len('submodule.'):].rpartition('.')
+        if attr == 'path':
+            paths[name] = value
+        else:
+            urls[name] = value
+    return dict((path, urls[name]) for (name, path) in paths.iteritems()
+                if name in urls)
+
+
+def _resolve_submodule_url(parent_url, url):
+    if not url.startswith('./') and not url.startswith('../'):
+        return url
+    base = parent_url.rstrip('/')
+    for component in url.split('/'):
+        if component == '..':
+            base = base.rsplit('/', 1)[0]
+        elif component != '.':
+            base = base + '/' + component
+    return base
+
 
 class BzrRepo(Repo):
+    def __init__(self, url, ref, mirrors=None, tarball_only=False):
+        Repo.__init__(self, url, ref, mirrors=mirrors,
+                      tarball_only=tarball_only)
+        self._branch = None
+        self._branch_lock = threading.Lock()
+        # Shown to people; self.rev is the revision id, which unlike the
+        # revno never comes to mean another revision
+        self.revno = None
+
+    def branch(self):
+        """
+        Return where to read the branch from:  its mirror, which the first
+        call brings up to date, if there are mirrors and the branch is not
+        local already, or else the branch itself.
+        """
+        with self._branch_lock:
+            if self._branch is None:
+                if self.mirrors and not os.path.exists(self.url):
+                    self._branch = self.mirrors.update_bzr(self.url)
+                else:
+                    self._branch = self.url
+            return self._branch
+
+    def size_hint(self):
+        if self.mirrors and not os.path.exists(self.url):
+            return self.mirrors.size(self.url, vcs='bzr')
+        return None
+
     def checkout(self, destdir):
-        if self.tree:
+        if self.tree or self.tarball_only:
+            # bzr can export straight from the branch
             return
         # destdir is a pre-existing directory in which a source checkout goes
         # e.g. mydir -> repo goes in mydir/myrepo
@@ -134,123 +527,187 @@ class BzrRepo(Repo):
             args.extend(['-r', self._ref])
         else:
             logging.info('Checking out bzr repo %s to %s', self.url, self.tree)
-        args.extend([self.url, self.tree])
+        # A lightweight checkout of a local mirror reads file texts locally
+        args.extend([self.branch(), self.tree])
         logging.debug("Executing ``%s''", ' '.join(args))
         subprocess.check_call(args)
 
     def record_rev(self):
-        if not self.tree:
+        if self.tree:
+            args = ['bzr', 'revision-info', '-q', '-d', self.tree]
+        elif self.tarball_only:
+            args = ['bzr', 'revision-info', '-q', '-d', self.branch()]
+            if self._ref:
+                args.append(self._ref)
+        else:
             raise RuntimeError('checkout must precede record_rev')
-        args = ['bzr', 'revno', '-q', self.tree]
         logging.debug("Executing ``%s''", ' '.join(args))
-        bzr_revno = subprocess.Popen(args, stdout=subprocess.PIPE)
-        assert bzr_revno.wait() == 0
-        self.rev = bzr_revno.stdout.read().strip()
+        bzr_revinfo = subprocess.Popen(args, stdout=subprocess.PIPE)
+        info = bzr_revinfo.communicate()[0].split()
+        if bzr_revinfo.returncode != 0:
+            raise subprocess.CalledProcessError(bzr_revinfo.returncode, args)
+        # revision-info prints the revision id after the revno
+        (self.revno, self.rev) = (info[0], info[-1])
         if self._ref:
-            logging.debug('bzr rev %s is %s', self._ref, self.rev)
+            logging.debug('bzr rev %s is %s (%s)', self._ref, self.revno,
+                          self.rev)
         else:
-            logging.debug('bzr tip is %s', self.rev)
+            logging.debug('bzr tip is %s (%s)', self.revno, self.rev)
 
-    def create_tarball(self, tarball_name, destdir):
-        if not self.tree:
+    def resolve_rev(self):
+        # Revision ids, unlike revnos, never refer to anything else
+        args = ['bzr', 'revision-info', '-q', '-d', self.url]
+        if self._ref:
+            args.append(self._ref)
+        logging.debug("Executing ``%s''", ' '.join(args))
+        bzr_revinfo = subprocess.Popen(args, stdout=subprocess.PIPE)
+        info = bzr_revinfo.communicate()[0].split()
+        if bzr_revinfo.returncode != 0:
+            raise subprocess.CalledProcessError(bzr_revinfo.returncode, args)
+        return info[-1]
+
+    def friendly_rev(self):
+        return self.revno
+
+    def create_tarball(self, tarball_name, destdir, workers=None, level=None):
+        if not self.tree and not self.tarball_only:
             raise RuntimeError('checkout call must precede create_tarball')
+        topdir  = tarball_name.rsplit('.tar', 1)[0]
         tarball = os.path.abspath(os.path.join(destdir, tarball_name))
         logging.debug('Creating tarball %s', tarball)
 
-        args = ['bzr', 'export', '-q', tarball, self.tree]
+        # Export an uncompressed tar stream and compress it ourselves
+        args = ['bzr', 'export', '-q', '--format=tar', '--root', topdir]
+        if self.tree:
+            args.extend(['-', self.tree])
+        else:
+            if not self.rev:
+                self.record_rev()
+            args.extend(['-r', 'revid:' + self.rev, '-', self.branch()])
         logging.debug("Executing ``%s''", ' '.join(args))
-        subprocess.check_call(args)
+        bzr_export = subprocess.Popen(args, stdout=subprocess.PIPE)
+        tarball_file = tarlib.CompressedFile(tarball, workers=workers,
+                                             level=level)
+        try:
+            # bzr stamps files with the time of the export
+            tarlib.copy_tar_stream(bzr_export.stdout, tarball_file,
+                                   max_mtime=tarlib.source_date_epoch())
+        finally:
+            tarball_file.close()
+        if bzr_export.wait() != 0:
+            raise subprocess.CalledProcessError(bzr_export.returncode, args)
 
 
-def build_repo(url):
+def build_repo(url, mirrors=None, tarball_only=False):
     if not url:
         return None
     (basic_url, rev) = _split_repo_url(url)
     if '://' in basic_url:
         scheme = basic_url.split('://', 1)[0]
         if scheme in ['bzr', 'bzr+ssh']:
-            return BzrRepo(basic_url, rev)
+            return BzrRepo(basic_url, rev, mirrors=mirrors,
+                           tarball_only=tarball_only)
         elif scheme in ['git', 'git+ssh']:
-            return GitRepo(basic_url, rev)
+            return GitRepo(basic_url, rev, mirrors=mirrors,
+                           tarball_only=tarball_only)
         else:
             raise ValueError('Unsupported repo scheme: ' + repr(scheme))
     elif basic_url.startswith('lp:'):
-        return BzrRepo(basic_url, rev)
+        return BzrRepo(basic_url, rev, mirrors=mirrors,
+                       tarball_only=tarball_only)
     else:
         # assume a local repo exists
         path = os.path.abspath(basic_url)
         if os.path.exists(os.path.join(path, '.bzr')):
-            return BzrRepo(path, rev)
+            return BzrRepo(path, rev, tarball_only=tarball_only)
         elif os.path.exists(os.path.join(path, '.git')):
-            return GitRepo(path, rev)
+            return GitRepo(path, rev, mirrors=mirrors,
+                           tarball_only=tarball_only)
         else:
             raise ValueError('Unrecognized local repo: ' + repr(path))
 
 
 class SRPMBuilder(object):
     def __init__(self, chroot, pkg_repo, fetch=None, sources=None,
-                 mock_opts=None):
+                 mock_opts=None, mirrors=None, tarball_only=False,
+                 tarball_cache=None, compress_workers=None,
+                 compress_level=None, downloader=None, srpm_cache=None,
+                 mock_configdir=None, mock_timeouts=None,
+                 compress_logs=False, ram_workspace=None):
         self.chroot    = chroot
         self.fetch     = fetch or []
         self.mock_opts = mock_opts
-        self.pkg_repo  = build_repo(pkg_repo)
+        self.mock_configdir = mock_configdir
+        self.mock_timeouts = mock_timeouts
+        self.compress_logs = compress_logs
+        self.srpm_cache = srpm_cache
+        self.downloader = downloader or fetchlib.Downloader()
+        self.tarball_cache = tarball_cache
+        self.compress_workers = compress_workers
+        self.compress_level = compress_level
+        self.ram_workspace = ram_workspace
+        self.pkg_repo  = build_repo(pkg_repo, mirrors=mirrors)
+        self.srcdir    = None
         self.specfile  = None
+        self.spec      = None
         self.sources   = {}
         for (i, url) in sources or []:
-            self.sources[int(i)] = build_repo(url)
+            self.sources[int(i)] = build_repo(url, mirrors=mirrors,
+                                              tarball_only=tarball_only)
 
     def checkout_packaging_repo(self, destdir):
         """
-        Create a checkout of self.pkg_repo inside of destdir, then chdir into
-        it.
+        Create a checkout of self.pkg_repo inside of destdir.  That checkout
+        becomes self.srcdir, where all of the build's sources are gathered.
         """
         self.pkg_repo.checkout(destdir)
         logging.info('Packaging repo checked out to %s', self.pkg_repo.tree)
-        os.chdir(self.pkg_repo.tree)
+        self.srcdir = os.path.abspath(self.pkg_repo.tree)
 
-        specs = glob.glob('*.spec')
+        specs = glob.glob(os.path.join(self.srcdir, '*.spec'))
         assert len(specs) == 1
-        self.specfile = os.path.abspath(specs[0])
+        self.specfile = specs[0]
+        self.spec = speclib.ParsedSpec(self.specfile)
         logging.info('Using spec file %s', self.specfile)
 
-    def checkout_sources(self, destdir):
-        for source in self.sources.itervalues():
-            if not source.tree:
-                source.checkout(destdir)
-            source.record_rev()
+    def checkout_sources(self, destdir, jobs=1):
+        """
+        Check out the -sN repos inside of destdir, or in self.ram_workspace
+        while it has room for them.
+        """
+        tasks = [('Source{0}'.format(i), self._checkout_source,
+                  (source, destdir))
+                 for (i, source) in sorted(self.sources.iteritems())]
+        poollib.run_tasks(tasks, jobs=jobs)
+
+    def _checkout_source(self, source, destdir):
+        if not source.tree and self.ram_workspace:
+            with self.ram_workspace.place(
+                    destdir, size=source.size_hint()) as placed:
+                source.checkout(placed)
+            if source.tree:
+                self.ram_workspace.settle([source.tree])
+        elif not source.tree:
+            source.checkout(destdir)
+        source.record_rev()
 
     def add_macros_to_specfile(self, macros):
         """
-        Read a spec file, looking for macro expansions that correspond to
-        keys in a dict.  For each match, add a %global macro definition to
-        the top of the spec file.
+        Scan a spec file, and the files it %includes, for references to
+        macros that correspond to keys in a dict.  For each match, add a
+        %global macro definition to the top of the spec file.
         """
-        with open(self.specfile) as original_file:
-            original = original_file.read()
-        applicable_macros = {}
-        for (key, val) in macros.iteritems():
-            for fmt in ['%{{{0}}}', '%{{?{0}}}', '%{{!?{0}}}', '%{0}']:
-                if fmt.format(key) in original:
-                    applicable_macros[key] = val
-                    break
+        referenced = speclib.macro_references(self.specfile)
+        applicable_macros = dict((key, val)
+                                 for (key, val) in macros.iteritems()
+                                 if key in referenced)
         applicable_macros = self.substitute_magic_values(applicable_macros)
         if applicable_macros:
             logging.info('Adding %i macro(s) to spec file: %s',
                          len(applicable_macros),
                          ', '.join(applicable_macros.keys()))
             logging.debug('Macro values: %s', str(applicable_macros))
-            modified = tempfile.NamedTemporaryFile(delete=False)
-            try:
-                for (key, val) in applicable_macros.iteritems():
-                    modified.write('%global {0} {1}\n'.format(key, val))
-                modified.write('\n')
-                modified.write(original)
-            except:
-                os.remove(modified.name)
-                raise
-            finally:
-                modified.close()
-            shutil.move(modified.name, self.specfile)
+            speclib.prepend_globals(self.specfile, applicable_macros)
 
     def substitute_magic_values(self, macros):
         utcnow = datetime.datetime.utcnow()
@@ -271,77 +728,232 @@ class SRPMBuilder(object):
             newmacros[key] = val
         return newmacros
 
-    def build_tarballs(self):
-        tset = rpm.ts()
-        spec = tset.parseSpec(self.specfile)
-        spec_sources = dict([(src[1], src[0]) for src in spec.sources
-                             if src[2] == 1])
+    def build_tarballs(self, jobs=1):
+        poollib.run_tasks(self.tarball_tasks(), jobs=jobs)
 
-        for (i, source) in self.sources.iteritems():
+    def tarball_tasks(self):
+        """
+        Return a list of run_tasks tasks that build tarballs for the spec
+        file's sources from the -sN repos.
+        """
+        spec_sources = self.spec.sources
+        tasks = []
+        for (i, source) in sorted(self.sources.iteritems()):
             if i in spec_sources:
                 tarball = os.path.basename(spec_sources[i])
-                logging.info('Building Source%i: %s from %s', i, tarball,
-                             source.tree)
-                source.create_tarball(tarball, '.')
+                tasks.append(('Source{0}'.format(i), self._build_tarball,
+                              (i, source, tarball)))
             else:
                 logging.warn('Spec file does not contain Source%i; skipping '
                              'tarball build for url %s', i, source.url)
+        return tasks
+
+    def _build_tarball(self, i, source, tarball):
+        tarball_path = os.path.join(self.srcdir, tarball)
+        # Never write into a file that may be linked to a cache entry
+        if os.path.lexists(tarball_path):
+            os.remove(tarball_path)
+        if self.tarball_cache:
+            # Different compressors, their settings and SOURCE_DATE_EPOCH
+            # give different bytes; the number of workers doesn't
+            compressor = tarlib.compressor_args(
+                tarball, workers=1, level=self.compress_level) or []
+            key = self.tarball_cache.key_for(
+                'tarball', tarball, ' '.join(compressor),
+                str(tarlib.source_date_epoch()), *source.cache_key())
+            if self.tarball_cache.fetch_file(key, tarball_path):
+                logging.info('Using cached Source%i: %s for %s rev %s', i,
+                             tarball, source.url, source.friendly_rev())
+                return
+        logging.info('Building Source%i: %s from %s', i, tarball,
+                     source.tree)
+        source.create_tarball(tarball, self.srcdir,
+                              workers=self.compress_workers,
+                              level=self.compress_level)
+        if self.tarball_cache:
+            self.tarball_cache.store_file(key, tarball_path)
 
-    def fetch_sources(self):
-        for source in self.fetch:
-            fetch_file(source)
-
-    def fetch_spec_sources(self):
-        tset = rpm.ts()
-        spec = tset.parseSpec(self.specfile)
-        for source in spec.sources:
-            srcuri  = source[0]
-            srcno   = source[1]
-            srcname = os.path.basename(srcuri)
-            if not os.path.exists(srcname):
+    def fetch_sources(self, jobs=1):
+        poollib.run_tasks(self.fetch_tasks(), jobs=jobs)
+
+    def fetch_tasks(self):
+        """
+        Return a list of run_tasks tasks that fetch the sources that were
+        explicitly requested.
+        """
+        return [('Fetch ' + os.path.basename(source), fetch_file,
+                 (source, self.srcdir, self.downloader))
+                for source in self.fetch]
+
+    def fetch_spec_sources(self, jobs=1):
+        poollib.run_tasks(self.spec_fetch_tasks(), jobs=jobs)
+
+    def spec_fetch_tasks(self):
+        """
+        Return a list of run_tasks tasks that download the spec file's
+        remote sources that neither exist yet nor will be built or fetched
+        by the tasks from tarball_tasks and fetch_tasks.
+        """
+        provided = set(os.path.basename(urlparse.urlparse(source)[2])
+                       for source in self.fetch)
+        for (srcno, srcuri) in self.spec.sources.iteritems():
+            if srcno in self.sources:
+                provided.add(os.path.basename(srcuri))
+        tasks = []
+        for (kind, spec_sources) in [('Source', self.spec.sources),
+                                     ('Patch', self.spec.patches)]:
+            for (srcno, srcuri) in sorted(spec_sources.iteritems()):
+                label = '{0}{1}'.format(kind, srcno)
+                srcname = os.path.basename(srcuri)
+                if (srcname in provided or
+                        os.path.exists(os.path.join(self.srcdir, srcname))):
+                    continue
                 if urlparse.urlparse(srcuri)[0]:
-                    logging.info('Downloading Source%i: %s from %s', srcno,
-                                 srcname, srcuri)
-                    fetch_file(srcuri)
+                    tasks.append((label, self._download_spec_source,
+                                  (label, srcname, srcuri)))
                 else:
-                    logging.warn('Unable to obtain Source%i: %s', srcno,
-                                 srcname)
+                    logging.warn('Unable to obtain %s: %s', label, srcname)
+        return tasks
+
+    def _download_spec_source(self, label, srcname, srcuri):
+        logging.info('Downloading %s: %s from %s', label, srcname, srcuri)
+        fetch_file(srcuri, self.srcdir, self.downloader)
 
-    def build_srpm(self, resultdir):
+    def build_srpm(self, resultdir, chroot_init=None):
+        """
+        Build the source RPM in resultdir.  If chroot_init is a
+        mocklib.BackgroundInit of the chroot, build in the root it sets up.
+        """
+        # Mock appends to logs, so only the SRPM may share the cache's copy
+        link = lambda name: name.endswith('.rpm')
+        if self.srpm_cache:
+            key = self.srpm_cache_key()
+            if self.srpm_cache.fetch_files(key, resultdir, link=link):
+                logging.info('Using cached source RPM for chroot %s in %s',
+                             self.chroot, resultdir)
+                if chroot_init:
+                    chroot_init.cancel()
+                return
+        # Never let mock write into files that are linked to cache entries
+        for srpm in glob.glob(os.path.join(resultdir, '*.src.rpm')):
+            if os.stat(srpm).st_nlink > 1:
+                os.remove(srpm)
         logging.info('Building source RPM in %s using chroot %s', resultdir,
                      self.chroot)
-        args = ['/usr/bin/mock', '-v', '-r', self.chroot, '--resultdir', resultdir]
+        args = [mocklib.MOCK, '-v', '-r', self.chroot, '--resultdir',
+                resultdir]
         args.extend(self.mock_opts or [])
+        if chroot_init:
+            with tracelib.span('wait-chroot-init'):
+                chroot_init.wait()
+            args.append('--no-clean')
         args.extend(['--buildsrpm', '--spec', self.specfile, '--sources',
-                     os.getcwd()])
-        logging.debug("Executing ``%s''", ' '.join(args))
-        subprocess.check_call(args)
-        assert len(glob.glob(os.path.join(resultdir, '*.src.rpm'))) == 1
+                     self.srcdir])
+        mocklib.run_mock(args, timeouts=self.mock_timeouts, logdir=resultdir,
+                         compress_logs=self.compress_logs)
+        srpms = glob.glob(os.path.join(resultdir, '*.src.rpm'))
+        assert len(srpms) == 1
+        if self.srpm_cache:
+            results = (srpms +
+                       glob.glob(os.path.join(resultdir, '*.log')) +
+                       glob.glob(os.path.join(resultdir, '*.log.gz')))
+            self.srpm_cache.store_files(key, results, link=link)
+
+    def srpm_cache_key(self):
+        """
+        Return a key that identifies everything that goes into the source
+        RPM:  the spec file as it is now, every file in the sources dir, the
+        mock config, and the mock options that affect the build.
+        """
+        parts = ['srpm', mocklib.config_digest(self.chroot,
+                                               self.mock_configdir)]
+        parts.extend(mocklib.output_opts(self.mock_opts or []))
+        with open(self.specfile, 'rb') as spec_file:
+            parts.append(hashlib.sha1(spec_file.read()).hexdigest())
+        for (dirpath, dirnames, filenames) in os.walk(self.srcdir):
+            # Revision control metadata doesn't go in the SRPM
+            dirnames[:] = sorted(name for name in dirnames
+                                 if name not in ('.git', '.bzr'))
+            for name in sorted(filenames):
+                path = os.path.join(dirpath, name)
+                parts.append(os.path.relpath(path, self.srcdir))
+                if os.path.islink(path):
+                    parts.append('-> ' + os.readlink(path))
+                else:
+                    parts.append(_file_digest(path))
+        return self.srpm_cache.key_for(*parts)
 
     def _get_nvr(self):
-        tset = rpm.ts()
-        tset.parseSpec(self.specfile)
-        name    = rpm.expandMacro('%{name}')
-        version = rpm.expandMacro('%{version}')
-        release = rpm.expandMacro('%{release}')
-        return (name, version, release)
+        return self.spec.nvr
+
+
+def _file_digest(path):
+    digest = hashlib.sha1()
+    with open(path, 'rb') as file_:
+        for chunk in iter(lambda: file_.read(1024 * 1024), ''):
+            digest.update(chunk)
+    return digest.hexdigest()
 
 
-def fetch_file(url, destdir='.'):
+def fetch_file(url, destdir, downloader=None):
     """
     Fetch a file and deposit it in destdir.
 
-    If url is a path to a local file it is copied.  Otherwise it is fetched
-    using the necessary transport (e.g. HTTP) if possible.
+    If url is a path to a local file it is reflinked, hardlinked, or copied,
+    whichever is cheapest.  Otherwise it is fetched with downloader, using
+    the necessary transport (e.g. HTTP) if possible.
     """
     filename = os.path.basename(urlparse.urlparse(url)[2])
     destfile = os.path.join(destdir, filename)
     if urlparse.urlparse(url)[0]:
         logging.debug('Downloading %s', url)
-        urllib.urlretrieve(url, destfile)
+        (downloader or fetchlib.Downloader()).fetch(url, destfile)
     else:
-        logging.debug('Copying local file %s', url)
-        shutil.copy2(url, destfile)
+        logging.debug('Linking local file %s', url)
+        cachelib.link_or_copy(url, destfile)
+
+
+def resolve_build_state(pkg_repo, sources, options):
+    """
+    Return a dict that describes everything a build would use:  the
+    revisions the packaging and -sN repos resolve to right now, and the
+    command line options that affect the result.
+    """
+    repos = [('pkg_repo', pkg_repo)]
+    repos.extend(('Source{0}'.format(i), url) for (i, url) in sources)
+    revs = {}
+
+    def resolve(name, url):
+        revs[name] = [url, build_repo(url).resolve_rev()]
+        logging.debug('%s %s is at %s', name, url, revs[name][1])
+    poollib.run_tasks([('Resolve ' + name, resolve, (name, url))
+                       for (name, url) in repos], jobs=options.jobs)
+    return {'revs': revs,
+            'macros': options.macros,
+            'fetch': options.fetches,
+            'chroot': options.chroot,
+            'config': options.config,
+            # Which build root to use doesn't change what gets built
+            'mock_options': ' '.join(mocklib.output_opts(
+                options.mock_options.split()))}
+
+
+def read_build_state(state_file):
+    try:
+        with open(state_file) as state:
+            return json.load(state)
+    except IOError:
+        return None
+    except ValueError:
+        logging.warn('Ignoring unreadable state file %s', state_file)
+        return None
+
+
+def write_build_state(state_file, state):
+    tmp_file = '{0}.tmp-{1}'.format(state_file, os.getpid())
+    with open(tmp_file, 'w') as tmp:
+        json.dump(state, tmp, indent=2, sort_keys=True)
+    os.rename(tmp_file, state_file)
 
 
 def _parse_macro_def(option, opt, value, parser):
@@ -354,7 +966,7 @@ def _parse_macro_def(option, opt, value, parser):
     setattr(parser.values, option.dest, parsed_macros)
 
 
-def parse_cli_args():
+def parse_cli_args(argv=None):
     usage = ('%prog [-d] [-m KEY=VALUE ...] [-sN SRC_REPO ...] '
              '[--mock-options OPTS] [-r CHROOT | -c CONFIG] -w WORKSPACE '
              '-o RESULTDIR PKG_REPO')
@@ -383,7 +995,69 @@ def parse_cli_args():
                       help='directory to place results into')
     parser.add_option('--mock-options', metavar='OPTS', default='',
                       help='options to pass to mock')
-    (options, args) = parser.parse_args()
+    parser.add_option('--ram-workspace', metavar='MB', type='int',
+                      default=None, help=('check out repos and build '
+                                          'tarballs in tmpfs, moving the '
+                                          'largest to the workspace on disk '
+                                          'beyond this much; what is left '
+                                          'in tmpfs is discarded after the '
+                                          'build'))
+    parser.add_option('--mirror-cache', metavar='DIR', default=None,
+                      help=('check out git and bzr repos from persistent '
+                            'mirrors kept in DIR'))
+    parser.add_option('--mirror-cache-size', metavar='MB', type='int',
+                      default=None, help=('evict least recently used '
+                                          'mirrors beyond this size'))
+    parser.add_option('--tarball-only', action='store_true', default=False,
+                      help=('build source tarballs straight from bare '
+                            'repos without checking out working trees'))
+    parser.add_option('--tarball-cache', metavar='DIR', default=None,
+                      help=('reuse tarballs built from the same source '
+                            'revisions, keeping them in DIR'))
+    parser.add_option('--tarball-cache-size', metavar='MB', type='int',
+                      default=None, help=('evict least recently used '
+                                          'tarballs beyond this size'))
+    parser.add_option('--compress-workers', metavar='N', type='int',
+                      default=None, help=('compress tarballs with N threads '
+                                          '(default: one per CPU)'))
+    parser.add_option('--compress-level', metavar='LEVEL', type='int',
+                      default=None, help='compression level for tarballs')
+    parser.add_option('-j', '--jobs', metavar='N', type='int', default=1,
+                      help=('check out, build, and download up to N '
+                            'sources at once (default: 1)'))
+    parser.add_option('--download-cache', metavar='DIR', default=None,
+                      help=('keep downloaded sources in DIR and only '
+                            'download them again when they change'))
+    parser.add_option('--download-cache-size', metavar='MB', type='int',
+                      default=None, help=('evict least recently used '
+                                          'downloads beyond this size'))
+    parser.add_option('--srpm-cache', metavar='DIR', default=None,
+                      help=('reuse source RPMs built from the same spec '
+                            'file and sources, keeping them in DIR'))
+    parser.add_option('--srpm-cache-size', metavar='MB', type='int',
+                      default=None, help=('evict least recently used '
+                                          'source RPMs beyond this size'))
+    parser.add_option('--state-file', metavar='FILE', default=None,
+                      help=('exit with status {0} without building if '
+                            'nothing changed since the build recorded in '
+                            'FILE').format(EXIT_UNCHANGED))
+    parser.add_option('--overlap-init', action='store_true', default=False,
+                      help=('initialize the mock chroot in the background '
+                            'while sources are prepared'))
+    parser.add_option('--timeout', metavar='PHASE=SECS', dest='timeouts',
+                      action='append', default=[],
+                      help=('kill mock if a phase whose name starts with '
+                            'PHASE, as in its "Start: PHASE" lines, takes '
+                            'longer than SECS; "total" limits the whole '
+                            'run (may be given more than once)'))
+    parser.add_option('--compress-logs', action='store_true', default=False,
+                      help=('gzip mock\'s logs while it writes them, '
+                            'leaving NAME.log.gz'))
+    parser.add_option('--trace', metavar='FILE', default=None,
+                      help=('write how long each phase of the build and '
+                            'each command took, and the resources they '
+                            'used, to FILE as a Chrome trace'))
+    (options, args) = parser.parse_args(argv)
     if len(args) != 1:
         parser.error('exactly 1 positional argument is required')
     if not options.chroot and not options.config:
@@ -394,49 +1068,173 @@ def parse_cli_args():
         parser.error('working directory must be specified with -w')
     if not options.resultdir:
         parser.error('result directory must be specified with -o')
+    try:
+        options.timeouts = mocklib.parse_timeouts(options.timeouts)
+    except ValueError as err:
+        parser.error(str(err))
     return (options, args)
 
 
 def main():
     (options, args) = parse_cli_args()
+    if options.jobs > 1:
+        # Concurrent tasks' threads are named after them
+        log_format = ('%(asctime)-15s [%(levelname)s] %(threadName)s: '
+                      '%(message)s')
+    else:
+        log_format = '%(asctime)-15s [%(levelname)s] %(message)s'
+    logging.basicConfig(stream=sys.stdout, level=options.loglevel,
+                        format=log_format)
+    sys.exit(run(options, args))
+
+
+def run(options, args, mirrors=None, downloader=None):
+    """
+    Build the SRPM that parsed command line options ask for and return the
+    exit status.  Callers that run many builds can pass in Mirrors and
+    a downloader to share between them; those are left open afterwards.
+    """
+    with tracelib.tracing(options.trace, {'script': 'build-srpm-from-scm',
+                                          'pkg_repo': args[0]}):
+        return _run(options, args, mirrors, downloader)
+
+
+def _run(options, args, mirrors, downloader):
     pkg_repo  = args[0]
     fetches   = map(os.path.abspath, options.fetches)
     resultdir = os.path.abspath(options.resultdir)
     workspace = os.path.abspath(options.workspace)
     builddir  = os.path.join(workspace, 'builddir')
     mock_opts = options.mock_options.split()
-    logging.basicConfig(stream=sys.stdout, level=options.loglevel,
-                        format='%(asctime)-15s [%(levelname)s] %(message)s')
+
+    state = None
+    if options.state_file:
+        # Find out whether there is anything to do before cloning anything
+        with tracelib.span('resolve-state'):
+            state = resolve_build_state(pkg_repo, options.sources, options)
+        if read_build_state(options.state_file) == state:
+            logging.info('Nothing changed since the build recorded in %s',
+                         options.state_file)
+            return EXIT_UNCHANGED
 
     mock = None
+    chroot_init = None
+    own_mirrors = mirrors is None
+    own_downloader = downloader is None
+    tarball_cache = None
+    download_cache = None
+    srpm_cache = None
 
-    if options.config:
-        mock = mocklib.MockTemp(logging, mock_opts=mock_opts)
-        mock.apply_config(options.config)
-        builder = SRPMBuilder(mock.chroot, pkg_repo,
-                              sources=options.sources, fetch=fetches,
-                              mock_opts=mock.mock_opts)
-    else:
-        builder = SRPMBuilder(options.chroot, pkg_repo,
-                              sources=options.sources, fetch=fetches,
-                              mock_opts=mock_opts)
-    if not os.path.exists(workspace):
-        os.makedirs(workspace)
-    if not os.path.exists(builddir):
-        os.makedirs(builddir)
-    builder.checkout_packaging_repo(builddir)
-    # We have now chdir'd into the packaging repo dir
-    builder.checkout_sources(workspace)
-    builder.add_macros_to_specfile(options.macros)
-    builder.build_tarballs()
-    builder.fetch_sources()
-    builder.fetch_spec_sources()
-    builder.build_srpm(resultdir)
-
-    if mock:
-        mock.cleanup()
+    if own_mirrors and options.mirror_cache:
+        max_size = None
+        if options.mirror_cache_size:
+            max_size = options.mirror_cache_size * 1024 * 1024
+        mirrors = Mirrors(cachelib.CacheDir(options.mirror_cache,
+                                            max_size=max_size))
+    if options.tarball_cache:
+        max_size = None
+        if options.tarball_cache_size:
+            max_size = options.tarball_cache_size * 1024 * 1024
+        tarball_cache = cachelib.CacheDir(options.tarball_cache,
+                                          max_size=max_size)
+    if own_downloader and options.download_cache:
+        max_size = None
+        if options.download_cache_size:
+            max_size = options.download_cache_size * 1024 * 1024
+        download_cache = cachelib.CacheDir(options.download_cache,
+                                           max_size=max_size)
+    if options.srpm_cache:
+        max_size = None
+        if options.srpm_cache_size:
+            max_size = options.srpm_cache_size * 1024 * 1024
+        srpm_cache = cachelib.CacheDir(options.srpm_cache, max_size=max_size)
+    if own_downloader:
+        downloader = fetchlib.Downloader(cache=download_cache)
+    ram_workspace = None
+    try:
+        if not os.path.exists(workspace):
+            os.makedirs(workspace)
+        if options.ram_workspace:
+            ram_workspace = ramlib.RAMWorkspace(
+                workspace, options.ram_workspace * 1024 * 1024)
+            builddir = os.path.join(ram_workspace.path, 'builddir')
+        if options.config:
+            mock = mocklib.MockTemp(logging, mock_opts=mock_opts)
+            with tracelib.span('mock-config'):
+                mock.apply_config(options.config)
+            builder = SRPMBuilder(mock.chroot, pkg_repo,
+                                  sources=options.sources, fetch=fetches,
+                                  mock_opts=mock.mock_opts, mirrors=mirrors,
+                                  tarball_only=options.tarball_only,
+                                  tarball_cache=tarball_cache,
+                                  compress_workers=options.compress_workers,
+                                  compress_level=options.compress_level,
+                                  downloader=downloader, srpm_cache=srpm_cache,
+                                  mock_configdir=mock.config_tempdir,
+                                  mock_timeouts=options.timeouts,
+                                  compress_logs=options.compress_logs,
+                                  ram_workspace=ram_workspace)
+        else:
+            builder = SRPMBuilder(options.chroot, pkg_repo,
+                                  sources=options.sources, fetch=fetches,
+                                  mock_opts=mock_opts, mirrors=mirrors,
+                                  tarball_only=options.tarball_only,
+                                  tarball_cache=tarball_cache,
+                                  compress_workers=options.compress_workers,
+                                  compress_level=options.compress_level,
+                                  downloader=downloader, srpm_cache=srpm_cache,
+                                  mock_timeouts=options.timeouts,
+                                  compress_logs=options.compress_logs,
+                                  ram_workspace=ram_workspace)
+        if options.overlap_init:
+            # Mock sets up the build root while the sources are prepared
+            chroot_init = mocklib.BackgroundInit(
+                builder.chroot, builder.mock_opts, timeouts=options.timeouts)
+        if not os.path.exists(builddir):
+            os.makedirs(builddir)
+        with tracelib.span('checkout-packaging', output=builddir):
+            builder.checkout_packaging_repo(builddir)
+        with tracelib.span('checkout-sources'):
+            builder.checkout_sources(workspace, jobs=options.jobs)
+        with tracelib.span('add-macros'):
+            builder.add_macros_to_specfile(options.macros)
+        # Tarballs and downloads don't depend on each other, so they can all
+        # happen at once.
+        with tracelib.span('sources', output=builder.srcdir):
+            poollib.run_tasks(builder.tarball_tasks() +
+                              builder.fetch_tasks() +
+                              builder.spec_fetch_tasks(), jobs=options.jobs)
+        if ram_workspace:
+            # Mock copies the sources from builddir, so the checkouts are
+            # the first to go if it all no longer fits
+            with tracelib.span('settle-ram-workspace'):
+                ram_workspace.settle([source.tree for source
+                                      in builder.sources.itervalues()
+                                      if source.tree])
+                ram_workspace.settle([builddir])
+        with tracelib.span('build-srpm', output=resultdir):
+            builder.build_srpm(resultdir, chroot_init=chroot_init)
+        if state:
+            # Revisions pushed since they were resolved just cause a rebuild
+            # next time
+            write_build_state(options.state_file, state)
+    finally:
+        # Callers that keep running builds must not be left holding the
+        # chroot, even when this one failed
+        if chroot_init:
+            # Does nothing unless preparing the sources failed
+            chroot_init.cancel()
+        if own_downloader:
+            downloader.close()
+        if mock:
+            mock.cleanup()
+        if own_mirrors and mirrors:
+            mirrors.release()
+        if ram_workspace:
+            ram_workspace.close()
 
     logging.info('Build complete; results in %s', resultdir)
+    return 0
 
 
 if __name__ == '__main__':
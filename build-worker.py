@@ -0,0 +1,529 @@
+#!/usr/bin/python -tt
+
+"""
+Queue builds for a long-running worker and run them, several at once.
+
+    build-worker.py -q QUEUE submit srpm [build-srpm-from-scm.py args]
+    build-worker.py -q QUEUE submit arch [build-arch.py args]
+    build-worker.py -q QUEUE [-j N] serve
+    build-worker.py -q QUEUE status
+
+Jobs take the same arguments as the scripts that would otherwise run them,
+with relative paths relative to the directory they were submitted from.
+The queue is an SQLite database, so any number of submitters and workers
+on the same machine can share it.
+
+A worker runs jobs in its own process rather than starting a new one for
+each of them, so what earlier jobs set up stays around for later ones:
+the rpm library, repo mirrors, kept-alive connections to download servers
+and mock config servers, and one view of how busy the machine is.  Mirrors
+are only held against eviction while there is work to do.
+
+Jobs running at the same time in the same chroot get build roots of their
+own, and each job's log messages and mock output go to a log of its own
+in the log directory.
+"""
+
+import contextlib
+import errno
+import imp
+import json
+import logging
+import optparse
+import os
+import os.path
+import sqlite3
+import sys
+import threading
+import time
+import urlparse
+
+import cachelib
+import fetchlib
+import mocklib
+import poollib
+import tracelib
+
+__version__ = '0.1'
+
+_TOPDIR = os.path.dirname(os.path.abspath(__file__))
+buildsrpm = imp.load_source('build_srpm_from_scm',
+                            os.path.join(_TOPDIR, 'build-srpm-from-scm.py'))
+buildarch = imp.load_source('build_arch',
+                            os.path.join(_TOPDIR, 'build-arch.py'))
+
+JOB_KINDS = ('srpm', 'arch')
+JOB_STATES = ('queued', 'running', 'succeeded', 'unchanged', 'failed')
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id          INTEGER PRIMARY KEY AUTOINCREMENT,
+    kind        TEXT NOT NULL,
+    argv        TEXT NOT NULL,
+    cwd         TEXT NOT NULL,
+    state       TEXT NOT NULL DEFAULT 'queued',
+    worker      INTEGER,
+    submitted   REAL NOT NULL,
+    started     REAL,
+    finished    REAL,
+    exit_status INTEGER,
+    error       TEXT
+);
+CREATE INDEX IF NOT EXISTS jobs_state ON jobs (state, id);
+"""
+
+
+class JobQueue(object):
+    """
+    A queue of build jobs in an SQLite database.  Each thread gets its own
+    connection; claiming a job takes the database's write lock, so no two
+    workers ever run the same job.
+    """
+    def __init__(self, path):
+        self.path = os.path.abspath(path)
+        self._local = threading.local()
+        self._conn().executescript(_SCHEMA)
+
+    def _conn(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            # Transactions are begun explicitly
+            conn = sqlite3.connect(self.path, timeout=60,
+                                   isolation_level=None)
+            conn.row_factory = sqlite3.Row
+            self._local.conn = conn
+        return conn
+
+    def submit(self, kind, argv, cwd):
+        cursor = self._conn().execute(
+            'INSERT INTO jobs (kind, argv, cwd, submitted) '
+            'VALUES (?, ?, ?, ?)', (kind, json.dumps(argv), cwd, time.time()))
+        return cursor.lastrowid
+
+    def claim(self):
+        """
+        Mark the oldest queued job as running in this process and return
+        it, or return None if there are none.
+        """
+        conn = self._conn()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            job = conn.execute("SELECT * FROM jobs WHERE state = 'queued' "
+                               "ORDER BY id LIMIT 1").fetchone()
+            if job:
+                conn.execute("UPDATE jobs SET state = 'running', worker = ?, "
+                             "started = ? WHERE id = ?",
+                             (os.getpid(), time.time(), job['id']))
+            conn.execute('COMMIT')
+        except:
+            conn.execute('ROLLBACK')
+            raise
+        return job
+
+    def finish(self, job_id, exit_status, error=None):
+        if exit_status == 0:
+            state = 'succeeded'
+        elif exit_status == buildsrpm.EXIT_UNCHANGED:
+            state = 'unchanged'
+        else:
+            state = 'failed'
+        self._conn().execute(
+            'UPDATE jobs SET state = ?, finished = ?, exit_status = ?, '
+            'error = ? WHERE id = ?',
+            (state, time.time(), exit_status, error, job_id))
+
+    def requeue_orphans(self):
+        """
+        Put jobs back in the queue whose workers died while running them.
+        """
+        conn = self._conn()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            for job in conn.execute("SELECT id, worker FROM jobs "
+                                    "WHERE state = 'running'").fetchall():
+                if _process_exists(job['worker']):
+                    continue
+                logging.warning('Requeueing job %i, whose worker %i died',
+                                job['id'], job['worker'])
+                conn.execute("UPDATE jobs SET state = 'queued', "
+                             "worker = NULL, started = NULL WHERE id = ?",
+                             (job['id'],))
+            conn.execute('COMMIT')
+        except:
+            conn.execute('ROLLBACK')
+            raise
+
+    def counts(self):
+        """
+        Return the number of jobs in each state.
+        """
+        counts = dict((state, 0) for state in JOB_STATES)
+        for (state, count) in self._conn().execute(
+                'SELECT state, COUNT(*) FROM jobs GROUP BY state'):
+            counts[state] = count
+        return counts
+
+    def jobs(self, limit=None):
+        """
+        Return the most recently submitted jobs, oldest first, along with
+        how long each waited in the queue and has been running for.
+        """
+        query = 'SELECT * FROM jobs ORDER BY id DESC'
+        params = ()
+        if limit:
+            query += ' LIMIT ?'
+            params = (limit,)
+        now = time.time()
+        jobs = []
+        for row in self._conn().execute(query, params):
+            job = dict((key, row[key]) for key in row.keys())
+            job['argv'] = json.loads(job['argv'])
+            job['wait_time'] = (job['started'] or now) - job['submitted']
+            job['run_time'] = None
+            if job['started']:
+                job['run_time'] = (job['finished'] or now) - job['started']
+            jobs.append(job)
+        jobs.reverse()
+        return jobs
+
+
+class WarmState(object):
+    """
+    What a worker keeps between jobs:  repo mirrors and downloaders by the
+    cache they use, the resource gate all of its builds share, and which
+    build roots running jobs use in each chroot.
+    """
+    def __init__(self, gate):
+        self.gate = gate
+        self.slots = mocklib.ChrootSlots()
+        self.active = 0
+        self._lock = threading.Lock()
+        self._mirrors = {}
+        self._downloaders = {}
+        self._holding = False
+
+    def claim(self, queue):
+        """
+        Claim a job from the queue, counting it as active if there is one.
+        """
+        with self._lock:
+            job = queue.claim()
+            if job:
+                self.active += 1
+                self._holding = True
+            return job
+
+    def done(self):
+        with self._lock:
+            self.active -= 1
+
+    def release_if_idle(self):
+        """
+        Let mirrors be evicted again once no job is using them.
+        """
+        with self._lock:
+            if self.active or not self._holding:
+                return
+            self._holding = False
+            if self._mirrors:
+                logging.info('Idle; releasing mirrors')
+            for mirrors in self._mirrors.itervalues():
+                mirrors.release()
+
+    def mirrors(self, cache_dir, max_size=None):
+        if not cache_dir:
+            return None
+        with self._lock:
+            if cache_dir not in self._mirrors:
+                self._mirrors[cache_dir] = buildsrpm.Mirrors(
+                    cachelib.CacheDir(cache_dir, max_size=max_size))
+            return self._mirrors[cache_dir]
+
+    def downloader(self, cache_dir, max_size=None):
+        with self._lock:
+            if cache_dir not in self._downloaders:
+                cache = None
+                if cache_dir:
+                    cache = cachelib.CacheDir(cache_dir, max_size=max_size)
+                self._downloaders[cache_dir] = fetchlib.Downloader(
+                    cache=cache)
+            return self._downloaders[cache_dir]
+
+    def close(self):
+        for downloader in self._downloaders.itervalues():
+            downloader.close()
+        for mirrors in self._mirrors.itervalues():
+            mirrors.release()
+
+
+def run_job(job, warm):
+    """
+    Run a claimed job and return its exit status.
+    """
+    argv = [str(arg) for arg in json.loads(job['argv'])]
+    cwd = str(job['cwd'])
+    if job['kind'] == 'srpm':
+        (options, args) = buildsrpm.parse_cli_args(argv)
+        args = [_local_path(args[0], cwd)]
+        options.sources = [(num, _local_path(url, cwd))
+                           for (num, url) in options.sources]
+        options.fetches = [_local_path(url, cwd) for url in options.fetches]
+        if options.config:
+            options.config = _local_path(options.config, cwd)
+        for name in ('workspace', 'resultdir', 'state_file', 'trace',
+                     'mirror_cache', 'tarball_cache', 'download_cache',
+                     'srpm_cache'):
+            _join_option(options, name, cwd)
+        mirrors = warm.mirrors(options.mirror_cache,
+                               _megabytes(options.mirror_cache_size))
+        downloader = warm.downloader(options.download_cache,
+                                     _megabytes(options.download_cache_size))
+        # Jobs using mock configs get unique build roots from MockTemp
+        chroots = [options.chroot] if options.chroot else []
+        with _build_roots(warm, options, chroots):
+            return buildsrpm.run(options, args, mirrors=mirrors,
+                                 downloader=downloader)
+    else:
+        (options, args) = buildarch.parse_cli_args(argv)
+        args = [_local_path(args[0], cwd)]
+        options.configs = [_local_path(config, cwd)
+                           for config in options.configs]
+        for name in ('resultdir', 'build_cache', 'publish_repo', 'trace'):
+            _join_option(options, name, cwd)
+        with _build_roots(warm, options, options.chroots):
+            return buildarch.run(options, args, gate=warm.gate)
+
+
+@contextlib.contextmanager
+def _build_roots(warm, options, chroots):
+    # Give a job build roots that no other running job uses in its chroots
+    slot = warm.slots.acquire(chroots)
+    try:
+        options.mock_options = ' '.join(
+            options.mock_options.split() +
+            mocklib.ChrootSlots.mock_opts(slot, 'worker'))
+        yield
+    finally:
+        warm.slots.release(chroots, slot)
+
+
+def serve(queue, warm, jobs, poll, log_dir):
+    """
+    Run jobs from the queue, up to jobs at once, until interrupted, each
+    one logging to job-ID.log in log_dir.
+    """
+    queue.requeue_orphans()
+    if not os.path.isdir(log_dir):
+        os.makedirs(log_dir)
+
+    def worker():
+        while True:
+            job = warm.claim(queue)
+            if not job:
+                warm.release_if_idle()
+                time.sleep(poll)
+                continue
+            # Architecture builds wait for the gate one chroot at a time;
+            # a source RPM build is a single task, so it waits here
+            gated = job['kind'] == 'srpm'
+            if gated:
+                warm.gate.wait(poll)
+            log_path = os.path.join(log_dir, 'job-{0}.log'.format(job['id']))
+            logging.info('Starting %s job %i after waiting %.1fs; logging '
+                         'to %s', job['kind'], job['id'],
+                         time.time() - job['submitted'], log_path)
+            start = time.time()
+            try:
+                with open(log_path, 'a') as log_file, \
+                        tracelib.redirect_output(log_file):
+                    (exit_status, error) = _run_logged(job, warm)
+            finally:
+                if gated:
+                    warm.gate.release()
+                warm.done()
+            queue.finish(job['id'], exit_status, error)
+            logging.info('Finished job %i with status %i in %.1fs',
+                         job['id'], exit_status, time.time() - start)
+
+    threads = []
+    for i in range(jobs):
+        thread = threading.Thread(target=worker, name='worker-{0}'.format(i))
+        thread.daemon = True
+        thread.start()
+        threads.append(thread)
+    # Joining with a timeout keeps the main thread interruptible
+    while any(thread.is_alive() for thread in threads):
+        for thread in threads:
+            thread.join(1)
+
+
+def _run_logged(job, warm):
+    # Return the exit status of a job and what went wrong, if anything,
+    # logging any exception to the job's own log
+    try:
+        return (run_job(job, warm), None)
+    except SystemExit as err:
+        # Bad arguments, reported by optparse
+        exit_status = err.code if isinstance(err.code, int) else 1
+        return (exit_status, 'exited with status {0}'.format(exit_status))
+    except Exception as err:
+        logging.error('Job %i failed', job['id'], exc_info=sys.exc_info())
+        return (1, '{0}: {1}'.format(type(err).__name__, err))
+
+
+class _JobLogHandler(logging.StreamHandler):
+    """
+    Writes each log record to the log of the job whose thread logged it,
+    or to stdout for the worker's own records.
+    """
+    def emit(self, record):
+        # Called with the handler's lock held
+        self.stream = tracelib.output()
+        logging.StreamHandler.emit(self, record)
+
+
+def print_status(queue, limit, as_json=False):
+    counts = queue.counts()
+    jobs = queue.jobs(limit=limit)
+    if as_json:
+        json.dump({'counts': counts, 'jobs': jobs}, sys.stdout, indent=2,
+                  sort_keys=True)
+        sys.stdout.write('\n')
+        return
+    print '  '.join('{0}: {1}'.format(state, counts[state])
+                    for state in JOB_STATES)
+    if not jobs:
+        return
+    print
+    print '{0:>6}  {1:<5}  {2:<9}  {3:>8}  {4:>8}  {5}'.format(
+        'ID', 'KIND', 'STATE', 'WAIT', 'RUN', 'ARGS')
+    for job in jobs:
+        run_time = '-'
+        if job['run_time'] is not None:
+            run_time = '{0:.1f}s'.format(job['run_time'])
+        print '{0:>6}  {1:<5}  {2:<9}  {3:>8}  {4:>8}  {5}'.format(
+            job['id'], job['kind'], job['state'],
+            '{0:.1f}s'.format(job['wait_time']), run_time,
+            ' '.join(job['argv']))
+
+
+def _local_path(location, cwd):
+    """
+    Make a location relative to cwd absolute if it names something there,
+    keeping any #ref; leave URLs and everything else alone.
+    """
+    if urlparse.urlparse(location)[0] or os.path.isabs(location):
+        return location
+    (path, sep, ref) = location.partition('#')
+    if not os.path.exists(os.path.join(cwd, path)):
+        return location
+    return os.path.abspath(os.path.join(cwd, path)) + sep + ref
+
+
+def _join_option(options, name, cwd):
+    value = getattr(options, name)
+    if value:
+        setattr(options, name, os.path.join(cwd, value))
+
+
+def _megabytes(size):
+    return size and size * 1024 * 1024
+
+
+def _process_exists(pid):
+    try:
+        os.kill(pid, 0)
+    except OSError as err:
+        return err.errno != errno.ESRCH
+    return True
+
+
+def parse_cli_args():
+    usage = ('%prog [-d] -q QUEUE submit srpm|arch ARGS...\n'
+             '       %prog [-d] [-j N] -q QUEUE serve\n'
+             '       %prog [-d] [--json] -q QUEUE status')
+    parser = optparse.OptionParser(usage=usage,
+                                   version='%prog {0}'.format(__version__))
+    # Everything after the command belongs to the job
+    parser.disable_interspersed_args()
+    parser.add_option('-d', '--debug', dest='loglevel', action='store_const',
+                      const=logging.DEBUG, default=logging.INFO)
+    parser.add_option('-q', '--queue', metavar='FILE', default=None,
+                      help='SQLite database holding the job queue')
+    parser.add_option('-j', '--jobs', metavar='N', type='int', default=1,
+                      help='run up to N jobs at once (default: 1)')
+    parser.add_option('--mem-per-build', metavar='MB', type='int',
+                      default=2048, help=('only start another build while '
+                                          'this much memory is available '
+                                          '(default: 2048)'))
+    parser.add_option('--disk-per-build', metavar='MB', type='int',
+                      default=4096, help=('only start another build while '
+                                          'this much disk space is free for '
+                                          'mock (default: 4096)'))
+    parser.add_option('--log-dir', metavar='DIR', default=None,
+                      help=('write the log of each job served to '
+                            'DIR/job-ID.log (default: QUEUE.logs)'))
+    parser.add_option('--poll', metavar='SECS', type='float', default=2,
+                      help=('check for new jobs this often when idle '
+                            '(default: 2)'))
+    parser.add_option('-n', '--limit', metavar='N', type='int', default=20,
+                      help=('show the N most recent jobs in the status '
+                            '(default: 20; 0 for all)'))
+    parser.add_option('--json', action='store_true', default=False,
+                      help='print the status as JSON')
+    (options, args) = parser.parse_args()
+    if not options.queue:
+        parser.error('queue must be specified with -q')
+    if not args or args[0] not in ('submit', 'serve', 'status'):
+        parser.error('command must be one of submit, serve, or status')
+    if args[0] == 'submit':
+        if len(args) < 2 or args[1] not in JOB_KINDS:
+            parser.error('job kind must be one of ' + ', '.join(JOB_KINDS))
+    elif len(args) != 1:
+        parser.error('{0} takes no arguments'.format(args[0]))
+    return (options, args)
+
+
+def main():
+    (options, args) = parse_cli_args()
+    handler = _JobLogHandler()
+    handler.setFormatter(logging.Formatter('%(asctime)-15s [%(levelname)s] '
+                                           '%(threadName)s: %(message)s'))
+    logging.getLogger().addHandler(handler)
+    logging.getLogger().setLevel(options.loglevel)
+    queue = JobQueue(options.queue)
+
+    if args[0] == 'submit':
+        (kind, argv) = (args[1], args[2:])
+        # Catch bad arguments now rather than when the job runs
+        if kind == 'srpm':
+            buildsrpm.parse_cli_args(argv)
+        else:
+            buildarch.parse_cli_args(argv)
+        print queue.submit(kind, argv, os.getcwd())
+    elif args[0] == 'status':
+        print_status(queue, options.limit, as_json=options.json)
+    else:
+        if os.path.isdir(buildarch.MOCK_BASEDIR):
+            disk_path = buildarch.MOCK_BASEDIR
+        else:
+            disk_path = '/'
+        gate = poollib.ResourceGate(
+            mem_per_task=options.mem_per_build * 1024 * 1024,
+            disk_per_task=options.disk_per_build * 1024 * 1024,
+            disk_path=disk_path)
+        warm = WarmState(gate)
+        logging.info('Serving jobs from %s, up to %i at once', queue.path,
+                     options.jobs)
+        try:
+            serve(queue, warm, options.jobs, options.poll,
+                  options.log_dir or queue.path + '.logs')
+        except KeyboardInterrupt:
+            # Jobs left running are requeued by the next worker
+            logging.info('Interrupted; stopping')
+        finally:
+            warm.close()
+
+
+if __name__ == '__main__':
+    main()
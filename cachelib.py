@@ -0,0 +1,267 @@
+import errno
+import fcntl
+import hashlib
+import logging
+import os
+import os.path
+import shutil
+import tempfile
+
+# ioctl that makes a file share another's extents (linux/fs.h)
+_FICLONE = 0x40049409
+
+
+class FileLock(object):
+    """
+    An flock(2) lock on a file.  Shared locks may be held by many processes
+    at once; exclusive locks exclude everyone else.
+    """
+    def __init__(self, path, shared=False):
+        self.path = path
+        self.shared = shared
+        self._file = None
+
+    def acquire(self, blocking=True):
+        lockfile = open(self.path, 'a')
+        mode = fcntl.LOCK_SH if self.shared else fcntl.LOCK_EX
+        if not blocking:
+            mode |= fcntl.LOCK_NB
+        try:
+            fcntl.flock(lockfile, mode)
+        except IOError as err:
+            lockfile.close()
+            if err.errno in (errno.EAGAIN, errno.EACCES):
+                return False
+            raise
+        self._file = lockfile
+        return True
+
+    def release(self):
+        if self._file:
+            self._file.close()
+            self._file = None
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.release()
+
+
+class CacheDir(object):
+    """
+    A directory of cache entries named by key that is shared between
+    concurrent builds.  Entries are files or directories; the least recently
+    used ones are evicted once the whole store exceeds max_size bytes.
+
+    Anyone using an entry should hold a shared lock on it for as long as it
+    is in use, since eviction only removes entries it can lock exclusively.
+    """
+    def __init__(self, path, max_size=None):
+        self.path = os.path.abspath(path)
+        self.max_size = max_size
+        try:
+            os.makedirs(self.path)
+        except OSError as err:
+            if err.errno != errno.EEXIST:
+                raise
+
+    @staticmethod
+    def key_for(*parts):
+        return hashlib.sha1('\0'.join(parts)).hexdigest()
+
+    def entry_path(self, key):
+        return os.path.join(self.path, key)
+
+    def lock(self, key, shared=False, suffix='.lock'):
+        return FileLock(self.entry_path(key) + suffix, shared=shared)
+
+    def touch(self, key):
+        """
+        Mark an entry as recently used.
+        """
+        try:
+            os.utime(self.entry_path(key), None)
+        except OSError as err:
+            if err.errno != errno.ENOENT:
+                raise
+
+    def fetch_file(self, key, dest):
+        """
+        Materialize a file entry at dest.  Return False if there is no such
+        entry.
+        """
+        try:
+            link_or_copy(self.entry_path(key), dest)
+        except (IOError, OSError) as err:
+            if err.errno == errno.ENOENT:
+                return False
+            raise
+        self.touch(key)
+        return True
+
+    def store_file(self, key, src):
+        """
+        Add a file to the store as a read-only entry, then evict old entries
+        if the store has grown too large.  An entry hard-linked to src keeps
+        its permissions, which are src's too.
+        """
+        (fd, tmp_path) = self._mktemp(key, tempfile.mkstemp)
+        os.close(fd)
+        try:
+            if not link_or_copy(src, tmp_path):
+                os.chmod(tmp_path, 0444)
+            with self.lock(key):
+                os.rename(tmp_path, self.entry_path(key))
+        finally:
+            # Only there if something went wrong
+            if os.path.lexists(tmp_path):
+                os.remove(tmp_path)
+        self.evict()
+
+    def fetch_files(self, key, destdir, link=None):
+        """
+        Materialize the files of a directory entry in destdir and return
+        their names, or None if there is no such entry.  Files for which
+        link returns False are copied instead, which is how to keep
+        something that will be appended to from changing the entry.
+        """
+        entry = self.entry_path(key)
+        with self.lock(key, shared=True):
+            if not os.path.isdir(entry):
+                return None
+            if not os.path.isdir(destdir):
+                os.makedirs(destdir)
+            names = sorted(os.listdir(entry))
+            for name in names:
+                dest = os.path.join(destdir, name)
+                if link is None or link(name):
+                    link_or_copy(os.path.join(entry, name), dest)
+                else:
+                    if os.path.lexists(dest):
+                        os.remove(dest)
+                    shutil.copy2(os.path.join(entry, name), dest)
+                    os.chmod(dest, 0644)
+        self.touch(key)
+        return names
+
+    def store_files(self, key, paths, link=None):
+        """
+        Add files to the store as a read-only directory entry, replacing
+        any existing one, then evict old entries if the store has grown too
+        large.  Files for which link returns False are copied in; files
+        hard-linked in keep their permissions, as in store_file.
+        """
+        entry = self.entry_path(key)
+        tmp_path = self._mktemp(key, tempfile.mkdtemp)
+        try:
+            os.chmod(tmp_path, 0755)
+            for path in paths:
+                name = os.path.basename(path)
+                dest = os.path.join(tmp_path, name)
+                if link is None or link(name):
+                    linked = link_or_copy(path, dest)
+                else:
+                    shutil.copy2(path, dest)
+                    linked = False
+                if not linked:
+                    os.chmod(dest, 0444)
+            with self.lock(key):
+                self.remove(key)
+                os.rename(tmp_path, entry)
+        finally:
+            if os.path.isdir(tmp_path):
+                shutil.rmtree(tmp_path)
+        self.evict()
+
+    def _mktemp(self, key, make):
+        # Unique to the thread as well as the process, and with a dot in
+        # it so eviction leaves it alone
+        return make(prefix=key + '.tmp-', dir=self.path)
+
+    def remove(self, key):
+        path = self.entry_path(key)
+        if os.path.isdir(path) and not os.path.islink(path):
+            shutil.rmtree(path)
+        elif os.path.lexists(path):
+            os.remove(path)
+
+    def evict(self):
+        """
+        Remove least recently used entries until the store fits in max_size.
+        Entries that are locked by someone else are left alone.
+        """
+        if not self.max_size:
+            return
+        with FileLock(os.path.join(self.path, '.evict.lock')):
+            entries = []
+            for key in os.listdir(self.path):
+                # Lock files and in-progress temporary entries contain dots;
+                # keys never do.
+                if '.' in key:
+                    continue
+                path = self.entry_path(key)
+                try:
+                    entries.append((os.lstat(path).st_mtime, key,
+                                    _disk_usage(path)))
+                except OSError as err:
+                    # Being replaced by another store, which evicts next
+                    if err.errno != errno.ENOENT:
+                        raise
+            total = sum(entry[2] for entry in entries)
+            for (__, key, size) in sorted(entries):
+                if total <= self.max_size:
+                    break
+                entry_lock = self.lock(key)
+                if not entry_lock.acquire(blocking=False):
+                    continue
+                try:
+                    logging.info('Evicting cache entry %s',
+                                 self.entry_path(key))
+                    self.remove(key)
+                    total -= size
+                finally:
+                    entry_lock.release()
+
+
+def link_or_copy(src, dest):
+    """
+    Make dest a copy of src as cheaply as possible:  a reflink where the
+    filesystem supports them, a hard link where it does not, and a real copy
+    only when src is on a different filesystem.
+
+    Hard links share their contents and permissions, so dest must be
+    replaced rather than written to or chmodded in place.  Return True if
+    dest is a hard link to src.
+    """
+    if os.path.lexists(dest):
+        os.remove(dest)
+    with open(src, 'rb') as src_file:
+        try:
+            with open(dest, 'wb') as dest_file:
+                fcntl.ioctl(dest_file.fileno(), _FICLONE, src_file.fileno())
+            shutil.copystat(src, dest)
+            return False
+        except IOError:
+            # Not supported here; fall back to a link
+            if os.path.lexists(dest):
+                os.remove(dest)
+    try:
+        os.link(src, dest)
+        return True
+    except OSError as err:
+        if err.errno not in (errno.EXDEV, errno.EPERM, errno.EMLINK):
+            raise
+        shutil.copy2(src, dest)
+        return False
+
+
+def _disk_usage(path):
+    if not os.path.isdir(path) or os.path.islink(path):
+        return os.lstat(path).st_size
+    total = 0
+    for (dirpath, dirnames, filenames) in os.walk(path):
+        for name in dirnames + filenames:
+            total += os.lstat(os.path.join(dirpath, name)).st_size
+    return total
@@ -0,0 +1,238 @@
+import errno
+import hashlib
+import httplib
+import json
+import logging
+import os
+import os.path
+import shutil
+import socket
+import threading
+import time
+import urllib
+import urlparse
+
+import cachelib
+
+MAX_REDIRECTS = 5
+
+
+class DownloadError(RuntimeError):
+    pass
+
+
+class Downloader(object):
+    """
+    Download files over HTTP and HTTPS, reusing kept-alive connections to
+    each server, resuming interrupted transfers with Range requests, and
+    retrying failures.  Other URL schemes go through urllib.
+
+    With a cache, every download is kept in it along with its ETag,
+    Last-Modified time, and SHA-256 digest.  Later downloads of the same
+    URL send a conditional GET and, if the server says nothing changed,
+    link the cached copy into place after checking its digest.
+
+    A Downloader may be shared by several threads; each gets its own
+    connections.
+    """
+    def __init__(self, cache=None, retries=3, timeout=60):
+        self.cache = cache
+        self.retries = retries
+        self.timeout = timeout
+        self._local = threading.local()
+        self._all_conns = []
+
+    def fetch(self, url, destfile):
+        scheme = urlparse.urlparse(url)[0]
+        if scheme not in ('http', 'https') or urllib.getproxies().get(scheme):
+            logging.debug('Downloading %s with urllib', url)
+            urllib.urlretrieve(url, destfile)
+            return
+        if not self.cache:
+            self._download(url, destfile + '.part')
+            os.rename(destfile + '.part', destfile)
+            return
+        key = self.cache.key_for('download', url)
+        entry = self.cache.entry_path(key)
+        with self.cache.lock(key):
+            meta = self._read_cached_meta(entry)
+            headers = {}
+            if meta.get('etag'):
+                headers['If-None-Match'] = meta['etag']
+            if meta.get('last_modified'):
+                headers['If-Modified-Since'] = meta['last_modified']
+            partfile = entry + '.part'
+            new_meta = self._download(url, partfile, headers=headers)
+            if new_meta is None:
+                logging.info('Using cached copy of %s', url)
+                self.cache.touch(key)
+            else:
+                tmp_entry = '{0}.tmp-{1}'.format(entry, os.getpid())
+                os.mkdir(tmp_entry)
+                os.rename(partfile, os.path.join(tmp_entry, 'content'))
+                with open(os.path.join(tmp_entry, 'meta'), 'w') as meta_file:
+                    json.dump(new_meta, meta_file)
+                if os.path.exists(entry):
+                    shutil.rmtree(entry)
+                os.rename(tmp_entry, entry)
+            cachelib.link_or_copy(os.path.join(entry, 'content'), destfile)
+        self.cache.evict()
+
+    def close(self):
+        """
+        Close every thread's connections.
+        """
+        for conns in self._all_conns:
+            for conn in conns.values():
+                conn.close()
+            conns.clear()
+
+    def _read_cached_meta(self, entry):
+        """
+        Return the metadata of a cache entry if its content is intact, or
+        an empty dict if it is missing or corrupt.
+        """
+        try:
+            with open(os.path.join(entry, 'meta')) as meta_file:
+                meta = json.load(meta_file)
+            content = os.path.join(entry, 'content')
+            if (os.path.getsize(content) == meta['size'] and
+                    _sha256(content) == meta['sha256']):
+                return meta
+            logging.warn('Discarding corrupt cache entry %s', entry)
+        except (IOError, OSError, ValueError, KeyError) as err:
+            if getattr(err, 'errno', None) != errno.ENOENT:
+                logging.warn('Discarding unreadable cache entry %s: %s',
+                             entry, err)
+        if os.path.exists(entry):
+            shutil.rmtree(entry)
+        return {}
+
+    def _download(self, url, partfile, headers=None):
+        """
+        Download url into partfile, resuming from whatever partfile already
+        holds if the server allows it.  Return the new file's metadata, or
+        None if the server responded to a conditional request with 304.
+        """
+        for attempt in xrange(self.retries + 1):
+            try:
+                return self._try_download(url, partfile, headers or {})
+            except (httplib.HTTPException, socket.error, DownloadError) as err:
+                if attempt == self.retries:
+                    raise DownloadError('failed to download {0}: {1}'
+                                        .format(url, err))
+                delay = 2 ** attempt
+                logging.warn('Download of %s failed (%s); retrying in %is',
+                             url, err, delay)
+                time.sleep(delay)
+
+    def _try_download(self, url, partfile, headers):
+        # A part file can only be resumed if we know which version of the
+        # file it holds the beginning of.
+        offset = 0
+        validator = None
+        if os.path.exists(partfile + '.validator'):
+            with open(partfile + '.validator') as validator_file:
+                validator = validator_file.read()
+            if os.path.exists(partfile):
+                offset = os.path.getsize(partfile)
+        for __ in xrange(MAX_REDIRECTS + 1):
+            request_headers = dict(headers)
+            if offset:
+                request_headers['Range'] = 'bytes={0}-'.format(offset)
+                request_headers['If-Range'] = validator
+            response = self._request(url, request_headers)
+            if response.status in (301, 302, 303, 307, 308):
+                response.read()
+                url = urlparse.urljoin(url, response.getheader('Location'))
+                logging.debug('Following redirect to %s', url)
+                continue
+            break
+        else:
+            raise DownloadError('too many redirects')
+        if response.status == 304:
+            response.read()
+            return None
+        if response.status == 206:
+            logging.info('Resuming download of %s at byte %i', url, offset)
+            mode = 'ab'
+        elif response.status == 200:
+            mode = 'wb'
+            offset = 0
+            validator = response.getheader('ETag')
+            if not validator or validator.startswith('W/'):
+                # Weak ETags can't be used in If-Range
+                validator = response.getheader('Last-Modified')
+            if validator:
+                with open(partfile + '.validator', 'w') as validator_file:
+                    validator_file.write(validator)
+            elif os.path.exists(partfile + '.validator'):
+                os.remove(partfile + '.validator')
+        elif response.status == 416 and offset:
+            # The part file is no good; start over
+            response.read()
+            os.remove(partfile)
+            raise DownloadError('server rejected resume request')
+        else:
+            response.read()
+            if response.status >= 500:
+                raise DownloadError('HTTP {0} {1}'.format(response.status,
+                                                          response.reason))
+            raise IOError('failed to download {0}: HTTP {1} {2}'.format(
+                url, response.status, response.reason))
+        expected = response.getheader('Content-Length')
+        received = 0
+        with open(partfile, mode) as out:
+            while True:
+                chunk = response.read(64 * 1024)
+                if not chunk:
+                    break
+                out.write(chunk)
+                received += len(chunk)
+        if expected is not None and received != int(expected):
+            raise DownloadError('connection closed after {0} of {1} bytes'
+                                .format(received, expected))
+        if os.path.exists(partfile + '.validator'):
+            os.remove(partfile + '.validator')
+        return {'url': url,
+                'etag': response.getheader('ETag'),
+                'last_modified': response.getheader('Last-Modified'),
+                'size': os.path.getsize(partfile),
+                'sha256': _sha256(partfile)}
+
+    def _request(self, url, headers):
+        (scheme, netloc, path, params, query, __) = urlparse.urlparse(url)
+        selector = urlparse.urlunparse(('', '', path or '/', params, query,
+                                        ''))
+        conns = getattr(self._local, 'conns', None)
+        if conns is None:
+            conns = self._local.conns = {}
+            self._all_conns.append(conns)
+        for reuse in (True, False):
+            conn = conns.get((scheme, netloc))
+            if conn is None:
+                if scheme == 'https':
+                    conn = httplib.HTTPSConnection(netloc,
+                                                   timeout=self.timeout)
+                else:
+                    conn = httplib.HTTPConnection(netloc,
+                                                  timeout=self.timeout)
+                conns[(scheme, netloc)] = conn
+                reuse = False
+            try:
+                conn.request('GET', selector, headers=headers)
+                return conn.getresponse()
+            except (httplib.HTTPException, socket.error):
+                # The server may have closed a kept-alive connection
+                conn.close()
+                del conns[(scheme, netloc)]
+                if not reuse:
+                    raise
+
+
+def _sha256(filename):
+    digest = hashlib.sha256()
+    with open(filename, 'rb') as file_:
+        for chunk in iter(lambda: file_.read(1024 * 1024), ''):
+            digest.update(chunk)
+    return digest.hexdigest()
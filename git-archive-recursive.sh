@@ -10,6 +10,10 @@ git read-tree $revision
 
 export up="$(pwd)"
 
+# git submodule foreach clears GIT_* variables for the commands it runs, so
+# keep copies under other names for it to restore.
+export tmpindex="$up/$GIT_INDEX_FILE"
+
 read_one_level () {
 	export GIT_ALTERNATE_OBJECT_DIRECTORIES="$GIT_ALTERNATE_OBJECT_DIRECTORIES":$(
 	    git submodule foreach 'echo "$up/$path/.git/objects"' |
@@ -17,9 +21,12 @@ read_one_level () {
 	    tr '\n' : |
 	    sed 's/:$//'
 	)
+	export alternates="$GIT_ALTERNATE_OBJECT_DIRECTORIES"
 
 	git submodule foreach '
 		cd "$up"
+		export GIT_INDEX_FILE="$tmpindex"
+		export GIT_ALTERNATE_OBJECT_DIRECTORIES="$alternates"
 		subcommit=$(git rev-parse :"$path")
 		git rm --cached "$path"
 		git read-tree -i --prefix="$path/" $subcommit
@@ -1,67 +1,659 @@
+import ctypes
+import ctypes.util
 import datetime
+import errno
+import gzip
+import hashlib
+import itertools
+import logging
 import os
-from os.path import basename, splitext, isdir, isfile
+import re
+from os.path import basename, isdir, isfile
+import select
 import shutil
-import sys
+import signal
+import subprocess
 import tempfile
+import threading
+import time
 import urllib
+import urlparse
+import zlib
+
+import cachelib
+import fetchlib
+import tracelib
 
 DEFAULT_SITE_CONFIG    = '/etc/mock/site-defaults.cfg'
 DEFAULT_LOGGING_CONFIG = '/etc/mock/logging.ini'
+DEFAULT_CONFIG_BASE    = '/tmp/rpmfab-mock-configs'
+DEFAULT_CONFIG_DIR     = '/etc/mock'
+
+# Generated config dirs nobody has used for this long are removed, and
+# downloaded configs are kept within this many bytes
+CONFIG_MAX_AGE = 30 * 24 * 60 * 60
+CONFIG_DOWNLOADS_SIZE = 16 * 1024 * 1024
+
+# The mock to run; benchmarks and tests point this at a stand-in
+MOCK = os.environ.get('RPMFAB_MOCK', '/usr/bin/mock')
+
+# Distinguishes the build roots of MockTemps in the same process
+_uniqueext_counter = itertools.count(1)
+
+# Mock -v marks the phases of a run with lines such as
+# "INFO: Start(bootstrap): chroot init" and "INFO: Finish: rpmbuild foo"
+_PHASE_RE = re.compile(r'^[A-Z]+: (Start|Finish)(?:\([^)]*\))?: (.+?)\s*$')
+
+# Mock configs include() other configs, relative ones from the directory
+# config_opts['config_path'] names
+_INCLUDE_RE = re.compile(r'''include\(\s*['"]([^'"]+)['"]''')
+_CONFIG_PATH_RE = re.compile(
+    r'''config_opts\[\s*['"]config_path['"]\s*\]\s*=\s*['"]([^'"]+)['"]''')
+
+# How long mock gets to clean up after being told to stop
+_KILL_GRACE = 30
+
+# How long output is still read after mock exits, for when something it
+# started keeps its stdout open and writing
+_DRAIN_TIME = 5
+
+# Plain logs are punched out once this much of them has been compressed
+_PUNCH_SIZE = 4 * 1024 * 1024
+
+# The logs mock writes to its result dir
+_MOCK_LOGS = ('build.log', 'root.log', 'state.log', 'hw_info.log')
+
+# fallocate(2) flags, for freeing the parts of logs already compressed
+_FALLOC_FL_KEEP_SIZE = 1
+_FALLOC_FL_PUNCH_HOLE = 2
+try:
+    _fallocate = ctypes.CDLL(ctypes.util.find_library('c'),
+                             use_errno=True).fallocate64
+    _fallocate.argtypes = [ctypes.c_int, ctypes.c_int, ctypes.c_int64,
+                           ctypes.c_int64]
+except (AttributeError, OSError):
+    _fallocate = None
+
+# Downloaders of configs fetched over HTTP, by config base, shared by every
+# MockTemp in the process so that callers running many builds keep their
+# connections open
+_config_downloaders = {}
+_config_downloaders_lock = threading.Lock()
+
+
+def config_digest(chroot, configdir=None):
+    """
+    Return a hash of everything mock reads to set up a chroot:  its config,
+    the configs and templates that includes, and the site defaults.  chroot
+    is a name in configdir or a path to a config file.
+    """
+    configdir = configdir or DEFAULT_CONFIG_DIR
+    if chroot.endswith('.cfg'):
+        configs = [chroot]
+    else:
+        configs = [os.path.join(configdir, chroot + '.cfg')]
+    configs.append(os.path.join(configdir, 'site-defaults.cfg'))
+    # Where relative includes are, unless a config says otherwise, as the
+    # ones MockTemp writes for mock's own chroots do
+    include_dir = configdir
+    digest = hashlib.sha1()
+    seen = set()
+    while configs:
+        config = configs.pop(0)
+        if config in seen:
+            continue
+        seen.add(config)
+        digest.update(config + '\0')
+        if not isfile(config):
+            continue
+        with open(config) as config_file:
+            data = config_file.read()
+        digest.update(data + '\0')
+        config_path = _CONFIG_PATH_RE.search(data)
+        if config_path:
+            include_dir = config_path.group(1)
+        for include in _INCLUDE_RE.findall(data):
+            configs.append(os.path.join(include_dir, include))
+    return digest.hexdigest()
+
+
+def output_opts(mock_opts):
+    """
+    Return the mock options that can change what a build produces, leaving
+    out those that only say where the config is, name the build root, or
+    change how much mock logs.
+    """
+    opts = []
+    skip_next = False
+    for opt in mock_opts:
+        if skip_next:
+            skip_next = False
+        elif opt in ('--configdir', '--uniqueext'):
+            skip_next = True
+        elif (opt.startswith('--configdir=') or
+              opt.startswith('--uniqueext=') or
+              opt in ('-v', '--verbose', '-q', '--quiet')):
+            continue
+        else:
+            opts.append(opt)
+    return opts
+
+
+class MockTimeout(RuntimeError):
+    """
+    Mock spent longer in a phase than it was allowed to and was killed.
+    """
+
+
+def parse_timeouts(specs):
+    """
+    Turn a list of PHASE=SECONDS strings into a dict for run_mock.
+    """
+    timeouts = {}
+    for spec in specs:
+        (phase, sep, secs) = spec.rpartition('=')
+        try:
+            timeouts[phase] = float(secs)
+        except ValueError:
+            sep = None
+        if not sep or not phase or timeouts[phase] <= 0:
+            raise ValueError('timeout {0!r} must have form PHASE=SECONDS'
+                             .format(spec))
+    return timeouts
+
+
+def run_mock(args, timeouts=None, logdir=None, compress_logs=False,
+             cancel=None):
+    """
+    Run mock, passing its output through as it comes, and log how long each
+    phase of the run took as it finishes.  Errors mock reports are logged
+    as soon as it reports them.
+
+    timeouts maps the start of phase names, as in mock's "Start: chroot
+    init" lines, to how many seconds any phase whose name starts that way
+    may take; "total" limits the whole run.  Mock and everything it started
+    are killed as soon as one runs over, and MockTimeout is raised.
+    Otherwise CalledProcessError is raised if mock fails, or if cancel, a
+    threading.Event, is set while it runs, which kills it the same way.
+
+    With compress_logs, the logs mock writes to logdir are compressed as
+    they grow and end up as NAME.log.gz instead of NAME.log.
+    """
+    timeouts = timeouts or {}
+    compressor = None
+    if compress_logs:
+        compressor = LogCompressor(logdir)
+    logging.debug("Executing ``%s''", ' '.join(args))
+    start = time.time()
+    # Mock gets its own process group so the whole build can be killed
+    proc = subprocess.Popen(args, stdout=subprocess.PIPE,
+                            stderr=subprocess.STDOUT, preexec_fn=os.setsid)
+    phases = []
+    errors = []
+    pending = ''
+    overrun = None
+    last_poll = 0
+    exited = None
+    try:
+        while True:
+            now = time.time()
+            overrun = _overrun_phase(phases, start, now, timeouts)
+            if overrun or (cancel and cancel.is_set()):
+                break
+            if compressor and now - last_poll >= 1:
+                compressor.poll()
+                last_poll = now
+            # Once mock has exited, only read what is already in the pipe:
+            # anything it left running may hold the pipe open for good
+            if exited is None and proc.poll() is not None:
+                exited = now
+            if exited is not None and now - exited >= _DRAIN_TIME:
+                break
+            timeout = 0 if exited is not None else 1
+            if not select.select([proc.stdout], [], [], timeout)[0]:
+                if exited is not None:
+                    break
+                continue
+            data = os.read(proc.stdout.fileno(), 65536)
+            if not data:
+                break
+            output = tracelib.output()
+            output.write(data)
+            output.flush()
+            lines = (pending + data).split('\n')
+            pending = lines.pop()
+            for line in lines:
+                _handle_mock_line(line, phases, errors, timeouts)
+        if overrun:
+            logging.error('Mock phase %s took longer than %gs; killing it',
+                          overrun[0], overrun[1])
+            _kill_group(proc)
+        elif cancel and cancel.is_set():
+            _kill_group(proc)
+        else:
+            proc.wait()
+    finally:
+        if proc.returncode is None:
+            _kill_group(proc)
+        proc.stdout.close()
+        if compressor:
+            compressor.close()
+    if overrun:
+        raise MockTimeout('mock phase {0!r} took longer than {1:g}s'
+                          .format(*overrun))
+    if proc.returncode:
+        raise subprocess.CalledProcessError(proc.returncode, ' '.join(args),
+                                            output='\n'.join(errors))
+
+
+def _handle_mock_line(line, phases, errors, timeouts):
+    match = _PHASE_RE.match(line)
+    if line.startswith('ERROR: '):
+        if not errors:
+            logging.error('Mock failed: %s', line[len('ERROR: '):])
+        errors.append(line)
+    elif match and match.group(1) == 'Start':
+        name = match.group(2)
+        limit = None
+        for (prefix, secs) in timeouts.iteritems():
+            if prefix != 'total' and name.startswith(prefix):
+                limit = secs if limit is None else min(limit, secs)
+        phases.append((name, time.time(), limit))
+    elif match:
+        name = match.group(2)
+        # Phases nest, but a phase mock never finished shouldn't stop the
+        # ones around it from being timed
+        for i in xrange(len(phases) - 1, -1, -1):
+            if phases[i][0] == name:
+                (__, started, __) = phases.pop(i)
+                now = time.time()
+                logging.info('Mock phase %s took %.1fs', name, now - started)
+                tracelib.record(name, started, now, cat='mock')
+                break
+
+
+def _overrun_phase(phases, start, now, timeouts):
+    # Return the name and limit of a phase that has run too long, if any
+    if 'total' in timeouts and now - start > timeouts['total']:
+        return ('total', timeouts['total'])
+    for (name, started, limit) in phases:
+        if limit is not None and now - started > limit:
+            return (name, limit)
+    return None
+
+
+def _kill_group(proc):
+    for sig in (signal.SIGTERM, signal.SIGKILL):
+        try:
+            os.killpg(proc.pid, sig)
+        except OSError as err:
+            if err.errno != errno.ESRCH:
+                raise
+        deadline = time.time() + _KILL_GRACE
+        while proc.poll() is None and time.time() < deadline:
+            time.sleep(0.1)
+        if proc.returncode is not None:
+            return
+    proc.wait()
+
+
+class LogCompressor(object):
+    """
+    Compresses the logs mock writes to a directory while it appends to
+    them, leaving NAME.log.gz in place of each NAME.log when closed, and
+    leaves other files there alone.  Where the filesystem allows, the parts
+    of the plain logs that have been compressed are freed as it goes, so
+    logs never take up much more disk than their compressed size.
+    """
+    def __init__(self, logdir):
+        self.logdir = logdir
+        self._logs = {}
+        # Logs left by an earlier run would be compressed in with this one
+        for name in _MOCK_LOGS:
+            if os.path.lexists(os.path.join(logdir, name)):
+                os.remove(os.path.join(logdir, name))
+
+    def poll(self):
+        """
+        Compress whatever has been added to the logs since the last poll.
+        """
+        for name in _MOCK_LOGS:
+            path = os.path.join(self.logdir, name)
+            log = self._logs.get(path)
+            if not log:
+                if not os.path.exists(path):
+                    continue
+                log = self._logs[path] = self._open(path)
+            self._compress(log)
+
+    def close(self):
+        self.poll()
+        for (path, log) in self._logs.iteritems():
+            log['gzip'].close()
+            log['gzip_file'].close()
+            log['file'].close()
+            os.remove(path)
+        self._logs = {}
+
+    def _open(self, path):
+        gz_path = path + '.gz'
+        # Never write into a file that may be linked to a cache entry
+        if os.path.lexists(gz_path):
+            os.remove(gz_path)
+        gzip_file = open(gz_path, 'wb')
+        # Freeing space needs the log open for writing, which it may not be
+        try:
+            (log_file, punched) = (open(path, 'r+b'), 0)
+        except IOError:
+            (log_file, punched) = (open(path, 'rb'), None)
+        return {'file': log_file, 'gzip_file': gzip_file,
+                'gzip': gzip.GzipFile(basename(path), 'wb', 9, gzip_file),
+                'punched': punched}
+
+    def _compress(self, log):
+        while True:
+            data = log['file'].read(1024 * 1024)
+            if not data:
+                break
+            log['gzip'].write(data)
+        offset = log['file'].tell()
+        if (_fallocate and log['punched'] is not None and
+                offset - log['punched'] >= _PUNCH_SIZE):
+            # Only free what is safely in the compressed log
+            log['gzip'].flush(zlib.Z_SYNC_FLUSH)
+            if _fallocate(log['file'].fileno(),
+                          _FALLOC_FL_PUNCH_HOLE | _FALLOC_FL_KEEP_SIZE,
+                          0, offset) == 0:
+                log['punched'] = offset
+
+
+class BackgroundInit(object):
+    """
+    Runs mock --init for a chroot in the background, so that its build root
+    is ready by the time a build wants it.  Builds that wait for it must
+    pass --no-clean to mock to use that root rather than making a new one.
+    mock_opts must be the same as the build's, since they can name the
+    config dir and build root.
+
+    Mock runs through run_mock, in a thread, so its output and phases are
+    logged and timeouts apply as they do for builds.
+    """
+    def __init__(self, chroot, mock_opts=None, timeouts=None):
+        self.chroot = chroot
+        args = [MOCK, '-r', chroot]
+        args.extend(mock_opts or [])
+        args.append('--init')
+        logging.info('Initializing chroot %s in the background', chroot)
+        self._error = None
+        self._cancel = threading.Event()
+        self._thread = threading.Thread(target=tracelib.carry(self._run),
+                                        args=(args, timeouts),
+                                        name='init-' + chroot)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _run(self, args, timeouts):
+        try:
+            run_mock(args, timeouts=timeouts, cancel=self._cancel)
+        except Exception as err:
+            self._error = err
+
+    def wait(self):
+        """
+        Wait for the build root to be ready, raising CalledProcessError (or
+        MockTimeout) if mock failed to set it up.
+        """
+        self._thread.join()
+        if self._error:
+            raise self._error
+        logging.info('Chroot %s is initialized', self.chroot)
+
+    def cancel(self):
+        """
+        Stop initializing the build root if it is no longer needed, killing
+        mock and everything it started, which would otherwise hold on to
+        the build root.
+        """
+        if self._thread.is_alive():
+            logging.info('Cancelling initialization of chroot %s',
+                         self.chroot)
+            self._cancel.set()
+            self._thread.join()
+
+
+class ChrootSlots(object):
+    """
+    Hands out build roots in each chroot so concurrent builds in the same
+    chroot don't collide.  Slot 0 is mock's usual build root; the others
+    are separate build roots that share its caches through --uniqueext.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._in_use = {}
+
+    def acquire(self, chroots):
+        """
+        Take the lowest slot that is free in every one of chroots, for a
+        build that uses the same mock options in each of them.
+        """
+        with self._lock:
+            in_use = [self._in_use.setdefault(chroot, set())
+                      for chroot in chroots]
+            slot = 0
+            while any(slot in slots for slots in in_use):
+                slot += 1
+            for slots in in_use:
+                slots.add(slot)
+            return slot
+
+    def release(self, chroots, slot):
+        with self._lock:
+            for chroot in chroots:
+                self._in_use[chroot].discard(slot)
+
+    @staticmethod
+    def mock_opts(slot, prefix):
+        """
+        Return the mock options that select a slot's build root.
+        """
+        if not slot:
+            return []
+        return ['--uniqueext', '{0}{1}'.format(prefix, slot)]
 
 
 class MockTemp(object):
-    def __init__(self, logging, mock_opts=[]):
+    """
+    Generated mock config dirs that live in config_base, shared between
+    runs.  Each is named after a hash of the config, site defaults, and
+    logging config it holds, so every run with the same config uses the
+    same chroot name and therefore mock's root, package, and ccache caches.
+    Dirs that no run has used for CONFIG_MAX_AGE seconds are removed.
+    """
+    def __init__(self, logging, mock_opts=[], config_base=None):
         # Create mock tempfiles
         self.logging = logging
         self.mock_opts = mock_opts
+        self.config_base = config_base or DEFAULT_CONFIG_BASE
         self.config_tempdir = None
         self.config_tempfile = None
+        self.chroot = None
+        self._build_lock = None
+        self._use_lock = None
 
-    def apply_config(self, config):
+    def apply_config(self, config, extra_config=None):
+        """
+        Set up a mock config dir for a config file or url, with
+        extra_config appended to the config if given.
+        """
         self.cleanup()
         self.config = config
-        self.config_tempdir = tempfile.mkdtemp(prefix='rpmfab-', dir='/tmp')
-        self.config_tempfile = tempfile.NamedTemporaryFile(
-            prefix='mock-', suffix='.cfg', dir=self.config_tempdir)
-
-        # Write config file data to temp file
+        self._make_config_base()
         self.logging.info("reading config file '%s'" % (self.config))
-        config_file = urllib.urlopen(self.config)
-        self.config_tempfile.write(config_file.read())
-        self.config_tempfile.flush()
-        config_file.close()
-        self.logging.info("created temporary mock config '{0}'"
-                          .format(self.config_tempfile.name))
-
-        # Add default config files
+        config_data = self._read_config(self.config)
+        self._apply_config_data(config_data, extra_config)
+
+    def apply_chroot(self, chroot, extra_config=None):
+        """
+        Set up a mock config dir for one of mock's own chroots with
+        extra_config appended to its config.
+        """
+        self.cleanup()
+        self.config = chroot
+        self._make_config_base()
+        # Make the chroot's own relative includes resolve where they always
+        # do
+        config_data = ("config_opts['config_path'] = {0!r}\n"
+                       "include({1!r})\n").format(
+            DEFAULT_CONFIG_DIR,
+            os.path.join(DEFAULT_CONFIG_DIR, chroot + '.cfg'))
+        self._apply_config_data(config_data, extra_config)
+
+    def _make_config_base(self):
+        if not isdir(self.config_base):
+            try:
+                os.makedirs(self.config_base)
+            except OSError:
+                if not isdir(self.config_base):
+                    raise
+
+    def _apply_config_data(self, config_data, extra_config):
+        if extra_config:
+            config_data += '\n' + extra_config
         if isfile(DEFAULT_SITE_CONFIG):
-            shutil.copy2(DEFAULT_SITE_CONFIG, self.config_tempdir)
+            with open(DEFAULT_SITE_CONFIG) as site_file:
+                site_data = site_file.read()
         else:
-            MockTemp._generate_default_config(self.config_tempdir)
+            site_data = MockTemp._default_config_data()
         if isfile(DEFAULT_LOGGING_CONFIG):
-            shutil.copy2(DEFAULT_LOGGING_CONFIG, self.config_tempdir)
+            logging_config = DEFAULT_LOGGING_CONFIG
         else:
-            shutil.copy2('logging.ini', self.config_tempdir)
+            logging_config = 'logging.ini'
+        with open(logging_config) as logging_file:
+            logging_data = logging_file.read()
 
-        MockTemp._set_old_filetime(self.config_tempfile.name)
-        MockTemp._set_old_filetime(os.path.join(self.config_tempdir,
-                                                'logging.ini'))
-        MockTemp._set_old_filetime(os.path.join(self.config_tempdir,
-                                                'site-defaults.cfg'))
+        digest = hashlib.sha1('\0'.join((config_data, site_data,
+                                          logging_data))).hexdigest()
+        self.chroot = 'rpmfab-' + digest[:16]
+        self.config_tempdir = os.path.join(self.config_base, self.chroot)
+        self.config_tempfile = os.path.join(self.config_tempdir,
+                                            self.chroot + '.cfg')
+        created = False
+        with cachelib.FileLock(self.config_tempdir + '.create'):
+            if isdir(self.config_tempdir):
+                self.logging.info("reusing mock config '{0}'"
+                                  .format(self.config_tempfile))
+                # How _prune_config_dirs tells it is still used
+                os.utime(self.config_tempdir, None)
+            else:
+                self._create_config_dir(config_data, site_data,
+                                        logging_data)
+                self.logging.info("created mock config '{0}'"
+                                  .format(self.config_tempfile))
+                created = True
+            self._use_lock = cachelib.FileLock(self.config_tempdir + '.use',
+                                               shared=True)
+            self._use_lock.acquire()
+        if created:
+            self._prune_config_dirs()
 
         # Must set configdir to find temporary mock config file
         # Inserting at the front since newer versions of mock
         # require this.
         self.mock_opts.insert(0, '--configdir')
         self.mock_opts.insert(1, self.config_tempdir)
-        self.chroot = splitext(basename(self.config_tempfile.name))[0]
+        # Mock refuses to use a build root that another build has locked.
+        # Concurrent builds with the same config get their own build roots
+        # with --uniqueext, which still share the caches of the chroot.
+        self._build_lock = cachelib.FileLock(self.config_tempdir + '.build')
+        if not self._build_lock.acquire(blocking=False):
+            self._build_lock = None
+            uniqueext = 'pid{0}-{1}'.format(os.getpid(),
+                                            next(_uniqueext_counter))
+            self.logging.info("chroot '{0}' is in use; using unique "
+                              "extension '{1}'".format(self.chroot,
+                                                       uniqueext))
+            self.mock_opts[2:2] = ['--uniqueext', uniqueext]
 
     def cleanup(self):
-        if self.config_tempfile:
-            self.config_tempfile.close()
-        if self.config_tempdir:
-            shutil.rmtree(self.config_tempdir)
+        # Config dirs are shared, so leave them for the next run
+        if self._build_lock:
+            self._build_lock.release()
+            self._build_lock = None
+        if self._use_lock:
+            self._use_lock.release()
+            self._use_lock = None
+
+    def _prune_config_dirs(self):
+        """
+        Remove the config dirs in config_base that have gone unused for
+        CONFIG_MAX_AGE seconds, unless a run is using them right now.
+        """
+        cutoff = time.time() - CONFIG_MAX_AGE
+        for name in os.listdir(self.config_base):
+            path = os.path.join(self.config_base, name)
+            # Lock files and temporary dirs have dots in their names
+            if (not name.startswith('rpmfab-') or '.' in name or
+                    not isdir(path) or os.stat(path).st_mtime >= cutoff):
+                continue
+            with cachelib.FileLock(path + '.create'):
+                use_lock = cachelib.FileLock(path + '.use')
+                if not use_lock.acquire(blocking=False):
+                    continue
+                try:
+                    self.logging.info("removing unused mock config dir "
+                                      "'{0}'".format(path))
+                    shutil.rmtree(path)
+                    # Nobody can be waiting for these, unlike .create
+                    for suffix in ('.use', '.build'):
+                        if os.path.lexists(path + suffix):
+                            os.remove(path + suffix)
+                finally:
+                    use_lock.release()
+
+    def _read_config(self, config):
+        """
+        Return the contents of a config file or URL.  Configs fetched over
+        HTTP are cached and only downloaded again when they change.
+        """
+        if urlparse.urlparse(config)[0] not in ('http', 'https'):
+            config_file = urllib.urlopen(config)
+            try:
+                return config_file.read()
+            finally:
+                config_file.close()
+        with _config_downloaders_lock:
+            downloader = _config_downloaders.get(self.config_base)
+            if not downloader:
+                cache = cachelib.CacheDir(
+                    os.path.join(self.config_base, 'downloads'),
+                    max_size=CONFIG_DOWNLOADS_SIZE)
+                downloader = fetchlib.Downloader(cache=cache)
+                _config_downloaders[self.config_base] = downloader
+        (fd, tmp_path) = tempfile.mkstemp(prefix='config-', suffix='.tmp',
+                                          dir=self.config_base)
+        os.close(fd)
+        try:
+            downloader.fetch(config, tmp_path)
+            with open(tmp_path) as config_file:
+                return config_file.read()
+        finally:
+            os.remove(tmp_path)
+
+    def _create_config_dir(self, config_data, site_data, logging_data):
+        # Build the dir on the side and rename it into place so other runs
+        # never see it half written
+        tmp_dir = '{0}.tmp-{1}'.format(self.config_tempdir, os.getpid())
+        if isdir(tmp_dir):
+            shutil.rmtree(tmp_dir)
+        os.mkdir(tmp_dir)
+        for (name, data) in [(basename(self.config_tempfile), config_data),
+                             ('site-defaults.cfg', site_data),
+                             ('logging.ini', logging_data)]:
+            path = os.path.join(tmp_dir, name)
+            with open(path, 'wb') as file_:
+                file_.write(data)
+            MockTemp._set_old_filetime(path)
+        os.rename(tmp_dir, self.config_tempdir)
 
     @staticmethod
     def _set_old_filetime(file):
@@ -75,12 +667,8 @@ class MockTemp(object):
         os.utime(file, (float(utime_secs), float(utime_secs)))
 
     @staticmethod
-    def _generate_default_config(dir):
-        config_filename = os.path.join(dir, 'site-defaults.cfg')
-        f = open(config_filename, 'wb')
-        f.write("""# Generated config file
+    def _default_config_data():
+        return """# Generated config file
 # DO NOT EDIT
 config_opts['plugin_conf']['yum_repo_enable'] = True
-    """)
-        f.close()
-        return config_filename
+    """
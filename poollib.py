@@ -0,0 +1,259 @@
+import logging
+import multiprocessing
+import os
+import Queue
+import sys
+import threading
+import time
+
+import tracelib
+
+
+class TaskFailures(RuntimeError):
+    """
+    One or more tasks run by run_tasks failed.  failures is a list of
+    (name, exception) pairs.
+    """
+    def __init__(self, failures):
+        RuntimeError.__init__(self, '{0} task(s) failed: {1}'.format(
+            len(failures), ', '.join(name for (name, __) in failures)))
+        self.failures = failures
+
+
+class ResourceGate(object):
+    """
+    Decides whether the machine has room to start another task, given
+    roughly how much memory and disk space (in bytes, on the filesystem
+    that holds disk_path) each task needs and whether the CPUs are already
+    busy.
+
+    Tasks that started less than settle_time seconds ago may not have used
+    their share of memory and disk yet, so their shares are held back from
+    what is free.
+
+    A gate may be shared by several threads, and by several jobs each
+    running tasks of their own.  Every task it admits counts as running
+    until it is released, and a task is always admitted when no others are
+    running, since otherwise nothing would ever free up the resources the
+    gate is waiting for.
+    """
+    def __init__(self, mem_per_task=0, disk_per_task=0, disk_path='/',
+                 settle_time=30):
+        self.mem_per_task = mem_per_task
+        self.disk_per_task = disk_per_task
+        self.disk_path = disk_path
+        self.settle_time = settle_time
+        self.running = 0
+        self._start_times = []
+        self._lock = threading.Lock()
+
+    def admit(self):
+        """
+        Return True and count a new task as running if there is room for
+        it, or False if it should wait.
+        """
+        with self._lock:
+            if self.running and not self._admit():
+                return False
+            self._start_times.append(time.time())
+            self.running += 1
+            return True
+
+    def wait(self, poll=5):
+        """
+        Block until a new task is admitted.
+        """
+        while not self.admit():
+            time.sleep(poll)
+
+    def release(self):
+        """
+        Count an admitted task as finished.
+        """
+        with self._lock:
+            self.running -= 1
+
+    def _admit(self):
+        now = time.time()
+        self._start_times = [start for start in self._start_times
+                             if now - start < self.settle_time]
+        starting = len(self._start_times) + 1
+        if os.getloadavg()[0] >= multiprocessing.cpu_count():
+            logging.debug('Waiting for load average to drop')
+            return False
+        if self.mem_per_task:
+            if mem_available() < self.mem_per_task * starting:
+                logging.debug('Waiting for memory to free up')
+                return False
+        if self.disk_per_task:
+            if disk_free(self.disk_path) < self.disk_per_task * starting:
+                logging.debug('Waiting for disk space on %s to free up',
+                              self.disk_path)
+                return False
+        return True
+
+
+def mem_available():
+    """
+    Return how many bytes of memory can be used without swapping.
+    """
+    with open('/proc/meminfo') as meminfo:
+        fields = dict(line.split(':', 1) for line in meminfo)
+    if 'MemAvailable' in fields:
+        return int(fields['MemAvailable'].split()[0]) * 1024
+    # Kernels older than 3.14 don't estimate it for us
+    return sum(int(fields[field].split()[0]) * 1024
+               for field in ('MemFree', 'Buffers', 'Cached'))
+
+
+def disk_free(path):
+    stat = os.statvfs(path)
+    return stat.f_bavail * stat.f_frsize
+
+
+def run_tasks(tasks, jobs=1, gate=None):
+    """
+    Run a list of (name, func, args) tasks using up to jobs threads.
+
+    With one job the tasks run in order in the calling thread and the first
+    failure propagates as it is.  Otherwise every task gets to run, each one
+    in a thread named after it so log messages say which task they came
+    from, and any failures are collected into a single TaskFailures.
+
+    If a ResourceGate is given, every task waits until it admits them.
+    """
+    if jobs <= 1 or len(tasks) <= 1:
+        for (name, func, args) in tasks:
+            if gate:
+                gate.wait()
+            _run_task(name, func, args, gate)
+        return
+    queue = Queue.Queue()
+    for task in tasks:
+        queue.put(task)
+    failures = []
+    cond = threading.Condition()
+
+    def worker():
+        while True:
+            with cond:
+                while gate and not queue.empty() and not gate.admit():
+                    cond.wait(5)
+                try:
+                    (name, func, args) = queue.get_nowait()
+                except Queue.Empty:
+                    return
+            threading.current_thread().name = name
+            try:
+                _run_task(name, func, args, gate)
+            except Exception:
+                logging.error('%s failed', name, exc_info=sys.exc_info())
+                failures.append((name, sys.exc_info()[1]))
+            with cond:
+                cond.notify_all()
+
+    threads = [threading.Thread(target=tracelib.carry(worker))
+               for __ in xrange(min(jobs, len(tasks)))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    if failures:
+        raise TaskFailures(failures)
+
+
+def run_dag(tasks, deps, jobs=1, gate=None):
+    """
+    Run a list of (name, func, args) tasks using up to jobs threads, each
+    one starting as soon as all of the tasks it depends on have succeeded.
+    deps maps task names to the names of the tasks they depend on.  Ready
+    tasks start in the order they are listed.
+
+    Every task runs in a thread named after it.  Tasks that fail, and the
+    tasks that depend on them, which never run, are collected into a single
+    TaskFailures.  A ResourceGate works as it does for run_tasks.
+    """
+    names = set(name for (name, __, __) in tasks)
+    waiting_on = dict((name, set(deps.get(name, ())) & names)
+                      for name in names)
+    _check_acyclic(waiting_on)
+    pending = list(tasks)
+    failed = set()
+    failures = []
+    cond = threading.Condition()
+
+    def next_task():
+        # Called with cond held; returns None once there is nothing left
+        while pending:
+            for task in pending[:]:
+                if waiting_on[task[0]] & failed:
+                    pending.remove(task)
+                    failed.add(task[0])
+                    bad = sorted(waiting_on[task[0]] & failed)
+                    logging.error('Skipping %s because %s failed', task[0],
+                                  ', '.join(bad))
+                    failures.append((task[0], RuntimeError(
+                        'dependency failed: ' + ', '.join(bad))))
+            ready = [task for task in pending if not waiting_on[task[0]]]
+            if ready and (not gate or gate.admit()):
+                pending.remove(ready[0])
+                return ready[0]
+            if pending:
+                cond.wait(5)
+        return None
+
+    def worker():
+        while True:
+            with cond:
+                task = next_task()
+            if task is None:
+                return
+            (name, func, args) = task
+            threading.current_thread().name = name
+            try:
+                _run_task(name, func, args, gate)
+            except Exception:
+                logging.error('%s failed', name, exc_info=sys.exc_info())
+                with cond:
+                    failed.add(name)
+                    failures.append((name, sys.exc_info()[1]))
+            with cond:
+                for waiting in waiting_on.itervalues():
+                    if name not in failed:
+                        waiting.discard(name)
+                cond.notify_all()
+
+    threads = [threading.Thread(target=tracelib.carry(worker))
+               for __ in xrange(max(1, min(jobs, len(tasks))))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    if failures:
+        raise TaskFailures(failures)
+
+
+def _run_task(name, func, args, gate):
+    # The gate has already admitted the task
+    try:
+        with tracelib.span(name, cat='task'):
+            func(*args)
+    finally:
+        if gate:
+            gate.release()
+
+
+def _check_acyclic(waiting_on):
+    # Repeatedly remove tasks with nothing left to wait on; whatever can't
+    # be removed is part of a cycle.
+    remaining = dict((name, set(names))
+                     for (name, names) in waiting_on.iteritems())
+    while remaining:
+        free = [name for (name, names) in remaining.iteritems() if not names]
+        if not free:
+            raise ValueError('dependency cycle among: ' +
+                             ', '.join(sorted(remaining)))
+        for name in free:
+            del remaining[name]
+        for names in remaining.itervalues():
+            names.difference_update(free)
@@ -0,0 +1,150 @@
+import contextlib
+import errno
+import logging
+import os
+import os.path
+import shutil
+import tempfile
+import threading
+
+RAM_BASEDIR = '/dev/shm'
+
+
+class RAMWorkspace(object):
+    """
+    A scratch directory in tmpfs for the parts of a workspace that are
+    mostly small files, which a slow disk handles worst.  Whatever is put
+    in it is kept within a budget of bytes by settle, which moves the
+    largest items out to the same place under disk_dir, leaving symlinks
+    behind so their paths keep working.
+
+    Everything still in RAM is discarded by close.
+    """
+    def __init__(self, disk_dir, budget):
+        self.disk_dir = os.path.abspath(disk_dir)
+        self.budget = budget
+        self.peak = 0
+        self.spilled = []
+        self._reserved = 0
+        self._lock = threading.Lock()
+        # Without tmpfs this is just part of the workspace on disk
+        self.in_ram = os.path.isdir(RAM_BASEDIR)
+        if not self.in_ram:
+            logging.warn('No %s; not keeping the workspace in RAM',
+                         RAM_BASEDIR)
+        self.path = tempfile.mkdtemp(
+            prefix='rpmfab-workspace-',
+            dir=RAM_BASEDIR if self.in_ram else self.disk_dir)
+
+    def usage(self):
+        """
+        Return how many bytes the items in RAM take up now, and remember
+        the most they have taken.
+        """
+        usage = disk_usage(self.path)
+        with self._lock:
+            self.peak = max(self.peak, usage)
+        return usage
+
+    @contextlib.contextmanager
+    def place(self, disk_dir, size=None):
+        """
+        Yield where a new item of about size bytes should be written inside
+        the with statement:  in RAM if it fits in what is left of the
+        budget, counting what the other items being written then are
+        expected to take, or else disk_dir.  Items of unknown size go in
+        RAM while any of the budget is left.
+        """
+        usage = self.usage() if self.in_ram else None
+        with self._lock:
+            fits = (self.in_ram and
+                    usage + self._reserved + (size or 0) < self.budget)
+            if fits:
+                self._reserved += size or 0
+        try:
+            yield self.path if fits else disk_dir
+        finally:
+            if fits:
+                with self._lock:
+                    self._reserved -= size or 0
+
+    def settle(self, paths):
+        """
+        Move items among paths (files or directories) out to disk, largest
+        first, until what is in RAM fits in the budget again.  Return the
+        paths of the ones that were moved.
+        """
+        usage = self.usage()
+        if not self.in_ram:
+            return []
+        sizes = sorted(((disk_usage(path), path) for path in paths
+                        if self._in_ram(path)), reverse=True)
+        moved = []
+        for (size, path) in sizes:
+            if usage <= self.budget:
+                break
+            moved.append(self.spill(path, size))
+            usage -= size
+        return moved
+
+    def spill(self, path, size=None):
+        """
+        Move an item out of RAM to disk, leaving a symlink to it, and return
+        its new path.
+        """
+        dest = os.path.join(self.disk_dir, os.path.relpath(path, self.path))
+        logging.info('Moving %s (%.1f MiB) to %s to stay within the RAM '
+                     'workspace budget', path,
+                     (size or disk_usage(path)) / 1048576.0, dest)
+        if os.path.lexists(dest):
+            if os.path.isdir(dest) and not os.path.islink(dest):
+                shutil.rmtree(dest)
+            else:
+                os.remove(dest)
+        elif not os.path.isdir(os.path.dirname(dest)):
+            os.makedirs(os.path.dirname(dest))
+        shutil.move(path, dest)
+        os.symlink(dest, path)
+        with self._lock:
+            self.spilled.append(dest)
+        return dest
+
+    def close(self):
+        """
+        Log the most RAM the workspace used and discard what is in it.
+        """
+        self.usage()
+        logging.info('RAM workspace peak usage: %.1f MiB of %.1f MiB; %i '
+                     'item(s) moved to disk', self.peak / 1048576.0,
+                     self.budget / 1048576.0, len(self.spilled))
+        shutil.rmtree(self.path, ignore_errors=True)
+
+    def _in_ram(self, path):
+        return (not os.path.islink(path) and
+                os.path.abspath(path).startswith(self.path + os.sep))
+
+
+def disk_usage(path):
+    """
+    Return how many bytes a file or directory takes up, not counting files
+    that vanish while it is measured, as they can while a checkout or
+    build is still running.
+    """
+    if not os.path.isdir(path) or os.path.islink(path):
+        return _size(path)
+    total = 0
+    # os.walk skips directories that vanish before it lists them
+    for (dirpath, dirnames, filenames) in os.walk(path):
+        for name in dirnames + filenames:
+            total += _size(os.path.join(dirpath, name))
+    return total
+
+
+def _size(path):
+    # The size of a file, or 0 if it is gone
+    try:
+        return os.lstat(path).st_size
+    except OSError as err:
+        if err.errno != errno.ENOENT:
+            raise
+        return 0
@@ -0,0 +1,133 @@
+from distutils.spawn import find_executable
+import errno
+import hashlib
+import json
+import logging
+import os
+import os.path
+import subprocess
+
+import cachelib
+
+INDEX_NAME = '.rpmfab-index.json'
+
+
+class LocalRepo(object):
+    """
+    A yum repository on the local filesystem that builds publish their RPMs
+    to and later builds install from.
+
+    Publishing only reads the headers of new RPMs:  an index of the size
+    and mtime of every RPM already published, kept alongside the repo,
+    tells createrepo when it can trust its existing metadata for all of
+    the others without even looking at them.
+    """
+    def __init__(self, path):
+        self.path = os.path.abspath(path)
+        self.repo_id = 'rpmfab-' + hashlib.sha1(self.path).hexdigest()[:8]
+
+    def has_metadata(self):
+        return os.path.isdir(os.path.join(self.path, 'repodata'))
+
+    def ensure(self):
+        """
+        Create the repo, with empty metadata, if it doesn't exist yet.
+        """
+        if self.has_metadata():
+            return
+        self.publish([])
+
+    def publish(self, rpms):
+        """
+        Add RPMs to the repo, replacing any with the same file names, and
+        update its metadata.
+        """
+        if not os.path.isdir(self.path):
+            try:
+                os.makedirs(self.path)
+            except OSError:
+                if not os.path.isdir(self.path):
+                    raise
+        with cachelib.FileLock(self.path + '.lock'):
+            index = self._read_index()
+            changed = not self.has_metadata()
+            # Without an index there is no telling what the metadata says
+            replaced = index is None and self.has_metadata()
+            index = index or {}
+            new_rpms = 0
+            for rpm in rpms:
+                name = os.path.basename(rpm)
+                dest = os.path.join(self.path, name)
+                stat = os.stat(rpm)
+                if index.get(name) == [stat.st_size, stat.st_mtime]:
+                    # Already published
+                    continue
+                cachelib.link_or_copy(rpm, dest)
+                if name in index:
+                    replaced = True
+                stat = os.stat(dest)
+                index[name] = [stat.st_size, stat.st_mtime]
+                new_rpms += 1
+            if not changed and not new_rpms:
+                logging.debug('Repo %s is up to date', self.path)
+                return
+            self._update_metadata(skip_stat=not replaced)
+            self._write_index(index)
+        logging.info('Published %i new RPM(s) to %s', new_rpms, self.path)
+
+    def digest(self):
+        """
+        Return a hash of the repo's metadata, which changes whenever the
+        RPMs in it do, or None if it has no metadata yet.
+        """
+        with cachelib.FileLock(self.path + '.lock', shared=True):
+            try:
+                with open(os.path.join(self.path, 'repodata',
+                                       'repomd.xml'), 'rb') as repomd_file:
+                    return hashlib.sha1(repomd_file.read()).hexdigest()
+            except IOError as err:
+                if err.errno != errno.ENOENT:
+                    raise
+                return None
+
+    def config_snippet(self):
+        """
+        Return a mock config snippet that makes builds install packages
+        from this repo, with metadata that never goes stale.
+        """
+        repo = ('\n[{0}]\nname=rpmfab local builds\nbaseurl=file://{1}\n'
+                'enabled=1\ngpgcheck=0\nskip_if_unavailable=1\n'
+                'metadata_expire=0\n').format(self.repo_id, self.path)
+        return ("for _key in ('yum.conf', 'dnf.conf'):\n"
+                "    if config_opts.get(_key):\n"
+                "        config_opts[_key] += {0!r}\n").format(repo)
+
+    def _update_metadata(self, skip_stat):
+        if find_executable('createrepo_c'):
+            args = ['createrepo_c']
+        else:
+            args = ['createrepo']
+        args.extend(['-q', '--update'])
+        if skip_stat:
+            # Nothing already in the metadata has changed
+            args.append('--skip-stat')
+        args.append(self.path)
+        logging.debug("Executing ``%s''", ' '.join(args))
+        subprocess.check_call(args)
+
+    def _read_index(self):
+        # Files that aren't there anymore won't be in the metadata either
+        try:
+            with open(os.path.join(self.path, INDEX_NAME)) as index_file:
+                index = json.load(index_file)
+        except (IOError, ValueError):
+            return None
+        return dict((name, entry) for (name, entry) in index.iteritems()
+                    if os.path.exists(os.path.join(self.path, name)))
+
+    def _write_index(self, index):
+        index_path = os.path.join(self.path, INDEX_NAME)
+        tmp_path = '{0}.tmp-{1}'.format(index_path, os.getpid())
+        with open(tmp_path, 'w') as index_file:
+            json.dump(index, index_file, indent=2, sort_keys=True)
+        os.rename(tmp_path, index_path)
@@ -0,0 +1,257 @@
+import contextlib
+import errno
+import hashlib
+import logging
+import os
+import os.path
+import re
+import shutil
+import tempfile
+import threading
+
+import rpm
+
+import tracelib
+
+# librpm keeps its macros in global state, so only one thread may parse a
+# spec file at a time, and each parse starts by resetting them.
+_rpm_lock = threading.Lock()
+
+# Flags in the third field of each of rpm.spec.sources' entries
+_RPMBUILD_ISSOURCE = 1
+_RPMBUILD_ISPATCH = 2
+
+# Everything macro_references looks for in one pass:  %% (a literal percent
+# sign), %include lines, SourceN tags, and references to macros by name in
+# any form (%name, %{name}, %{?name}, %{!?name:...}, and so on).
+_SPEC_TOKEN_RE = re.compile(r'%%'
+                            r'|^[ \t]*%include[ \t]+(\S+)'
+                            r'|^[Ss]ource(\d*)[ \t]*:[ \t]*(\S+)'
+                            r'|%\{?[!?]*([A-Za-z_]\w*)', re.MULTILINE)
+_SOURCE_MACRO_RE = re.compile(r'%\{?SOURCE(\d+)\}?$')
+_SOURCEDIR_RE = re.compile(r'%\{_sourcedir\}|%_sourcedir\b')
+# Relative paths in %include lines and %{load:...} macros, which rpm looks
+# for in the working directory
+_RELATIVE_INCLUDE_RE = re.compile(r'^([ \t]*%include[ \t]+)([^%/\s]\S*)'
+                                  r'|(%\{load:)([^%/}][^}]*)', re.MULTILINE)
+# How much of a spec file to scan at a time
+_SCAN_CHUNK = 1024 * 1024
+
+
+class ParsedSpec(object):
+    """
+    A spec file that is parsed once and reparsed only when its contents
+    change, such as when macros are added to it.
+
+    sources and patches map each SourceN or PatchN number to its URL or file
+    name.  build_requires and provides list the names of the capabilities
+    the source package requires and its binary packages provide.
+    """
+    def __init__(self, specfile):
+        self.specfile = specfile
+        self._digest = None
+        self._sources = None
+        self._patches = None
+        self._nvr = None
+        self._build_requires = None
+        self._provides = None
+
+    @property
+    def sources(self):
+        self._parse_if_changed()
+        return self._sources
+
+    @property
+    def patches(self):
+        self._parse_if_changed()
+        return self._patches
+
+    @property
+    def nvr(self):
+        self._parse_if_changed()
+        return self._nvr
+
+    @property
+    def build_requires(self):
+        self._parse_if_changed()
+        return self._build_requires
+
+    @property
+    def provides(self):
+        self._parse_if_changed()
+        return self._provides
+
+    def _parse_if_changed(self):
+        with open(self.specfile, 'rb') as spec_file:
+            digest = hashlib.sha1(spec_file.read()).hexdigest()
+        if digest == self._digest:
+            return
+        logging.debug('Parsing spec file %s', self.specfile)
+        specfile = os.path.abspath(self.specfile)
+        specdir = os.path.dirname(specfile)
+        with _absolute_copy(specfile, specdir) as parsed, _rpm_lock, \
+                tracelib.span('parse-spec', cat='spec'), \
+                _spec_macros(specdir):
+            spec = rpm.ts().parseSpec(parsed)
+            sources = {}
+            patches = {}
+            for (url, num, flags) in spec.sources:
+                if flags & _RPMBUILD_ISSOURCE:
+                    sources[num] = url
+                elif flags & _RPMBUILD_ISPATCH:
+                    patches[num] = url
+            nvr = (rpm.expandMacro('%{name}'), rpm.expandMacro('%{version}'),
+                   rpm.expandMacro('%{release}'))
+            build_requires = list(spec.sourceHeader[rpm.RPMTAG_REQUIRENAME])
+            provides = set()
+            for package in spec.packages:
+                provides.add(package.header[rpm.RPMTAG_NAME])
+                provides.update(package.header[rpm.RPMTAG_PROVIDENAME])
+        (self._sources, self._patches, self._nvr) = (sources, patches, nvr)
+        self._build_requires = build_requires
+        self._provides = sorted(provides)
+        self._digest = digest
+
+
+@contextlib.contextmanager
+def _spec_macros(specdir):
+    # Drop the macros that spec files parsed earlier in this process
+    # defined, so that one spec's %global or %define can't change how
+    # another one parses, and find sources next to the spec file
+    rpm.reloadConfig()
+    for name in ('_sourcedir', '_specdir'):
+        rpm.addMacro(name, specdir)
+    try:
+        yield
+    finally:
+        for name in ('_sourcedir', '_specdir'):
+            rpm.delMacro(name)
+
+
+@contextlib.contextmanager
+def _absolute_copy(specfile, specdir):
+    # Let the files the spec %includes or %{load:}s be found where mock
+    # finds them, relative to the spec file, by parsing a copy of it whose
+    # relative paths are made absolute.  rpm would look for them in the
+    # working directory, which is shared by every thread in the process.
+    tempdir = tempfile.mkdtemp(prefix='rpmfab-spec-')
+    try:
+        yield _copy_with_absolute_paths(specfile, specdir, tempdir, {})
+    finally:
+        shutil.rmtree(tempdir)
+
+
+def _copy_with_absolute_paths(path, specdir, tempdir, copies):
+    # Copy path into tempdir with its relative includes made absolute, and
+    # included files that are there to copy made copies of their own, once
+    # each; return the path of the copy
+    if path in copies:
+        return copies[path]
+    copies[path] = os.path.join(tempdir, '{0}-{1}'.format(
+        len(copies), os.path.basename(path)))
+
+    def absolute(match):
+        (prefix, include) = ((match.group(1), match.group(2))
+                             if match.group(2) else
+                             (match.group(3), match.group(4)))
+        include_path = os.path.join(specdir, include)
+        if '%' not in include and os.path.isfile(include_path):
+            include_path = _copy_with_absolute_paths(include_path, specdir,
+                                                     tempdir, copies)
+        return prefix + include_path
+
+    with open(path, 'rb') as original_file, \
+            open(copies[path], 'wb') as copy_file:
+        for line in original_file:
+            copy_file.write(_RELATIVE_INCLUDE_RE.sub(absolute, line))
+    return copies[path]
+
+
+def macro_references(specfile):
+    """
+    Return the set of names of the macros that a spec file refers to,
+    either itself or through the files it %includes, reading each file
+    once.  Included files are looked for next to the spec file, where
+    mock finds sources, and skipped if they are not there (yet).
+    """
+    specfile = os.path.abspath(specfile)
+    specdir = os.path.dirname(specfile)
+    names = set()
+    sources = {}
+    includes = []
+    scanned = set()
+    pending = [specfile]
+    while pending:
+        path = pending.pop()
+        if path in scanned:
+            continue
+        scanned.add(path)
+        try:
+            spec_file = open(path, 'rb')
+        except IOError as err:
+            if err.errno != errno.ENOENT:
+                raise
+            logging.debug('Not scanning missing %%include file %s', path)
+            continue
+        with spec_file:
+            for lines in iter(lambda: spec_file.readlines(_SCAN_CHUNK), []):
+                for (include, srcno, srcuri, name) in \
+                        _SPEC_TOKEN_RE.findall(''.join(lines)):
+                    if name:
+                        names.add(name)
+                        continue
+                    # The tokens in these lines' values count too
+                    value = include or srcuri
+                    names.update(token[-1] for token
+                                 in _SPEC_TOKEN_RE.findall(value)
+                                 if token[-1])
+                    if include:
+                        includes.append(include)
+                    elif srcuri:
+                        sources[int(srcno or 0)] = srcuri
+        # Includes may name sources defined after them
+        while includes:
+            include_path = _include_path(includes.pop(), specdir, sources)
+            if include_path:
+                pending.append(include_path)
+    return names
+
+
+def _include_path(include, specdir, sources):
+    """
+    Return the path of a file that %include names, or None if it takes
+    more than expanding %{SOURCEN} and %{_sourcedir} to find out.
+    """
+    match = _SOURCE_MACRO_RE.match(include)
+    if match:
+        if int(match.group(1)) not in sources:
+            return None
+        include = os.path.basename(sources[int(match.group(1))])
+    include = _SOURCEDIR_RE.sub(lambda match: specdir, include)
+    if '%' in include:
+        return None
+    return os.path.join(specdir, include)
+
+
+def prepend_globals(specfile, macros):
+    """
+    Define macros, a dict, with %global at the top of a spec file.  The
+    rest of the file is streamed into a new one next to it, which then
+    replaces it.
+    """
+    specdir = os.path.dirname(os.path.abspath(specfile))
+    modified = tempfile.NamedTemporaryFile(dir=specdir, prefix='.rpmfab-',
+                                           suffix='.tmp', delete=False)
+    try:
+        for (key, val) in macros.iteritems():
+            modified.write('%global {0} {1}\n'.format(key, val))
+        modified.write('\n')
+        with open(specfile, 'rb') as original_file:
+            shutil.copyfileobj(original_file, modified, _SCAN_CHUNK)
+        modified.close()
+        shutil.copymode(specfile, modified.name)
+        os.rename(modified.name, specfile)
+    except:
+        modified.close()
+        os.remove(modified.name)
+        raise
@@ -0,0 +1,358 @@
+from distutils.spawn import find_executable
+import logging
+import multiprocessing
+import os
+import shutil
+import subprocess
+import tarfile
+
+# xz splits its input into blocks of this size no matter how many threads
+# it uses so its output doesn't depend on the number of workers
+XZ_BLOCK_SIZE = 16 * 1024 * 1024
+
+
+def compressor_args(tarball, workers=None, level=None):
+    """
+    Return the command that compresses a tar stream on stdin for a tarball
+    of the given name, or None if the tarball is not compressed.
+
+    Where a parallel compressor is available it uses workers threads, or
+    one per CPU by default.  Each of them produces the same output no
+    matter how many threads it uses.
+    """
+    workers = str(workers or multiprocessing.cpu_count())
+    if tarball.endswith('.tar.gz') or tarball.endswith('.tgz'):
+        if find_executable('pigz'):
+            args = ['pigz', '-n', '-c', '-p', workers]
+        else:
+            args = ['gzip', '-n', '-c']
+    elif tarball.endswith('.tar.bz2'):
+        if find_executable('pbzip2'):
+            args = ['pbzip2', '-c', '-p' + workers]
+        else:
+            args = ['bzip2', '-c']
+    elif tarball.endswith('.tar.xz'):
+        # xz -T1 switches to a different single-threaded format; -T+1 (xz
+        # 5.4 or later) sticks with the blocked one
+        if workers == '1':
+            workers = '+1'
+        args = ['xz', '-c', '-T' + workers,
+                '--block-size={0}'.format(XZ_BLOCK_SIZE)]
+    elif tarball.endswith('.tar.zst'):
+        args = ['zstd', '-q', '-c', '-T' + workers]
+    else:
+        return None
+    if level is not None:
+        args.append('-{0}'.format(level))
+    return args
+
+
+def source_date_epoch():
+    """
+    Return the value of SOURCE_DATE_EPOCH, which caps the timestamps in
+    generated tarballs so they are reproducible, or None if it is not set.
+    """
+    if os.getenv('SOURCE_DATE_EPOCH'):
+        return int(os.getenv('SOURCE_DATE_EPOCH'))
+    return None
+
+
+def copy_tar_stream(src, dest, max_mtime=None):
+    """
+    Copy an uncompressed tar stream from one file to another, capping the
+    timestamps of its members at max_mtime if one is given.
+    """
+    if max_mtime is None:
+        shutil.copyfileobj(src, dest)
+        return
+    in_tar = tarfile.open(fileobj=src, mode='r|')
+    out_tar = tarfile.open(fileobj=dest, mode='w|', format=tarfile.PAX_FORMAT)
+    for member in in_tar:
+        member.mtime = min(member.mtime, max_mtime)
+        if member.isreg():
+            out_tar.addfile(member, in_tar.extractfile(member))
+        else:
+            out_tar.addfile(member)
+    in_tar.close()
+    out_tar.close()
+
+
+class CompressedFile(object):
+    """
+    A write-only file that compresses everything written to it on its way
+    to a tarball on disk.
+    """
+    def __init__(self, tarball, workers=None, level=None):
+        self.args = compressor_args(tarball, workers=workers, level=level)
+        self._file = open(tarball, 'wb')
+        if self.args:
+            self._proc = subprocess.Popen(self.args, stdin=subprocess.PIPE,
+                                          stdout=self._file)
+            self.stream = self._proc.stdin
+        else:
+            self._proc = None
+            self.stream = self._file
+
+    def write(self, data):
+        self.stream.write(data)
+
+    def close(self):
+        if self._proc:
+            self._proc.stdin.close()
+            if self._proc.wait() != 0:
+                self._file.close()
+                raise subprocess.CalledProcessError(self._proc.returncode,
+                                                    self.args)
+        self._file.close()
+
+
+class CatFile(object):
+    """
+    A long-lived ``git cat-file --batch'' process that reads objects from
+    one repository.
+    """
+    def __init__(self, repo):
+        self.repo = repo
+        self._proc = subprocess.Popen(['git', 'cat-file', '--batch'],
+                                      cwd=repo, stdin=subprocess.PIPE,
+                                      stdout=subprocess.PIPE)
+
+    def request(self, name):
+        """
+        Ask for an object and return its type and size.  Exactly that many
+        bytes of content must then be consumed with read_content.
+        """
+        self._proc.stdin.write(name + '\n')
+        self._proc.stdin.flush()
+        header = self._proc.stdout.readline().split()
+        if len(header) != 3:
+            raise KeyError('object {0} not found in {1}'.format(name,
+                                                                self.repo))
+        return (header[1], int(header[2]))
+
+    def read_content(self, size):
+        data = self._proc.stdout.read(size)
+        self._proc.stdout.read(1)  # trailing newline
+        return data
+
+    def stream_content(self, size):
+        return _ContentReader(self._proc.stdout, size)
+
+    def read(self, name):
+        (objtype, size) = self.request(name)
+        return (objtype, self.read_content(size))
+
+    def close(self):
+        # If the last object wasn't read to the end, cat-file is blocked
+        # writing the rest of it; closing stdout makes that write fail so it
+        # exits rather than waiting forever.
+        for stream in (self._proc.stdin, self._proc.stdout):
+            try:
+                stream.close()
+            except IOError:
+                pass
+        self._proc.wait()
+
+
+class _ContentReader(object):
+    # Hands tarfile exactly one object's worth of a cat-file stream
+    def __init__(self, stream, size):
+        self._stream = stream
+        self._remaining = size
+
+    def read(self, size=-1):
+        if size < 0 or size > self._remaining:
+            size = self._remaining
+        data = self._stream.read(size)
+        self._remaining -= len(data)
+        if not self._remaining:
+            self._stream.read(1)  # trailing newline
+        return data
+
+
+class GitArchiver(object):
+    """
+    Write a commit and, recursively, the commits of its submodules to a
+    single tar stream, much like ``git archive'' would for one repository.
+    Repos whose commits have .gitattributes files are archived by ``git
+    archive'' itself so export-ignore and export-subst still apply.
+
+    find_submodule is called with the repo, commit, path, and submodule
+    commit of each gitlink and should return a repo that contains the
+    submodule's commit, or None to leave the submodule out as an empty
+    directory.  Repos are anything git will run in:  bare repos or working
+    trees.
+    """
+    def __init__(self, find_submodule):
+        self.find_submodule = find_submodule
+        self._catfiles = {}
+
+    def archive(self, repo, commit, prefix, fileobj):
+        (__, commit_data) = self._catfile(repo).read(commit)
+        (headers, __, __) = commit_data.partition('\n\n')
+        tree = None
+        mtime = 0
+        for line in headers.splitlines():
+            if line.startswith('tree '):
+                tree = line.split()[1]
+            elif line.startswith('committer '):
+                # ... <email> TIMESTAMP TZ
+                mtime = int(line.rsplit(None, 2)[1])
+        if source_date_epoch() is not None:
+            mtime = min(mtime, source_date_epoch())
+        tar = tarfile.open(fileobj=fileobj, mode='w|',
+                           format=tarfile.PAX_FORMAT,
+                           pax_headers={'comment': commit})
+        prefix = prefix.rstrip('/')
+        if prefix:
+            tar.addfile(self._tarinfo(prefix, tarfile.DIRTYPE, 0775, mtime))
+        self._add_tree(tar, repo, commit, tree, '', prefix, mtime)
+        tar.close()
+
+    def close(self):
+        for catfile in self._catfiles.itervalues():
+            catfile.close()
+        self._catfiles = {}
+
+    def _catfile(self, repo):
+        if repo not in self._catfiles:
+            self._catfiles[repo] = CatFile(repo)
+        return self._catfiles[repo]
+
+    def _add_tree(self, tar, repo, commit, tree, path, prefix, mtime):
+        # path is relative to repo's top level; prefix is where that top
+        # level goes in the tarball
+        if not path and _has_attributes(repo, commit):
+            self._add_archive(tar, repo, commit, prefix, mtime)
+            return
+        catfile = self._catfile(repo)
+        (__, tree_data) = catfile.read(tree)
+        for (mode, name, sha) in _parse_tree(tree_data):
+            entry_path = path + name
+            member = prefix + '/' + entry_path if prefix else entry_path
+            if mode == '40000':
+                tar.addfile(self._tarinfo(member, tarfile.DIRTYPE, 0775,
+                                          mtime))
+                self._add_tree(tar, repo, commit, sha, entry_path + '/',
+                               prefix, mtime)
+            elif mode == '160000':
+                tar.addfile(self._tarinfo(member, tarfile.DIRTYPE, 0775,
+                                          mtime))
+                subrepo = self.find_submodule(repo, commit, entry_path, sha)
+                if subrepo:
+                    (__, sub_data) = self._catfile(subrepo).read(sha)
+                    subtree = sub_data.split('\n', 1)[0].split()[1]
+                    self._add_tree(tar, subrepo, sha, subtree, '', member,
+                                   mtime)
+            elif mode == '120000':
+                (__, target) = catfile.read(sha)
+                info = self._tarinfo(member, tarfile.SYMTYPE, 0777, mtime)
+                info.linkname = target
+                tar.addfile(info)
+            else:
+                (__, size) = catfile.request(sha)
+                if mode == '100755':
+                    info = self._tarinfo(member, tarfile.REGTYPE, 0775, mtime)
+                else:
+                    info = self._tarinfo(member, tarfile.REGTYPE, 0664, mtime)
+                info.size = size
+                if size:
+                    tar.addfile(info, catfile.stream_content(size))
+                else:
+                    # tarfile won't read anything, not even the newline
+                    catfile.read_content(0)
+                    tar.addfile(info)
+
+    def _add_archive(self, tar, repo, commit, prefix, mtime):
+        # Let git archive apply the attributes, then fill in submodules
+        args = ['git', 'archive', '--format=tar', commit]
+        logging.debug("Executing ``%s'' in %s", ' '.join(args), repo)
+        git_archive = subprocess.Popen(args, cwd=repo, stdout=subprocess.PIPE)
+        archived = set()
+        try:
+            in_tar = tarfile.open(fileobj=git_archive.stdout, mode='r|')
+            for info in in_tar:
+                name = info.name.rstrip('/')
+                archived.add(name)
+                info.name = prefix + '/' + name if prefix else name
+                info.mtime = mtime
+                info.uid = info.gid = 0
+                info.uname = info.gname = 'root'
+                if info.isreg():
+                    tar.addfile(info, in_tar.extractfile(info))
+                else:
+                    tar.addfile(info)
+            in_tar.close()
+        finally:
+            git_archive.stdout.close()
+            if git_archive.wait() != 0:
+                raise subprocess.CalledProcessError(git_archive.returncode,
+                                                    args)
+        for (path, subcommit) in _gitlinks(repo, commit):
+            # git archive writes submodules as empty directories, unless
+            # they are export-ignored
+            if path not in archived:
+                continue
+            subrepo = self.find_submodule(repo, commit, path, subcommit)
+            if subrepo:
+                (__, sub_data) = self._catfile(subrepo).read(subcommit)
+                subtree = sub_data.split('\n', 1)[0].split()[1]
+                member = prefix + '/' + path if prefix else path
+                self._add_tree(tar, subrepo, subcommit, subtree, '', member,
+                               mtime)
+
+    @staticmethod
+    def _tarinfo(name, entry_type, mode, mtime):
+        info = tarfile.TarInfo(name)
+        info.type = entry_type
+        info.mode = mode
+        info.mtime = mtime
+        info.uname = 'root'
+        info.gname = 'root'
+        return info
+
+
+def _has_attributes(repo, commit):
+    """
+    Return whether anything in a commit, or the repo's info/attributes,
+    gives paths attributes that git archive pays attention to.
+    """
+    git_dir = subprocess.Popen(['git', 'rev-parse', '--git-dir'], cwd=repo,
+                               stdout=subprocess.PIPE).communicate()[0]
+    info_attributes = os.path.join(repo, git_dir.strip(), 'info',
+                                   'attributes')
+    if os.path.isfile(info_attributes):
+        return True
+    args = ['git', 'ls-tree', '-r', '-z', '--name-only', commit]
+    git_lstree = subprocess.Popen(args, cwd=repo, stdout=subprocess.PIPE)
+    names = git_lstree.communicate()[0].split('\0')
+    if git_lstree.returncode != 0:
+        raise subprocess.CalledProcessError(git_lstree.returncode, args)
+    return any(os.path.basename(name) == '.gitattributes' for name in names)
+
+
+def _gitlinks(repo, commit):
+    # (path, commit) of every submodule in a commit
+    args = ['git', 'ls-tree', '-r', '-z', commit]
+    git_lstree = subprocess.Popen(args, cwd=repo, stdout=subprocess.PIPE)
+    output = git_lstree.communicate()[0]
+    if git_lstree.returncode != 0:
+        raise subprocess.CalledProcessError(git_lstree.returncode, args)
+    for entry in output.split('\0'):
+        if not entry:
+            continue
+        (info, __, path) = entry.partition('\t')
+        (mode, objtype, sha) = info.split()
+        if objtype == 'commit':
+            yield (path, sha)
+
+
+def _parse_tree(data):
+    # Each entry is "MODE NAME\0" followed by a 20-byte binary SHA-1
+    pos = 0
+    while pos < len(data):
+        space = data.index(' ', pos)
+        nul = data.index('\0', space)
+        sha = data[nul + 1:nul + 21].encode('hex')
+        yield (data[pos:space], data[space + 1:nul], sha)
+        pos = nul + 21
@@ -0,0 +1,132 @@
+import os
+import os.path
+import shutil
+import stat
+import tempfile
+import unittest
+
+import cachelib
+
+
+class CacheDirTest(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp(prefix='rpmfab-test-')
+        self.cache = cachelib.CacheDir(os.path.join(self.tmpdir, 'cache'))
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def write(self, name, data):
+        path = os.path.join(self.tmpdir, name)
+        with open(path, 'wb') as out:
+            out.write(data)
+        return path
+
+    def store(self, key, size, mtime):
+        # Store an entry of size bytes that was last used at mtime
+        self.cache.store_file(key, self.write(key + '-src', 'x' * size))
+        os.utime(self.cache.entry_path(key), (mtime, mtime))
+
+    def entries(self):
+        return [name for name in os.listdir(self.cache.path)
+                if '.' not in name]
+
+    def test_store_and_fetch_file(self):
+        key = self.cache.key_for('file', 'a')
+        self.cache.store_file(key, self.write('src', 'contents'))
+        dest = os.path.join(self.tmpdir, 'dest')
+        self.assertTrue(self.cache.fetch_file(key, dest))
+        with open(dest, 'rb') as dest_file:
+            self.assertEqual(dest_file.read(), 'contents')
+
+    def test_fetch_missing_file(self):
+        dest = os.path.join(self.tmpdir, 'dest')
+        self.assertFalse(self.cache.fetch_file(self.cache.key_for('no'),
+                                               dest))
+        self.assertFalse(os.path.lexists(dest))
+
+    def test_store_file_keeps_source_writable(self):
+        src = self.write('src', 'contents')
+        os.chmod(src, 0644)
+        self.cache.store_file(self.cache.key_for('file', 'a'), src)
+        self.assertEqual(stat.S_IMODE(os.stat(src).st_mode), 0644)
+
+    def test_store_files_replaces_entry(self):
+        key = self.cache.key_for('files')
+        self.cache.store_files(key, [self.write('a', 'a'),
+                                     self.write('b', 'b')])
+        self.cache.store_files(key, [self.write('c', 'c')])
+        destdir = os.path.join(self.tmpdir, 'dest')
+        self.assertEqual(self.cache.fetch_files(key, destdir), ['c'])
+        self.assertEqual(os.listdir(destdir), ['c'])
+
+    def test_fetch_files_copies_unlinked_files(self):
+        key = self.cache.key_for('files')
+        self.cache.store_files(key, [self.write('a.log', 'log')])
+        destdir = os.path.join(self.tmpdir, 'dest')
+        self.cache.fetch_files(key, destdir, link=lambda name: False)
+        with open(os.path.join(destdir, 'a.log'), 'ab') as log_file:
+            log_file.write(' more')
+        with open(os.path.join(self.cache.entry_path(key),
+                               'a.log'), 'rb') as entry_file:
+            self.assertEqual(entry_file.read(), 'log')
+
+    def test_evicts_least_recently_used(self):
+        self.store('a', 1000, 100)
+        self.store('b', 1000, 300)
+        self.store('c', 1000, 200)
+        self.cache.max_size = 2500
+        self.cache.evict()
+        self.assertEqual(sorted(self.entries()), ['b', 'c'])
+
+    def test_eviction_skips_locked_entries(self):
+        self.store('a', 1000, 100)
+        self.store('b', 1000, 200)
+        self.store('c', 1000, 300)
+        self.cache.max_size = 2500
+        with self.cache.lock('a', shared=True):
+            self.cache.evict()
+        self.assertEqual(sorted(self.entries()), ['a', 'c'])
+
+    def test_store_evicts(self):
+        self.cache.max_size = 1500
+        self.store('a', 1000, 100)
+        self.store('b', 1000, 200)
+        self.assertEqual(self.entries(), ['b'])
+
+    def test_no_eviction_without_max_size(self):
+        self.store('a', 1000, 100)
+        self.store('b', 1000, 200)
+        self.cache.evict()
+        self.assertEqual(sorted(self.entries()), ['a', 'b'])
+
+
+class FileLockTest(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp(prefix='rpmfab-test-')
+        self.path = os.path.join(self.tmpdir, 'lock')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_exclusive_lock_excludes(self):
+        with cachelib.FileLock(self.path):
+            self.assertFalse(cachelib.FileLock(self.path, shared=True)
+                             .acquire(blocking=False))
+            self.assertFalse(cachelib.FileLock(self.path)
+                             .acquire(blocking=False))
+        lock = cachelib.FileLock(self.path)
+        self.assertTrue(lock.acquire(blocking=False))
+        lock.release()
+
+    def test_shared_locks_coexist(self):
+        with cachelib.FileLock(self.path, shared=True):
+            lock = cachelib.FileLock(self.path, shared=True)
+            self.assertTrue(lock.acquire(blocking=False))
+            lock.release()
+            self.assertFalse(cachelib.FileLock(self.path)
+                             .acquire(blocking=False))
+
+
+if __name__ == '__main__':
+    unittest.main()
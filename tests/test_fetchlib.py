@@ -0,0 +1,118 @@
+import BaseHTTPServer
+import logging
+import os
+import os.path
+import shutil
+import tempfile
+import threading
+import unittest
+
+import cachelib
+import fetchlib
+
+
+class _Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+    # Serves server.files, which maps paths to (ETag, contents), and
+    # records the headers of every request in server.requests
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        self.server.requests.append((self.path, dict(self.headers)))
+        if self.path == '/moved':
+            self.send_response(302)
+            self.send_header('Location', '/file')
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        if self.path == '/broken':
+            self.send_error(503)
+            return
+        if self.path not in self.server.files:
+            self.send_error(404)
+            return
+        (etag, content) = self.server.files[self.path]
+        if self.headers.get('If-None-Match') == etag:
+            self.send_response(304)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header('ETag', etag)
+        self.send_header('Content-Length', str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def log_message(self, *args):
+        pass
+
+
+class DownloaderTest(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp(prefix='rpmfab-test-')
+        self.server = BaseHTTPServer.HTTPServer(('127.0.0.1', 0), _Handler)
+        self.server.files = {'/file': ('"1"', 'contents\n' * 1000)}
+        self.server.requests = []
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        self.base = 'http://127.0.0.1:{0}'.format(self.server.server_port)
+        cache = cachelib.CacheDir(os.path.join(self.tmpdir, 'cache'))
+        self.downloader = fetchlib.Downloader(cache=cache, retries=0)
+        logging.disable(logging.WARNING)
+
+    def tearDown(self):
+        logging.disable(logging.NOTSET)
+        self.downloader.close()
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.tmpdir)
+
+    def fetch(self, path, name='dest'):
+        dest = os.path.join(self.tmpdir, name)
+        self.downloader.fetch(self.base + path, dest)
+        with open(dest, 'rb') as dest_file:
+            return dest_file.read()
+
+    def test_download(self):
+        self.assertEqual(self.fetch('/file'), 'contents\n' * 1000)
+
+    def test_download_without_cache(self):
+        self.downloader = fetchlib.Downloader(retries=0)
+        self.assertEqual(self.fetch('/file'), 'contents\n' * 1000)
+
+    def test_unchanged_file_comes_from_cache(self):
+        self.fetch('/file', 'first')
+        self.assertEqual(self.fetch('/file', 'second'), 'contents\n' * 1000)
+        self.assertEqual(self.server.requests[1][1].get('if-none-match'),
+                         '"1"')
+
+    def test_changed_file_is_downloaded_again(self):
+        self.fetch('/file', 'first')
+        self.server.files['/file'] = ('"2"', 'new\n')
+        self.assertEqual(self.fetch('/file', 'second'), 'new\n')
+        with open(os.path.join(self.tmpdir, 'first'), 'rb') as first_file:
+            self.assertEqual(first_file.read(), 'contents\n' * 1000)
+
+    def test_corrupt_cache_entry_is_discarded(self):
+        self.fetch('/file', 'first')
+        key = self.downloader.cache.key_for('download', self.base + '/file')
+        content = os.path.join(self.downloader.cache.entry_path(key),
+                               'content')
+        os.chmod(content, 0644)
+        with open(content, 'wb') as content_file:
+            content_file.write('garbage')
+        self.assertEqual(self.fetch('/file', 'second'), 'contents\n' * 1000)
+        self.assertNotIn('if-none-match', self.server.requests[1][1])
+
+    def test_redirect_is_followed(self):
+        self.assertEqual(self.fetch('/moved'), 'contents\n' * 1000)
+
+    def test_missing_file(self):
+        self.assertRaises(IOError, self.fetch, '/missing')
+
+    def test_server_error(self):
+        self.assertRaises(fetchlib.DownloadError, self.fetch, '/broken')
+
+
+if __name__ == '__main__':
+    unittest.main()
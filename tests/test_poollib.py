@@ -0,0 +1,91 @@
+import logging
+import threading
+import unittest
+
+import poollib
+
+
+class TaskTestCase(unittest.TestCase):
+    def setUp(self):
+        self.ran = []
+        self.lock = threading.Lock()
+        logging.disable(logging.ERROR)
+
+    def tearDown(self):
+        logging.disable(logging.NOTSET)
+
+    def task(self, name, fail=False):
+        def run():
+            with self.lock:
+                self.ran.append(name)
+            if fail:
+                raise RuntimeError(name + ' broke')
+        return (name, run, ())
+
+
+class RunTasksTest(TaskTestCase):
+    def test_serial_tasks_run_in_order(self):
+        poollib.run_tasks([self.task('a'), self.task('b'), self.task('c')])
+        self.assertEqual(self.ran, ['a', 'b', 'c'])
+
+    def test_serial_failure_propagates(self):
+        self.assertRaises(RuntimeError, poollib.run_tasks,
+                          [self.task('a', fail=True), self.task('b')])
+        self.assertEqual(self.ran, ['a'])
+
+    def test_parallel_failures_are_collected(self):
+        tasks = [self.task('a', fail=True), self.task('b'),
+                 self.task('c', fail=True)]
+        try:
+            poollib.run_tasks(tasks, jobs=2)
+        except poollib.TaskFailures as err:
+            self.assertEqual(sorted(name for (name, __) in err.failures),
+                             ['a', 'c'])
+        else:
+            self.fail('TaskFailures not raised')
+        self.assertEqual(sorted(self.ran), ['a', 'b', 'c'])
+
+    def test_gate_is_released(self):
+        gate = poollib.ResourceGate()
+        poollib.run_tasks([self.task('a'), self.task('b')], jobs=2,
+                          gate=gate)
+        self.assertEqual(gate.running, 0)
+
+
+class RunDagTest(TaskTestCase):
+    def test_dependencies_run_first(self):
+        tasks = [self.task('app'), self.task('lib'), self.task('base')]
+        deps = {'app': ['lib'], 'lib': ['base']}
+        poollib.run_dag(tasks, deps, jobs=3)
+        self.assertEqual(self.ran, ['base', 'lib', 'app'])
+
+    def test_unknown_dependencies_are_ignored(self):
+        poollib.run_dag([self.task('a')], {'a': ['elsewhere']}, jobs=2)
+        self.assertEqual(self.ran, ['a'])
+
+    def test_failure_skips_dependents(self):
+        tasks = [self.task('app'), self.task('lib', fail=True),
+                 self.task('other')]
+        try:
+            poollib.run_dag(tasks, {'app': ['lib']}, jobs=2)
+        except poollib.TaskFailures as err:
+            self.assertEqual(sorted(name for (name, __) in err.failures),
+                             ['app', 'lib'])
+        else:
+            self.fail('TaskFailures not raised')
+        self.assertEqual(sorted(self.ran), ['lib', 'other'])
+
+    def test_cycle_is_reported(self):
+        tasks = [self.task('a'), self.task('b'), self.task('c')]
+        deps = {'a': ['b'], 'b': ['a'], 'c': []}
+        try:
+            poollib.run_dag(tasks, deps, jobs=2)
+        except ValueError as err:
+            self.assertEqual(str(err), 'dependency cycle among: a, b')
+        else:
+            self.fail('ValueError not raised')
+        self.assertEqual(self.ran, [])
+
+
+if __name__ == '__main__':
+    unittest.main()
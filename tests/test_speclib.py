@@ -0,0 +1,119 @@
+import os
+import os.path
+import shutil
+import tempfile
+import unittest
+
+try:
+    import speclib
+except ImportError:
+    # The rpm module comes with rpm itself, not from PyPI
+    speclib = None
+
+_SPEC = """\
+Name: {name}
+Version: 1.0
+Release: 1
+Summary: Test package
+License: MIT
+Source0: {name}-%{{version}}.tar.gz
+{extra}
+
+%description
+Test package.
+
+%files
+"""
+
+
+@unittest.skipIf(speclib is None, 'needs the rpm Python module')
+class SpecTestCase(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp(prefix='rpmfab-test-')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def write(self, path, data):
+        path = os.path.join(self.tmpdir, path)
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        with open(path, 'wb') as out:
+            out.write(data)
+        return path
+
+    def spec(self, path, name, extra=''):
+        return self.write(path, _SPEC.format(name=name, extra=extra))
+
+
+class ParsedSpecTest(SpecTestCase):
+    def test_parse(self):
+        spec = speclib.ParsedSpec(self.spec('foo.spec', 'foo',
+                                            'Patch3: fix.patch\n'
+                                            'BuildRequires: make\n'))
+        self.assertEqual(spec.nvr, ('foo', '1.0', '1'))
+        self.assertEqual(spec.sources, {0: 'foo-1.0.tar.gz'})
+        self.assertEqual(spec.patches, {3: 'fix.patch'})
+        self.assertIn('make', spec.build_requires)
+        self.assertIn('foo', spec.provides)
+
+    def test_reparse_when_changed(self):
+        path = self.spec('foo.spec', 'foo')
+        spec = speclib.ParsedSpec(path)
+        self.assertEqual(spec.nvr[0], 'foo')
+        self.spec('foo.spec', 'bar')
+        self.assertEqual(spec.nvr[0], 'bar')
+
+    def test_relative_include_next_to_spec(self):
+        self.write('pkg/deps.inc', 'BuildRequires: included\n')
+        spec = speclib.ParsedSpec(self.spec('pkg/foo.spec', 'foo',
+                                            '%include deps.inc\n'))
+        cwd = os.getcwd()
+        self.assertIn('included', spec.build_requires)
+        self.assertEqual(os.getcwd(), cwd)
+
+    def test_macros_do_not_leak_between_specs(self):
+        first = speclib.ParsedSpec(self.spec('a.spec', 'a',
+                                             '%global leak 1\n'))
+        second = speclib.ParsedSpec(self.spec(
+            'b.spec', 'b', '%{?leak:BuildRequires: leaked}\n'))
+        self.assertEqual(first.nvr[0], 'a')
+        self.assertNotIn('leaked', second.build_requires)
+
+
+class MacroReferencesTest(SpecTestCase):
+    def test_references(self):
+        path = self.spec('foo.spec', 'foo',
+                         '%global x %{?with_y:1}\n'
+                         '%if %{!?_without_z:1}\n%endif\n')
+        names = speclib.macro_references(path)
+        self.assertTrue(set(['version', 'with_y', '_without_z']) <= names)
+
+    def test_references_in_includes(self):
+        self.write('common.inc', 'Requires: %{needed_by_include}\n')
+        self.write('other.inc', 'Requires: %{via_source}\n')
+        path = self.spec('foo.spec', 'foo',
+                         'Source1: other.inc\n'
+                         '%include %{_sourcedir}/common.inc\n'
+                         '%include %{SOURCE1}\n'
+                         '%include missing.inc\n')
+        names = speclib.macro_references(path)
+        self.assertIn('needed_by_include', names)
+        self.assertIn('via_source', names)
+
+
+class PrependGlobalsTest(SpecTestCase):
+    def test_prepend_globals(self):
+        path = self.spec('foo.spec', 'foo')
+        os.chmod(path, 0640)
+        speclib.prepend_globals(path, {'answer': '42'})
+        with open(path, 'rb') as spec_file:
+            self.assertEqual(spec_file.read(),
+                             '%global answer 42\n\n' +
+                             _SPEC.format(name='foo', extra=''))
+        self.assertEqual(os.stat(path).st_mode & 0777, 0640)
+        self.assertEqual(os.listdir(self.tmpdir), ['foo.spec'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,142 @@
+import io
+import os
+import os.path
+import shutil
+import subprocess
+import tarfile
+import tempfile
+import unittest
+
+import tarlib
+
+# Every commit gets the same time, so archives of different repos agree
+_GIT_ENV = {'GIT_AUTHOR_NAME': 'rpmfab', 'GIT_AUTHOR_EMAIL': 'rpmfab@test',
+            'GIT_AUTHOR_DATE': '1500000000 +0000',
+            'GIT_COMMITTER_NAME': 'rpmfab',
+            'GIT_COMMITTER_EMAIL': 'rpmfab@test',
+            'GIT_COMMITTER_DATE': '1500000000 +0000'}
+
+
+def _git(repo, *args):
+    env = dict(os.environ)
+    env.update(_GIT_ENV)
+    return subprocess.check_output(('git',) + args, cwd=repo, env=env)
+
+
+def _members(data):
+    # Everything about each member of a tarball, in order, including its
+    # contents
+    tar = tarfile.open(fileobj=io.BytesIO(data), mode='r|')
+    members = []
+    for info in tar:
+        content = tar.extractfile(info).read() if info.isreg() else None
+        members.append((info.name.rstrip('/'), info.type, info.mode,
+                        info.mtime, info.linkname, info.uid, info.gid,
+                        info.uname, info.gname, content))
+    tar.close()
+    return (tar.pax_headers, members)
+
+
+class GitArchiverTest(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp(prefix='rpmfab-test-')
+        self.saved_epoch = os.environ.pop('SOURCE_DATE_EPOCH', None)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+        os.environ.pop('SOURCE_DATE_EPOCH', None)
+        if self.saved_epoch is not None:
+            os.environ['SOURCE_DATE_EPOCH'] = self.saved_epoch
+
+    def make_repo(self, name, files):
+        # files maps paths to contents, or to ('link', TARGET) for symlinks;
+        # files in bin/ are executable
+        repo = os.path.join(self.tmpdir, name)
+        os.makedirs(repo)
+        _git(repo, 'init', '-q')
+        for (path, content) in sorted(files.iteritems()):
+            full_path = os.path.join(repo, path)
+            if not os.path.isdir(os.path.dirname(full_path)):
+                os.makedirs(os.path.dirname(full_path))
+            if isinstance(content, tuple):
+                os.symlink(content[1], full_path)
+                continue
+            with open(full_path, 'wb') as out:
+                out.write(content)
+            os.chmod(full_path, 0755 if path.startswith('bin/') else 0644)
+        _git(repo, 'add', '-A')
+        self.commit(repo)
+        return repo
+
+    def commit(self, repo):
+        _git(repo, 'commit', '-q', '-m', 'test')
+        return _git(repo, 'rev-parse', 'HEAD').strip()
+
+    def archive(self, repo, prefix, find_submodule=None):
+        commit = _git(repo, 'rev-parse', 'HEAD').strip()
+        archiver = tarlib.GitArchiver(find_submodule or
+                                      (lambda *args: None))
+        out = io.BytesIO()
+        try:
+            archiver.archive(repo, commit, prefix, out)
+        finally:
+            archiver.close()
+        return out.getvalue()
+
+    def git_archive(self, repo, prefix):
+        return _git(repo, 'archive', '--format=tar',
+                    '--prefix=' + prefix + '/', 'HEAD')
+
+    def test_matches_git_archive(self):
+        repo = self.make_repo('plain', {
+            'README': 'hello\n', 'empty': '', 'bin/run': '#!/bin/sh\n',
+            'src/deep/er/file.c': 'int x;\n' * 10000,
+            'link': ('link', 'README'), 'src/dangling': ('link', 'nope'),
+            'x' * 120 + '/long-name': 'long\n'})
+        self.assertEqual(_members(self.archive(repo, 'plain-1.0')),
+                         _members(self.git_archive(repo, 'plain-1.0')))
+
+    def test_matches_git_archive_with_attributes(self):
+        repo = self.make_repo('attrs', {
+            '.gitattributes': 'secret export-ignore\n'
+                              'VERSION export-subst\n',
+            'secret': 'hidden\n', 'VERSION': '$Format:%H$\n',
+            'README': 'hello\n'})
+        archived = _members(self.archive(repo, 'attrs-1.0'))
+        self.assertEqual(archived,
+                         _members(self.git_archive(repo, 'attrs-1.0')))
+        names = [member[0] for member in archived[1]]
+        self.assertNotIn('attrs-1.0/secret', names)
+
+    def test_submodules_are_archived_in_place(self):
+        sub = self.make_repo('sub', {'lib.c': 'int y;\n',
+                                     'include/lib.h': 'int y;\n'})
+        subcommit = _git(sub, 'rev-parse', 'HEAD').strip()
+        repo = self.make_repo('super', {'main.c': 'int main;\n',
+                                        'zz': 'last\n'})
+        _git(repo, 'update-index', '--add', '--cacheinfo',
+             '160000,{0},sub'.format(subcommit))
+        self.commit(repo)
+
+        def find_submodule(repo, commit, path, subcommit):
+            return sub if path == 'sub' else None
+        (__, archived) = _members(self.archive(repo, 'super-1.0',
+                                               find_submodule))
+        (__, expected) = _members(self.git_archive(repo, 'super-1.0'))
+        (__, sub_members) = _members(self.git_archive(sub, 'super-1.0/sub'))
+        # git archive writes the submodule as an empty directory, which
+        # the archiver fills in right there
+        at = [member[0] for member in expected].index('super-1.0/sub') + 1
+        expected[at:at] = sub_members[1:]
+        self.assertEqual(archived, expected)
+
+    def test_source_date_epoch_caps_mtimes(self):
+        repo = self.make_repo('plain', {'README': 'hello\n'})
+        os.environ['SOURCE_DATE_EPOCH'] = '1400000000'
+        (__, members) = _members(self.archive(repo, 'plain-1.0'))
+        self.assertEqual(set(member[3] for member in members),
+                         set([1400000000]))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,296 @@
+import contextlib
+import errno
+import json
+import os
+import os.path
+import resource
+import subprocess
+import sys
+import threading
+import time
+
+# Spans are recorded by the tracer active in the thread they happen in, and
+# output goes where redirect_output sent it for that thread; threads doing
+# part of a job take both along with carry()
+_local = threading.local()
+# How many tracers are active in any thread, which need subprocesses traced
+_active_count = [0]
+_active_lock = threading.Lock()
+
+_Popen = subprocess.Popen
+
+
+class Tracer(object):
+    """
+    Collects timing spans for the phases of a build and for every
+    subprocess it runs, and writes them out as a Chrome trace (which
+    chrome://tracing, Perfetto, and plain JSON tools all read).
+
+    Phase spans record the rusage of everything the process and its
+    children did while they ran, so phases running at the same time in
+    different threads share each other's numbers.  Subprocess spans record
+    the subprocess's own rusage, exactly.
+    """
+    def __init__(self):
+        self.start_time = time.time()
+        self.events = []
+        self._lock = threading.Lock()
+        self._threads = {}
+        self._previous = None
+
+    def activate(self):
+        """
+        Start recording the spans of the calling thread, and install the
+        subprocess wrapper that records one for each subprocess.
+        """
+        self._previous = current()
+        _local.tracer = self
+        with _active_lock:
+            _active_count[0] += 1
+            subprocess.Popen = _TracedPopen
+
+    def deactivate(self):
+        _local.tracer = self._previous
+        with _active_lock:
+            _active_count[0] -= 1
+            if not _active_count[0]:
+                subprocess.Popen = _Popen
+
+    def add_span(self, name, cat, start, end, args, thread=None):
+        thread = thread or threading.current_thread()
+        with self._lock:
+            self._threads.setdefault(thread.ident, thread.name)
+            self.events.append({
+                'name': name, 'cat': cat, 'ph': 'X', 'pid': os.getpid(),
+                'tid': thread.ident,
+                'ts': int((start - self.start_time) * 1e6),
+                'dur': int((end - start) * 1e6), 'args': args})
+
+    def write(self, path, metadata=None):
+        """
+        Write the spans recorded so far to a Chrome trace file at path,
+        with metadata (such as what was built) in its otherData.
+        """
+        with self._lock:
+            events = [{'name': 'thread_name', 'ph': 'M', 'pid': os.getpid(),
+                       'tid': ident, 'args': {'name': name}}
+                      for (ident, name) in sorted(self._threads.items())]
+            events.extend(sorted(self.events, key=lambda event: event['ts']))
+        trace = {'traceEvents': events, 'displayTimeUnit': 'ms',
+                 'otherData': dict(metadata or {},
+                                   start_time=self.start_time)}
+        tmp_path = '{0}.tmp-{1}'.format(path, os.getpid())
+        with open(tmp_path, 'w') as trace_file:
+            json.dump(trace, trace_file, indent=1, sort_keys=True)
+        os.rename(tmp_path, path)
+
+
+def current():
+    """
+    Return the tracer active in the calling thread, or None.
+    """
+    return getattr(_local, 'tracer', None)
+
+
+def output():
+    """
+    Return the stream that output meant for people, such as mock's, goes
+    to from the calling thread:  sys.stdout unless redirect_output says
+    otherwise.
+    """
+    return getattr(_local, 'output', None) or sys.stdout
+
+
+@contextlib.contextmanager
+def redirect_output(stream):
+    """
+    Send the calling thread's output to stream inside the with statement,
+    so that jobs running at the same time each get their own log.
+    """
+    previous = getattr(_local, 'output', None)
+    _local.output = stream
+    try:
+        yield stream
+    finally:
+        _local.output = previous
+
+
+def carry(func):
+    """
+    Return a function that calls func with the tracer and output of the
+    thread calling carry, for use as the target of a thread doing part of
+    its job.
+    """
+    state = (current(), getattr(_local, 'output', None))
+
+    def call(*args, **kwargs):
+        previous = (current(), getattr(_local, 'output', None))
+        (_local.tracer, _local.output) = state
+        try:
+            return func(*args, **kwargs)
+        finally:
+            (_local.tracer, _local.output) = previous
+    return call
+
+
+@contextlib.contextmanager
+def tracing(path, metadata=None):
+    """
+    Trace everything run inside the with statement, as one span named
+    total with the rest inside it, into a Chrome trace file at path.  Do
+    nothing if path is None.
+    """
+    if not path:
+        yield None
+        return
+    tracer = Tracer()
+    tracer.activate()
+    try:
+        with span('total'):
+            yield tracer
+    finally:
+        tracer.deactivate()
+        tracer.write(path, metadata)
+
+
+@contextlib.contextmanager
+def span(name, cat='phase', output=None, **args):
+    """
+    Record the code run inside the with statement as a span named name in
+    the calling thread's tracer.  If output is the path of a file or directory,
+    the span also records how many bytes it held at the end.  Extra
+    keyword arguments are recorded with the span as they are.
+
+    This costs nothing when no tracer is active.
+    """
+    tracer = current()
+    if not tracer:
+        yield
+        return
+    start = time.time()
+    self_before = resource.getrusage(resource.RUSAGE_SELF)
+    children_before = resource.getrusage(resource.RUSAGE_CHILDREN)
+    try:
+        yield
+    finally:
+        end = time.time()
+        self_after = resource.getrusage(resource.RUSAGE_SELF)
+        children_after = resource.getrusage(resource.RUSAGE_CHILDREN)
+        args['self_cpu'] = round(_cpu(self_after) - _cpu(self_before), 3)
+        args.update(_rusage_args(children_after, children_before))
+        if output:
+            args['output_bytes'] = _disk_usage(output)
+        tracer.add_span(name, cat, start, end, args)
+
+
+def record(name, start, end, cat='phase', **args):
+    """
+    Record a span that has already happened, between two time.time()s, in
+    the calling thread's tracer.
+    """
+    tracer = current()
+    if tracer:
+        tracer.add_span(name, cat, start, end, args)
+
+
+def _cpu(rusage):
+    return rusage.ru_utime + rusage.ru_stime
+
+
+def _rusage_args(after, before=None):
+    """
+    Return the CPU time and I/O that one rusage records beyond another.
+    """
+    args = {'cpu_user': after.ru_utime, 'cpu_sys': after.ru_stime,
+            'blocks_in': after.ru_inblock, 'blocks_out': after.ru_oublock}
+    if before:
+        args['cpu_user'] -= before.ru_utime
+        args['cpu_sys'] -= before.ru_stime
+        args['blocks_in'] -= before.ru_inblock
+        args['blocks_out'] -= before.ru_oublock
+    args['cpu_user'] = round(args['cpu_user'], 3)
+    args['cpu_sys'] = round(args['cpu_sys'], 3)
+    return args
+
+
+def _disk_usage(path):
+    if not os.path.exists(path):
+        return 0
+    if not os.path.isdir(path):
+        return os.path.getsize(path)
+    total = 0
+    for (dirpath, dirnames, filenames) in os.walk(path):
+        for name in filenames:
+            full_path = os.path.join(dirpath, name)
+            if not os.path.islink(full_path):
+                total += os.path.getsize(full_path)
+    return total
+
+
+class _TracedPopen(_Popen):
+    """
+    A subprocess.Popen that reaps its process with wait4 to get its
+    rusage, and records a span for it from start to exit in the tracer of
+    the thread that started it.
+    """
+    def __init__(self, args, *posargs, **kwargs):
+        self._trace_start = time.time()
+        self._trace_thread = threading.current_thread()
+        self._tracer = current()
+        self._trace_args = args
+        self._trace_rusage = None
+        _Popen.__init__(self, args, *posargs, **kwargs)
+
+    def wait(self):
+        while self.returncode is None:
+            try:
+                (pid, sts, rusage) = _eintr_retry(os.wait4, self.pid, 0)
+            except OSError as err:
+                if err.errno != errno.ECHILD:
+                    raise
+                (pid, sts, rusage) = (self.pid, 0, None)
+            if pid == self.pid:
+                self._trace_rusage = rusage
+                self._handle_exitstatus(sts)
+        return self.returncode
+
+    def _internal_poll(self, _deadstate=None, **kwargs):
+        kwargs['_waitpid'] = self._wait4
+        return _Popen._internal_poll(self, _deadstate, **kwargs)
+
+    def _wait4(self, pid, options, _wait4=os.wait4):
+        (pid, sts, rusage) = _wait4(pid, options)
+        if pid:
+            self._trace_rusage = rusage
+        return (pid, sts)
+
+    def _handle_exitstatus(self, sts, *args, **kwargs):
+        _Popen._handle_exitstatus(self, sts, *args, **kwargs)
+        if self._tracer:
+            self._record_span()
+
+    def _record_span(self):
+        cmd = self._trace_args
+        if isinstance(cmd, basestring):
+            cmd = cmd.split()
+        name = os.path.basename(cmd[0]) if cmd else '?'
+        # Name git and mock runs after what they do
+        for arg in cmd[1:]:
+            if not arg.startswith('-') and not arg.startswith('/'):
+                name += ' ' + arg.split(None, 1)[0]
+                break
+        args = {'cmd': ' '.join(cmd), 'exit_status': self.returncode}
+        if self._trace_rusage:
+            args.update(_rusage_args(self._trace_rusage))
+            args['max_rss_kb'] = self._trace_rusage.ru_maxrss
+        self._tracer.add_span(name, 'subprocess', self._trace_start,
+                              time.time(), args, thread=self._trace_thread)
+
+
+def _eintr_retry(func, *args):
+    while True:
+        try:
+            return func(*args)
+        except OSError as err:
+            if err.errno != errno.EINTR:
+                raise